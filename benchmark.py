@@ -0,0 +1,421 @@
+"""
+Micro-benchmarks of the building blocks of the model.
+
+    python benchmark.py subpixel [--sizes 128 256 512] [--ratios 2 3 4] [--batch_size 4] [--runs 10]
+    python benchmark.py towers [--towers 1 2 4] [--device CPU] [--batch_size 32] [--image_size 128] [--steps 20]
+    python benchmark.py ssim [--sizes 256 512 1024] [--batch_size 4] [--runs 10]
+    python benchmark.py histogram [--sizes 128 256 512] [--batch_size 4] [--runs 10]
+    python benchmark.py suite [--output benchmark.json] [--baseline baseline.json] [--runs 10] [--quick]
+    python benchmark.py compare baseline.json benchmark.json [--threshold 0.1]
+
+subpixel compares phase_shift with the original split/concat implementation: graph node count, graph build time and
+forward and forward/backward time of the pixel shuffle alone for every output size and ratio.
+
+towers reports training images/sec of model_fn with the batch split across 1, 2, 4... towers and the speedup over
+the first tower count, on synthetic images so that the input pipeline does not limit the result.
+
+ssim compares tf_ssim, the separable filter of the stacked moments, with the original five 2-D convolutions: the
+largest difference of the ssim maps and forward and forward/backward time for every image size.
+
+histogram compares tf_histogram_loss with the original loop over the bins: difference of the losses, graph node
+count, graph build time and forward and forward/backward time.
+
+suite is the reproducible benchmark of the model and the input pipeline on synthetic data, no dataset is needed.
+For every image size (256/512/1024), batch size and upscale ratio it measures the graph build time, the forward
+latency and the forward/backward step time of srcnn with Adam, the peak memory, phase_shift and tf_ssim, and the
+records/sec of the training input pipeline on synthetic tfrecords. Every measurement runs in a fresh process with
+fixed seeds, times are medians after a warm-up run and peak memory is the growth of the peak resident memory of the
+process. The results are saved to json together with a description of the machine. compare reports the relative
+change of every measurement against a baseline and exits with 1 when one of them got worse by more than the
+threshold, suite --baseline compares right away.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.estimator.model_fn import ModeKeys as Modes
+
+from config import FLAGS
+from main import input_fn
+from model import get_session_config, srcnn, model_fn, tf_histogram_loss, tf_histogram_loss_reference, tf_ssim, tf_ssim_reference
+from subpixel import phase_shift, split_phase_shift
+from utils import DEPTH, FILENAME, FORMAT, HEIGHT, HR_IMAGE, LR_HEIGHT, LR_IMAGE, LR_WIDTH, UINT8_FORMAT, WIDTH
+
+SUITE_SIZES = [256, 512, 1024]
+SUITE_BATCH_SIZES = [1, 4]
+SUITE_RATIOS = [2, 4]
+SUITE_SEED = 42
+PIPELINE_RECORDS = 256
+PIPELINE_BATCHES = 200
+
+# measurements where larger values are better, all others are times or memory
+HIGHER_IS_BETTER = ['records_per_sec', 'mb_per_sec']
+
+
+def _time_runs(session, fetches, feed_dict, runs):
+    """Median time of a session.run in ms after one warm-up run."""
+    session.run(fetches, feed_dict=feed_dict)
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        session.run(fetches, feed_dict=feed_dict)
+        times.append(time.time() - start)
+    return 1000 * np.median(times)
+
+
+def _benchmark_shuffle(shuffle, size, ratio, color, batch_size, runs):
+    channels = (3 if color else 1) * ratio * ratio
+    lr_size = size // ratio
+    graph = tf.Graph()
+    with graph.as_default():
+        X = tf.placeholder(tf.float32, shape=(batch_size, lr_size, lr_size, channels))
+        nodes = len(graph.as_graph_def().node)
+        start = time.time()
+        Y = shuffle(X, ratio, color)
+        gradient = tf.gradients(tf.reduce_sum(Y), X)[0]
+        build_ms = 1000 * (time.time() - start)
+        nodes = len(graph.as_graph_def().node) - nodes
+        x = np.random.rand(batch_size, lr_size, lr_size, channels).astype(np.float32)
+        with tf.Session(graph=graph) as session:
+            forward_ms = _time_runs(session, Y, {X: x}, runs)
+            backward_ms = _time_runs(session, gradient, {X: x}, runs)
+    return nodes, build_ms, forward_ms, backward_ms
+
+
+def _parse_default_flags():
+    """Parse the flags read by the model and input code with their defaults, the benchmark options are no flags."""
+    FLAGS([sys.argv[0]])
+
+
+def benchmark_subpixel(args):
+    print("%-6s %5s %5s %-12s %7s %10s %12s %12s" % ('size', 'ratio', 'color', 'impl', 'nodes', 'build ms', 'forward ms',
+                                                     'fwd+bwd ms'))
+    for size in args.sizes:
+        for ratio in args.ratios:
+            for color in (False, True):
+                for name, shuffle in [('split', split_phase_shift), ('reshape', phase_shift)]:
+                    nodes, build_ms, forward_ms, backward_ms = _benchmark_shuffle(shuffle, size, ratio, color,
+                                                                                  args.batch_size, args.runs)
+                    print("%-6d %5d %5s %-12s %7d %10.1f %12.2f %12.2f" % (size, ratio, color, name, nodes, build_ms,
+                                                                           forward_ms, backward_ms))
+
+
+def benchmark_towers(args):
+    lr_size = args.image_size // args.ratio
+    lr_images = np.random.rand(args.batch_size, lr_size, lr_size, 1).astype(np.float32)
+    hr_images = np.random.rand(args.batch_size, args.image_size, args.image_size, 1).astype(np.float32)
+    print("%-7s %-30s %12s %8s" % ('towers', 'devices', 'images/sec', 'speedup'))
+    baseline = None
+    for towers in args.towers:
+        device = ','.join('%s:%d' % (args.device, i) for i in range(towers))
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.train.create_global_step()
+            params = tf.contrib.training.HParams(learning_rate=1e-3, pkeep_conv=0.75, histogram_loss_weight=0.0, device=device,
+                                                 ratio=args.ratio, normalize_inputs=False, input_mean=[0.], input_std=[1.])
+            spec = model_fn(tf.constant(lr_images), tf.constant(hr_images), Modes.TRAIN, params)
+            with tf.Session(graph=graph, config=get_session_config(device)) as session:
+                session.run(tf.global_variables_initializer())
+                step_ms = _time_runs(session, spec.train_op, None, args.steps)
+        images_per_sec = args.batch_size / (step_ms / 1000)
+        baseline = baseline or images_per_sec
+        print("%-7d %-30s %12.1f %8.2f" % (towers, device, images_per_sec, images_per_sec / baseline))
+
+
+def benchmark_ssim(args):
+    print("%-6s %-10s %14s %12s %12s" % ('size', 'impl', 'max diff', 'forward ms', 'fwd+bwd ms'))
+    for size in args.sizes:
+        images = np.random.rand(2, args.batch_size, size, size, 1).astype(np.float32)
+        # the second image is a noisy copy of the first, like a prediction of the high resolution image
+        images[1] = np.clip(images[0] + 0.1 * (images[1] - 0.5), 0, 1)
+        graph = tf.Graph()
+        with graph.as_default():
+            img1 = tf.placeholder(tf.float32, shape=images.shape[1:])
+            img2 = tf.placeholder(tf.float32, shape=images.shape[1:])
+            feed_dict = {img1: images[0], img2: images[1]}
+            with tf.Session(graph=graph) as session:
+                maps = []
+                for name, ssim in [('reference', tf_ssim_reference), ('separable', tf_ssim)]:
+                    ssim_map = ssim(img1, img2, mean_metric=False)
+                    gradient = tf.gradients(tf.reduce_mean(ssim_map), img2)[0]
+                    maps.append(session.run(ssim_map, feed_dict=feed_dict))
+                    forward_ms = _time_runs(session, ssim_map, feed_dict, args.runs)
+                    backward_ms = _time_runs(session, gradient, feed_dict, args.runs)
+                    difference = np.abs(maps[-1] - maps[0]).max()
+                    print("%-6d %-10s %14.3g %12.2f %12.2f" % (size, name, difference, forward_ms, backward_ms))
+                assert np.allclose(maps[0], maps[1], atol=1e-4), 'tf_ssim differs from the reference'
+
+
+def benchmark_histogram(args):
+    print("%-6s %-10s %12s %7s %10s %12s %12s" % ('size', 'impl', 'loss', 'nodes', 'build ms', 'forward ms', 'fwd+bwd ms'))
+    for size in args.sizes:
+        images = np.random.rand(2, args.batch_size, size, size, 1).astype(np.float32)
+        images[1] = np.clip(images[0] + 0.1 * (images[1] - 0.5), 0, 1)
+        losses = []
+        for name, histogram_loss in [('reference', tf_histogram_loss_reference), ('vectorized', tf_histogram_loss)]:
+            graph = tf.Graph()
+            with graph.as_default():
+                img1 = tf.placeholder(tf.float32, shape=images.shape[1:])
+                img2 = tf.placeholder(tf.float32, shape=images.shape[1:])
+                feed_dict = {img1: images[0], img2: images[1]}
+                nodes = len(graph.as_graph_def().node)
+                start = time.time()
+                loss = histogram_loss(img1, img2)
+                build_ms = 1000 * (time.time() - start)
+                nodes = len(graph.as_graph_def().node) - nodes
+                # the histogram is piecewise linear in the pixels, the gradient flows through the positions within the bins
+                gradient = tf.gradients(loss, img2)[0]
+                with tf.Session(graph=graph) as session:
+                    losses.append(session.run(loss, feed_dict=feed_dict))
+                    forward_ms = _time_runs(session, loss, feed_dict, args.runs)
+                    backward_ms = _time_runs(session, gradient, feed_dict, args.runs)
+            print("%-6d %-10s %12.6g %7d %10.1f %12.2f %12.2f" % (size, name, losses[-1], nodes, build_ms, forward_ms, backward_ms))
+        assert np.isclose(losses[0], losses[1], rtol=1e-4, atol=1e-7), 'tf_histogram_loss differs from the reference'
+
+
+def _peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return usage / 1024. / 1024. if sys.platform == 'darwin' else usage / 1024.
+
+
+def _measure_srcnn(size, batch_size, ratio, runs):
+    np.random.seed(SUITE_SEED)
+    baseline_mb = _peak_rss_mb()
+    lr_size = size // ratio
+    lr_images = np.random.rand(batch_size, lr_size, lr_size, 1).astype(np.float32)
+    hr_images = np.random.rand(batch_size, size, size, 1).astype(np.float32)
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.set_random_seed(SUITE_SEED)
+        lr_input = tf.placeholder(tf.float32, shape=lr_images.shape)
+        hr_input = tf.placeholder(tf.float32, shape=hr_images.shape)
+        start = time.time()
+        prediction = srcnn(lr_input, size, ratio=ratio)
+        train_op = tf.train.AdamOptimizer(1e-3).minimize(tf.losses.mean_squared_error(hr_input, prediction))
+        build_ms = 1000 * (time.time() - start)
+        feed_dict = {lr_input: lr_images, hr_input: hr_images}
+        with tf.Session(graph=graph) as session:
+            session.run(tf.global_variables_initializer())
+            forward_ms = _time_runs(session, prediction, feed_dict, runs)
+            step_ms = _time_runs(session, train_op, feed_dict, runs)
+    return OrderedDict([('build_ms', build_ms), ('forward_ms', forward_ms), ('step_ms', step_ms),
+                        ('peak_mb', _peak_rss_mb() - baseline_mb)])
+
+
+def _measure_phase_shift(size, batch_size, ratio, runs):
+    np.random.seed(SUITE_SEED)
+    nodes, build_ms, forward_ms, backward_ms = _benchmark_shuffle(phase_shift, size, ratio, False, batch_size, runs)
+    return OrderedDict([('nodes', nodes), ('build_ms', build_ms), ('forward_ms', forward_ms), ('step_ms', backward_ms)])
+
+
+def _measure_ssim(size, batch_size, runs):
+    np.random.seed(SUITE_SEED)
+    images = np.random.rand(2, batch_size, size, size, 1).astype(np.float32)
+    graph = tf.Graph()
+    with graph.as_default():
+        img1 = tf.placeholder(tf.float32, shape=images.shape[1:])
+        img2 = tf.placeholder(tf.float32, shape=images.shape[1:])
+        start = time.time()
+        ssim = tf_ssim(img1, img2)
+        gradient = tf.gradients(ssim, img2)[0]
+        build_ms = 1000 * (time.time() - start)
+        feed_dict = {img1: images[0], img2: images[1]}
+        with tf.Session(graph=graph) as session:
+            forward_ms = _time_runs(session, ssim, feed_dict, runs)
+            step_ms = _time_runs(session, gradient, feed_dict, runs)
+    return OrderedDict([('build_ms', build_ms), ('forward_ms', forward_ms), ('step_ms', step_ms)])
+
+
+def _pipeline_settings():
+    """HParams of input_fn for the suite. They are the flag defaults, parse_function reads the image shapes from FLAGS."""
+    return dict(compression_type='', record_format=UINT8_FORMAT, image_size=FLAGS.image_size, lr_image_size=FLAGS.lr_image_size,
+                color_channels=FLAGS.color_channels, ratio=FLAGS.image_size // FLAGS.lr_image_size, variable_size=False,
+                bucket_boundaries='', patch_size=0, patches_per_image=16, patch_stride=0, patch_min_variance=0.0,
+                num_parallel_reads=FLAGS.num_parallel_reads, num_parallel_calls=FLAGS.num_parallel_calls, cache='',
+                shuffle_buffer_mb=FLAGS.shuffle_buffer_mb, prefetch_batches=FLAGS.prefetch_batches, device='CPU:0')
+
+
+def _write_synthetic_records(path, count, image_size, lr_image_size, channels):
+    """Compact uint8 records of random images."""
+    hr_shape = (image_size, image_size, channels)
+    lr_shape = (lr_image_size, lr_image_size, channels)
+    with tf.python_io.TFRecordWriter(path) as writer:
+        for i in range(count):
+            feature = {
+                HEIGHT: tf.train.Feature(int64_list=tf.train.Int64List(value=[hr_shape[0]])),
+                WIDTH: tf.train.Feature(int64_list=tf.train.Int64List(value=[hr_shape[1]])),
+                DEPTH: tf.train.Feature(int64_list=tf.train.Int64List(value=[hr_shape[2]])),
+                LR_HEIGHT: tf.train.Feature(int64_list=tf.train.Int64List(value=[lr_shape[0]])),
+                LR_WIDTH: tf.train.Feature(int64_list=tf.train.Int64List(value=[lr_shape[1]])),
+                FORMAT: tf.train.Feature(bytes_list=tf.train.BytesList(value=[UINT8_FORMAT.encode('utf-8')])),
+                HR_IMAGE: tf.train.Feature(bytes_list=tf.train.BytesList(value=[np.random.randint(0, 256, hr_shape, np.uint8).tobytes()])),
+                LR_IMAGE: tf.train.Feature(bytes_list=tf.train.BytesList(value=[np.random.randint(0, 256, lr_shape, np.uint8).tobytes()])),
+                FILENAME: tf.train.Feature(bytes_list=tf.train.BytesList(value=[('synthetic_%d' % i).encode('utf-8')]))
+            }
+            writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+
+
+def _measure_pipeline(settings, batch_size, batches):
+    """Records/sec of input_fn with the given settings on shards of synthetic records."""
+    np.random.seed(SUITE_SEED)
+    record_dir = tempfile.mkdtemp()
+    try:
+        files = [os.path.join(record_dir, 'synthetic-%d.tfrecord' % i) for i in range(4)]
+        for path in files:
+            _write_synthetic_records(path, PIPELINE_RECORDS // len(files), settings['image_size'], settings['lr_image_size'],
+                                     settings['color_channels'])
+        params = tf.contrib.training.HParams(**settings)
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.set_random_seed(SUITE_SEED)
+            features, labels = input_fn(files, None, True, batch_size, params)
+            with tf.Session(graph=graph) as session:
+                # the first batches fill the shuffle buffer
+                for _ in range(10):
+                    session.run([features, labels])
+                start = time.time()
+                decoded_bytes = 0
+                for _ in range(batches):
+                    lr_images, hr_images = session.run([features, labels])
+                    decoded_bytes += lr_images.nbytes + hr_images.nbytes
+                elapsed = time.time() - start
+    finally:
+        shutil.rmtree(record_dir)
+    return OrderedDict([('records_per_sec', batches * batch_size / elapsed), ('mb_per_sec', decoded_bytes / elapsed / 1024 / 1024)])
+
+
+def _isolated(function, *args):
+    """Run a measurement in a fresh process, so that earlier measurements do not affect its time or memory."""
+    # the process inherits sys.argv with the suite options, the model and input code read FLAGS
+    pool = multiprocessing.get_context('spawn').Pool(1, initializer=_parse_default_flags)
+    try:
+        return pool.apply(function, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _machine():
+    return OrderedDict([('host', platform.node()), ('platform', platform.platform()), ('processor', platform.processor()),
+                        ('cpus', multiprocessing.cpu_count()), ('python', platform.python_version()),
+                        ('tensorflow', tf.__version__), ('numpy', np.__version__)])
+
+
+def run_suite(args):
+    sizes = SUITE_SIZES[:1] if args.quick else SUITE_SIZES
+    results = OrderedDict()
+    for size in sizes:
+        for batch_size in SUITE_BATCH_SIZES:
+            for ratio in SUITE_RATIOS:
+                key = 'srcnn/size=%d/batch=%d/ratio=%d' % (size, batch_size, ratio)
+                results[key] = _isolated(_measure_srcnn, size, batch_size, ratio, args.runs)
+                print(key, json.dumps(results[key]))
+                key = 'phase_shift/size=%d/batch=%d/ratio=%d' % (size, batch_size, ratio)
+                results[key] = _isolated(_measure_phase_shift, size, batch_size, ratio, args.runs)
+                print(key, json.dumps(results[key]))
+            key = 'ssim/size=%d/batch=%d' % (size, batch_size)
+            results[key] = _isolated(_measure_ssim, size, batch_size, args.runs)
+            print(key, json.dumps(results[key]))
+    for batch_size in SUITE_BATCH_SIZES:
+        key = 'pipeline/batch=%d' % batch_size
+        results[key] = _isolated(_measure_pipeline, _pipeline_settings(), batch_size, PIPELINE_BATCHES)
+        print(key, json.dumps(results[key]))
+
+    report = OrderedDict([('date', time.strftime('%Y-%m-%dT%H:%M:%S')), ('machine', _machine()), ('runs', args.runs),
+                          ('results', results)])
+    with open(args.output, 'w') as writer:
+        json.dump(report, writer, indent=2)
+    print("Saved results to %s" % args.output)
+    if args.baseline:
+        return compare_results(args.baseline, args.output, args.threshold)
+    return 0
+
+
+def compare_results(baseline_path, current_path, threshold):
+    """Print the relative change of every measurement, returns 1 when a measurement regressed by more than threshold."""
+    with open(baseline_path) as reader:
+        baseline = json.load(reader)
+    with open(current_path) as reader:
+        current = json.load(reader)
+    if baseline['machine'].get('host') != current['machine'].get('host'):
+        print("Warning: baseline from %s, results from %s" % (baseline['machine'].get('host'), current['machine'].get('host')))
+    regressions = 0
+    print("%-42s %-16s %12s %12s %9s" % ('benchmark', 'measurement', 'baseline', 'current', 'change'))
+    for key, measurements in current['results'].items():
+        if key not in baseline['results']:
+            print("%-42s new" % key)
+            continue
+        for name, value in measurements.items():
+            base = baseline['results'][key].get(name)
+            if base is None or value is None or name == 'nodes' and base == value:
+                continue
+            change = (value - base) / base if base else 0.
+            worse = -change if name in HIGHER_IS_BETTER else change
+            flag = 'REGRESSION' if worse > threshold else ''
+            regressions += 1 if flag else 0
+            print("%-42s %-16s %12.3f %12.3f %+8.1f%% %s" % (key, name, base, value, 100 * change, flag))
+    print("%d regressions above %.0f%%" % (regressions, 100 * threshold))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the model building blocks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    subpixel = subparsers.add_parser('subpixel', help='phase_shift against the split/concat implementation')
+    subpixel.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512], help='output image sizes')
+    subpixel.add_argument('--ratios', type=int, nargs='+', default=[2, 3, 4], help='upscale ratios')
+    subpixel.add_argument('--batch_size', type=int, default=4)
+    subpixel.add_argument('--runs', type=int, default=10, help='timed runs per measurement')
+    subpixel.set_defaults(run=benchmark_subpixel)
+
+    towers = subparsers.add_parser('towers', help='training throughput against the number of towers')
+    towers.add_argument('--towers', type=int, nargs='+', default=[1, 2, 4], help='tower counts')
+    towers.add_argument('--device', default='CPU', help='device type of the towers, CPU or GPU')
+    towers.add_argument('--batch_size', type=int, default=32, help='batch size split across the towers')
+    towers.add_argument('--image_size', type=int, default=128, help='high resolution image size')
+    towers.add_argument('--ratio', type=int, default=2, help='upscale ratio')
+    towers.add_argument('--steps', type=int, default=20, help='timed training steps')
+    towers.set_defaults(run=benchmark_towers)
+
+    ssim = subparsers.add_parser('ssim', help='separable tf_ssim against the original 2-D convolutions')
+    ssim.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024], help='image sizes')
+    ssim.add_argument('--batch_size', type=int, default=4)
+    ssim.add_argument('--runs', type=int, default=10, help='timed runs per measurement')
+    ssim.set_defaults(run=benchmark_ssim)
+
+    histogram = subparsers.add_parser('histogram', help='vectorized tf_histogram_loss against the loop over the bins')
+    histogram.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512], help='image sizes')
+    histogram.add_argument('--batch_size', type=int, default=4)
+    histogram.add_argument('--runs', type=int, default=10, help='timed runs per measurement')
+    histogram.set_defaults(run=benchmark_histogram)
+
+    suite = subparsers.add_parser('suite', help='reproducible benchmark of the model and the input pipeline on synthetic data')
+    suite.add_argument('--output', default='benchmark.json', help='json file of the results')
+    suite.add_argument('--baseline', default='', help='compare the results with this json file')
+    suite.add_argument('--threshold', type=float, default=0.1, help='relative change counted as regression')
+    suite.add_argument('--runs', type=int, default=10, help='timed runs per measurement')
+    suite.add_argument('--quick', action='store_true', help='only the smallest image size')
+    suite.set_defaults(run=run_suite)
+
+    compare = subparsers.add_parser('compare', help='compare suite results with a baseline')
+    compare.add_argument('baseline', help='json file of the baseline')
+    compare.add_argument('current', help='json file of the results')
+    compare.add_argument('--threshold', type=float, default=0.1, help='relative change counted as regression')
+    compare.set_defaults(run=lambda args: compare_results(args.baseline, args.current, args.threshold))
+
+    args = parser.parse_args()
+    _parse_default_flags()
+    sys.exit(args.run(args))
@@ -4,19 +4,71 @@ import numpy as np
 flags = tf.app.flags
 flags.DEFINE_string("dataset", "train", "The name of dataset [celebA, mnist, lsun ...]")
 flags.DEFINE_string("subset", "kidney", "The name of subset [train, validation, test]")
+flags.DEFINE_string("validation_subset", "", "The subset evaluated during training, empty disables evaluation []")
+flags.DEFINE_integer("eval_frequency", 500, "Minimum number of training steps between checkpoints and evaluations [500]")
 flags.DEFINE_string("extension", "jpg", "The file extension [tif, jpg....]")
 flags.DEFINE_string("checkpoint_dir", "checkpoint", "Directory name to save the checkpoints [checkpoint]")
 flags.DEFINE_string("summaries_dir", "summaries", "Directory name to save training summaries[summaries]")
 flags.DEFINE_string("log_dir", "logs", "Directory name to store logs [logs]")
 flags.DEFINE_string("output_dir", "outputs", "Directory name to store output images [outputs]")
+flags.DEFINE_string("export_dir", "export", "Directory name to export SavedModels and frozen graphs [export]")
 flags.DEFINE_string("data_dir", "data", "Directory name to download the train/test datasets [data]")
 flags.DEFINE_string("tfrecord_dir", "tfrecords", "Directory name to store the TFRecord data [tfrecords]")
+flags.DEFINE_string("npy_dir", "npy", "Directory name to store the memory-mapped NumPy data [npy]")
+flags.DEFINE_string("data_backend", "tfrecord", "Training data read from tfrecords or memory-mapped NumPy arrays [tfrecord, npy]")
 flags.DEFINE_integer("batch_size", 10, "The size of batch images [10]")
 flags.DEFINE_integer("image_size", 256, "The size of image to use (will be center cropped) [256]")
+flags.DEFINE_integer("lr_image_size", 256, "The size of low resolution images, image_size / lr_image_size is the upscale ratio [256]")
+flags.DEFINE_bool("variable_size", False, "Keep the original image sizes in compact tfrecords instead of resizing to image_size [false]")
+flags.DEFINE_string("bucket_boundaries", "", "Comma separated image heights/widths bounding the size buckets of variable size batches, "
+                                             "empty batches only images of equal size []")
+flags.DEFINE_integer("patch_size", 0, "Train on random low resolution patches of this size instead of whole images, 0 disables [0]")
+flags.DEFINE_integer("patches_per_image", 16, "Number of random patches sampled from every decoded image [16]")
+flags.DEFINE_integer("patch_stride", 0, "Stride of the grid of patch positions in low resolution pixels, 0 is the patch size [0]")
+flags.DEFINE_float("patch_min_variance", 0.0, "Skip patches whose high resolution variance is not above this threshold [0.0]")
+flags.DEFINE_integer("num_parallel_reads", 4, "Number of tfrecord files read in parallel [4]")
+flags.DEFINE_integer("num_parallel_calls", 4, "Number of records parsed in parallel [4]")
+flags.DEFINE_string("cache", "", "Cache parsed records in 'memory' or in files with this path prefix, empty disables caching []")
+flags.DEFINE_integer("shuffle_buffer_mb", 512, "Memory budget of the shuffle buffer in megabytes [512]")
+flags.DEFINE_integer("prefetch_batches", 2, "Number of batches prepared ahead of the training step [2]")
+flags.DEFINE_bool("benchmark_input", False, "Only drain the training input pipeline and report its throughput [false]")
+flags.DEFINE_integer("benchmark_steps", 0, "Number of batches drained by the input benchmark, 0 drains one epoch [0]")
+flags.DEFINE_bool("normalize_inputs", False, "Standardize the low resolution inputs per channel with the mean and std in stats.json of the "
+                                          "training subset (tfrecords.py --tfrecord_mode=validate), pass it to testing and export too [false]")
 flags.DEFINE_integer("color_channels", 1, "The number of image color channels")
 flags.DEFINE_integer("epoch", 1500, "Epoch to train [1000]")
 flags.DEFINE_float("learning_rate", 1e-3, "The learning rate of gradient descent algorithm [1e-4]")
-flags.DEFINE_string("device", 'CPU:0', "The device: CPU or GPU [CPU:0]")
-flags.DEFINE_string("tfrecord_mode", 'test', "Mode to create/test tfrecord files. Default is [test]")
+flags.DEFINE_float("histogram_loss_weight", 0.0, "Weight of the histogram loss added to the training loss, 0 disables it [0.0]")
+flags.DEFINE_integer("throughput_every_steps", 100, "Training steps between throughput and memory records [100]")
+flags.DEFINE_integer("trace_every_steps", 500, "Training steps between traced steps measuring the input wait, 0 disables tracing [500]")
+flags.DEFINE_bool("profile", False, "Trace a window of training or testing steps and report the slowest and largest ops [false]")
+flags.DEFINE_integer("profile_start", 10, "First profiled step, earlier steps warm up [10]")
+flags.DEFINE_integer("profile_steps", 5, "Number of profiled steps [5]")
+flags.DEFINE_integer("profile_top", 20, "Number of ops listed in the profile report [20]")
+flags.DEFINE_string("device", 'CPU:0', "Comma separated devices the training batch is split across, e.g. CPU:0,CPU:1 or GPU:0,GPU:1 [CPU:0]")
+flags.DEFINE_integer("intra_op_threads", 0, "Threads of a single op, 0 uses the tuned profile of this machine or the TensorFlow default [0]")
+flags.DEFINE_integer("inter_op_threads", 0, "Ops run in parallel, 0 uses the tuned profile of this machine or the TensorFlow default [0]")
+flags.DEFINE_string("thread_profile_dir", "thread_profiles", "Directory of the thread profiles tuned by tune_threads.py, one {hostname}.json per machine [thread_profiles]")
+flags.DEFINE_integer("tune_steps", 10, "Timed steps per thread configuration tried by tune_threads.py [10]")
+flags.DEFINE_string("tfrecord_mode", 'test', "Mode to create/test/validate tfrecord files or export them to NumPy arrays [create, test, validate, export_npy]. Default is [test]")
+flags.DEFINE_string("record_format", "uint8", "Pixel encoding of new tfrecords [uint8, float16, float]")
+flags.DEFINE_integer("shard_size", 0, "Number of records per tfrecord shard, 0 writes one file per image [0]")
+flags.DEFINE_integer("shard_bytes", 0, "Target size of a tfrecord shard in bytes before compression, 0 is unlimited [0]")
+flags.DEFINE_bool("incremental", True, "Only process new or changed images when tfrecords of the subset exist [true]")
+flags.DEFINE_integer("workers", 1, "Number of processes decoding and serializing images for tfrecords [1]")
+flags.DEFINE_integer("queue_size", 64, "Maximum number of images in flight between the workers and the tfrecord writer [64]")
+flags.DEFINE_string("compression", "", "Compression of tfrecord shards, sharded mode only [GZIP, ZLIB or empty for none]")
+flags.DEFINE_integer("test_batch_size", 8, "The number of test images predicted in one batch [8]")
+flags.DEFINE_string("outputs", "prediction,low_resolution,high_resolution,composite",
+                    "Comma separated images written by testing [prediction, low_resolution, high_resolution, composite]")
+flags.DEFINE_integer("output_workers", 4, "Number of threads writing output images while testing continues, 0 writes them in the testing loop [4]")
+flags.DEFINE_integer("tile_size", 0, "Predict test images in tiles of this low resolution size, 0 predicts whole images [0]")
+flags.DEFINE_integer("tile_batch", 8, "Number of tiles predicted in one batch [8]")
+flags.DEFINE_integer("tile_overlap", 0, "Low resolution pixels by which neighbouring tiles overlap and are blended [0]")
+flags.DEFINE_string("quantize_mode", "export", "Mode to export a quantized inference graph or compare it with the float model [export, report]")
+flags.DEFINE_string("quantization", "int8", "Quantization of the exported inference graph [int8, float16]")
+flags.DEFINE_integer("calibration_batches", 16, "Number of batches of the subset calibrating the int8 activation ranges [16]")
+flags.DEFINE_string("quantized_graph", "", "Quantized inference graph, testing runs it instead of the checkpoint. "
+                                           "quantize.py defaults to {checkpoint_dir}/srcnn_{quantization}.pb []")
 flags.DEFINE_bool("is_train", "true", "Train or test mode")
 FLAGS = flags.FLAGS
@@ -10,44 +10,191 @@ Downloads the following:
 from __future__ import print_function
 
 import argparse
+import hashlib
 import json
 import os
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import zipfile
+from functools import partial
 
 from six.moves import urllib
+from six.moves.BaseHTTPServer import HTTPServer
+from six.moves.SimpleHTTPServer import SimpleHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+
+# published digest of img_align_celeba.zip
+CELEB_A_CHECKSUM = 'md5:00d2c5bc6d35e252742224ab0c1e8fcb'
 
 parser = argparse.ArgumentParser(description='Download dataset for DCGAN.')
 parser.add_argument('--datasets', metavar='N', type=str, nargs='+',
                     help='name of dataset to download [celebA, lusn, mnist]')
+parser.add_argument('--workers', type=int, default=4,
+                    help='number of parallel range requests per download [4]')
+parser.add_argument('--check', action='store_true',
+                    help='check downloads and extraction against a local HTTP server instead of downloading')
 
 
-def download(url, dirpath):
-    filename = url.split('/')[-1]
-    filepath = os.path.join(dirpath, filename)
-    u = urllib.request.urlopen(url)
-    f = open(filepath, 'wb')
-    filesize = int(u.headers["Content-Length"])
-    print("Downloading: %s Bytes: %s" % (filename, filesize))
+def _print_status(filename, downloaded, filesize, status_width=70):
+    if filesize:
+        status = (("[%-" + str(status_width + 1) + "s] %3.2f%%") %
+                  ('=' * int(float(downloaded) / filesize * status_width) + '>', downloaded * 100. / filesize))
+    else:
+        status = "%s: %d Bytes" % (filename, downloaded)
+    print('', end='\r')
+    print(status, end='')
+    sys.stdout.flush()
+
+
+def _probe(url):
+    """Return the final url after redirects, the size of the file and whether the server accepts range requests."""
+    u = urllib.request.urlopen(urllib.request.Request(url, headers={'Range': 'bytes=0-0'}))
+    try:
+        if u.getcode() == 206:
+            return u.geturl(), int(u.headers['Content-Range'].split('/')[-1]), True
+        length = u.headers.get('Content-Length')
+        return u.geturl(), int(length) if length else None, False
+    finally:
+        u.close()
+
+
+def _load_progress(progress_path, url, filesize, workers):
+    """Load the byte count done per chunk of an interrupted download, or split the file into new chunks.
+    Returns the progress and whether it resumes an earlier download.
+    """
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            progress = json.load(f)
+        if progress['size'] == filesize:
+            return progress, True
+    chunk_size = -(-filesize // workers)
+    chunks = [[start, min(start + chunk_size, filesize) - 1, 0] for start in range(0, filesize, chunk_size)]
+    return {'url': url, 'size': filesize, 'chunks': chunks}, False
+
+
+def _save_progress(progress_path, progress):
+    with open(progress_path + '.tmp', 'w') as f:
+        json.dump(progress, f)
+    os.replace(progress_path + '.tmp', progress_path)
+
+
+def _download_chunk(url, partial_path, chunk, lock, errors, block_sz=64 * 1024):
+    start, end, done = chunk
+    if start + done > end:
+        return
+    try:
+        u = urllib.request.urlopen(urllib.request.Request(url, headers={'Range': 'bytes=%d-%d' % (start + done, end)}))
+        # unbuffered, every block counted as done has been handed to the operating system
+        with open(partial_path, 'r+b', buffering=0) as f:
+            f.seek(start + done)
+            while True:
+                buf = u.read(block_sz)
+                if not buf:
+                    break
+                f.write(buf)
+                with lock:
+                    chunk[2] += len(buf)
+        u.close()
+    except Exception as e:
+        errors.append(e)
+
 
+def _download_ranges(url, filepath, filesize, workers):
+    """Download with parallel range requests straight into the preallocated file.
+
+    The bytes done per chunk are saved next to the file, a restarted download only requests the missing ranges.
+    """
+    partial_path = filepath + '.partial'
+    progress_path = filepath + '.progress'
+    progress, resumed = _load_progress(progress_path, url, filesize, workers)
+    if not resumed or not os.path.exists(partial_path):
+        progress, resumed = _load_progress('', url, filesize, workers)
+        with open(partial_path, 'wb') as f:
+            f.truncate(filesize)
+    else:
+        print("Resuming download of %s" % os.path.basename(filepath))
+    lock = threading.Lock()
+    errors = []
+    threads = [threading.Thread(target=_download_chunk, args=(url, partial_path, chunk, lock, errors)) for chunk in progress['chunks']]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(0.5)
+        with lock:
+            _save_progress(progress_path, progress)
+            downloaded = sum(done for start, end, done in progress['chunks'])
+        _print_status(os.path.basename(filepath), downloaded, filesize)
+    _save_progress(progress_path, progress)
+    print('')
+    if errors:
+        raise errors[0]
+    missing = [(start + done, end) for start, end, done in progress['chunks'] if start + done <= end]
+    if missing:
+        raise IOError('Incomplete download of %s, missing ranges %s, run again to resume' % (url, missing))
+    os.replace(partial_path, filepath)
+    os.remove(progress_path)
+
+
+def _download_stream(url, filepath):
+    """Download over a single stream, for servers without range requests. Cannot be resumed."""
+    u = urllib.request.urlopen(url)
+    length = u.headers.get('Content-Length')
+    filesize = int(length) if length else None
     downloaded = 0
-    block_sz = 8192
-    status_width = 70
-    while True:
-        buf = u.read(block_sz)
-        if not buf:
-            print('')
-            break
+    with open(filepath + '.partial', 'wb') as f:
+        while True:
+            buf = u.read(64 * 1024)
+            if not buf:
+                print('')
+                break
+            downloaded += len(buf)
+            f.write(buf)
+            _print_status(os.path.basename(filepath), downloaded, filesize)
+    u.close()
+    os.replace(filepath + '.partial', filepath)
+
+
+def verify_checksum(filepath, checksum):
+    """Check a file against a checksum given as 'algorithm:hexdigest', e.g. 'sha256:9f86d0...' or 'md5:...'."""
+    algorithm, expected = checksum.split(':', 1)
+    digest = hashlib.new(algorithm)
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    if digest.hexdigest() != expected.lower():
+        raise IOError('Checksum mismatch for %s: %s %s, expected %s' % (filepath, algorithm, digest.hexdigest(), expected))
+
+
+def download(url, dirpath, checksum=None, workers=4):
+    """Download url into dirpath.
+
+    Servers that accept range requests are downloaded with parallel range requests and an interrupted download
+    resumes where it stopped. Other servers (e.g. python -m http.server) are downloaded over a single stream.
+    With a checksum the file is verified and removed when it does not match.
+    """
+    filename = url.split('/')[-1]
+    filepath = os.path.join(dirpath, filename)
+    if os.path.exists(filepath) and not os.path.exists(filepath + '.progress'):
+        print("Found %s - skip download" % filename)
+    else:
+        url, filesize, ranges = _probe(url)
+        print("Downloading: %s Bytes: %s" % (filename, filesize))
+        if ranges and filesize:
+            _download_ranges(url, filepath, filesize, max(workers, 1))
         else:
-            print('', end='\r')
-        downloaded += len(buf)
-        f.write(buf)
-        status = (("[%-" + str(status_width + 1) + "s] %3.2f%%") %
-                  ('=' * int(float(downloaded) / filesize * status_width) + '>', downloaded * 100. / filesize))
-        print(status, end='')
-        sys.stdout.flush()
-    f.close()
+            _download_stream(url, filepath)
+    if checksum:
+        try:
+            verify_checksum(filepath, checksum)
+        except IOError:
+            os.remove(filepath)
+            raise
     return filepath
 
 
@@ -59,47 +206,49 @@ def unzip(filepath):
     os.remove(filepath)
 
 
-def download_celeb_a(dirpath):
-    NUM_EXAMPLES = 202599
-    TRAIN_STOP = 162770
-    VALID_STOP = 182637
+def _celeb_a_split(index, train_stop=162770, valid_stop=182637):
+    if index < train_stop:
+        return 'train'
+    elif index < valid_stop:
+        return 'valid'
+    return 'test'
+
+
+def extract_split(filepath, target_dir, split_fn):
+    """Extract the files of a zip archive in one pass straight into target_dir/{split}, split_fn maps a member
+    file name to its split or None to skip it. Extraction goes into a temporary directory, renamed when complete.
+    """
+    partial_dir = target_dir + '.partial'
+    print("Extracting: " + filepath)
+    with zipfile.ZipFile(filepath) as zf:
+        for info in zf.infolist():
+            name = os.path.basename(info.filename)
+            split = split_fn(name) if name else None
+            if split is None:
+                continue
+            dest_dir = os.path.join(partial_dir, split)
+            if not os.path.exists(dest_dir):
+                os.makedirs(dest_dir)
+            with zf.open(info) as source, open(os.path.join(dest_dir, name), 'wb') as dest:
+                shutil.copyfileobj(source, dest)
+    os.rename(partial_dir, target_dir)
+
+
+def download_celeb_a(dirpath, workers=4):
     data_dir = 'celebA'
     if os.path.exists(os.path.join(dirpath, data_dir)):
         print('Found Celeb-A - skip')
         return
     url = 'https://www.dropbox.com/sh/8oqt9vytwxb3s4r/AADIKlz8PR9zr6Y20qbkunrba/Img/img_align_celeba.zip?dl=1&pv=1'
-    filepath = download(url, dirpath)
-    zip_dir = ''
-    with zipfile.ZipFile(filepath) as zf:
-        zip_dir = zf.namelist()[0]
-        zf.extractall(dirpath)
-    os.remove(filepath)
+    filepath = download(url, dirpath, CELEB_A_CHECKSUM, workers)
 
-    # now split data into train/valid/test
-    train_dir = os.path.join(dirpath, zip_dir, 'train')
-    valid_dir = os.path.join(dirpath, zip_dir, 'valid')
-    test_dir = os.path.join(dirpath, zip_dir, 'test')
-    if not os.path.exists(train_dir):
-        os.makedirs(train_dir)
-    if not os.path.exists(valid_dir):
-        os.makedirs(valid_dir)
-    if not os.path.exists(test_dir):
-        os.makedirs(test_dir)
-    zip_path = os.path.join(dirpath, zip_dir)
-    for i in range(NUM_EXAMPLES):
-        image_filename = "{:06d}.jpg".format(i + 1)
-        candidate_file = os.path.join(zip_path, image_filename)
-        if os.path.exists(candidate_file):
-            if i < TRAIN_STOP:
-                dest_dir = train_dir
-            elif i < VALID_STOP:
-                dest_dir = valid_dir
-            else:
-                dest_dir = test_dir
-            dest_file = os.path.join(dest_dir, image_filename)
-            os.rename(candidate_file, dest_file)
-
-    os.rename(os.path.join(dirpath, zip_dir), os.path.join(dirpath, data_dir))
+    # split data into train/valid/test by the number of the image, e.g. 000001.jpg
+    def split_fn(name):
+        stem = name.split('.')[0]
+        return _celeb_a_split(int(stem) - 1) if stem.isdigit() else None
+
+    extract_split(filepath, os.path.join(dirpath, data_dir), split_fn)
+    os.remove(filepath)
 
 
 def _list_categories(tag):
@@ -167,22 +316,149 @@ def prepare_data_dir(path='./data'):
         os.mkdir(path)
 
 
-def download_dataset(dataset_names):
+def download_dataset(dataset_names, workers=4):
     prepare_data_dir()
     if 'celebA' in dataset_names:
-        download_celeb_a('./data')
+        download_celeb_a('./data', workers)
     if 'lsun' in dataset_names:
         download_lsun('./data')
     if 'mnist' in dataset_names:
         download_mnist('./data')
 
 
+class _RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Static files with single byte range requests, a local stand-in for the dataset servers."""
+    ranges = []
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return self.send_error(404)
+        with open(path, 'rb') as f:
+            data = f.read()
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+            self.ranges.append((start, end))
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _PlainRequestHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the range probe closes a plain server's full response early
+        pass
+
+
+def _serve(handler, directory):
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/' % server.server_address[1]
+
+
+def check_download(workers=4):
+    """Download a random archive from local servers: parallel ranges, resume from .progress, checksum mismatch,
+    fallback to one stream without range support, and split extraction."""
+    root = tempfile.mkdtemp()
+    served_dir = os.path.join(root, 'served')
+    target_dir = os.path.join(root, 'downloads')
+    os.makedirs(served_dir)
+    os.makedirs(target_dir)
+    data = os.urandom(3 * 1024 * 1024 + 123)
+    with open(os.path.join(served_dir, 'archive.bin'), 'wb') as f:
+        f.write(data)
+    checksum = 'md5:' + hashlib.md5(data).hexdigest()
+    filepath = os.path.join(target_dir, 'archive.bin')
+
+    def downloaded():
+        with open(filepath, 'rb') as f:
+            return f.read()
+
+    range_server, range_url = _serve(_RangeRequestHandler, served_dir)
+    plain_server, plain_url = _serve(_PlainRequestHandler, served_dir)
+    try:
+        del _RangeRequestHandler.ranges[:]
+        download(range_url + 'archive.bin', target_dir, checksum, workers)
+        assert downloaded() == data
+        chunks = [r for r in _RangeRequestHandler.ranges if r != (0, 0)]
+        assert len(chunks) == workers, chunks
+        print("parallel range download: %d ranges, ok" % len(chunks))
+
+        # an interrupted download with the first chunk done and half of the second
+        os.remove(filepath)
+        progress, _ = _load_progress('', range_url + 'archive.bin', len(data), workers)
+        progress['chunks'][0][2] = progress['chunks'][0][1] - progress['chunks'][0][0] + 1
+        progress['chunks'][1][2] = (progress['chunks'][1][1] - progress['chunks'][1][0] + 1) // 2
+        done = progress['chunks'][0][2] + progress['chunks'][1][2]
+        with open(filepath + '.partial', 'wb') as f:
+            f.write(data[:progress['chunks'][1][0] + progress['chunks'][1][2]])
+            f.truncate(len(data))
+        _save_progress(filepath + '.progress', progress)
+        del _RangeRequestHandler.ranges[:]
+        download(range_url + 'archive.bin', target_dir, checksum, workers)
+        assert downloaded() == data and not os.path.exists(filepath + '.progress')
+        requested = sum(end - start + 1 for start, end in _RangeRequestHandler.ranges if (start, end) != (0, 0))
+        assert requested == len(data) - done, (requested, len(data) - done)
+        print("resumed download: %d of %d bytes requested, ok" % (requested, len(data)))
+
+        os.remove(filepath)
+        try:
+            download(range_url + 'archive.bin', target_dir, 'md5:' + '0' * 32, workers)
+            raise AssertionError('checksum mismatch not detected')
+        except IOError:
+            assert not os.path.exists(filepath)
+        print("checksum mismatch: file removed, ok")
+
+        download(plain_url + 'archive.bin', target_dir, checksum, workers)
+        assert downloaded() == data
+        print("download without range support: ok")
+    finally:
+        range_server.shutdown()
+        plain_server.shutdown()
+
+    archive_path = os.path.join(root, 'images.zip')
+    with zipfile.ZipFile(archive_path, 'w') as zf:
+        for index in range(10):
+            zf.writestr('images/%06d.jpg' % (index + 1), os.urandom(100))
+        zf.writestr('images/README.txt', b'not an image')
+    split_fn = lambda name: _celeb_a_split(int(name.split('.')[0]) - 1, 6, 8) if name.split('.')[0].isdigit() else None
+    extract_split(archive_path, os.path.join(root, 'images'), split_fn)
+    counts = dict((split, len(os.listdir(os.path.join(root, 'images', split)))) for split in ['train', 'valid', 'test'])
+    assert counts == {'train': 6, 'valid': 2, 'test': 2}, counts
+    assert not os.path.exists(os.path.join(root, 'images.partial'))
+    print("split extraction %s: ok" % counts)
+    shutil.rmtree(root)
+
+
 if __name__ == '__main__':
     args = parser.parse_args()
 
+    if args.check:
+        check_download(args.workers)
+        sys.exit(0)
+
     if not args.datasets:
         raise Exception(" [!] You need to specify the name of datasets to download")
 
-    if not os.path.exists(os.path.join(FLAGS.data_dir, FLAGS.dataset)):
-        download_dataset(FLAGS.dataset)
-    download_dataset(args.datasets)
+    download_dataset(args.datasets, args.workers)
@@ -0,0 +1,80 @@
+"""
+Export the latest checkpoint for inference.
+
+python export.py writes a SavedModel with the export_outputs of model_fn to {export_dir}/{dataset}/{subset}/{timestamp}
+and next to it frozen_graph.pb: the same graph with the variables turned into constants, constant folded and stripped
+of everything the prediction does not need, and frozen_graph.json naming its input and output tensors.
+Both are loaded by predict.py.
+"""
+import json
+import os
+
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from config import FLAGS
+from model import checkpoint_input_stats, model_fn
+from utils import get_upscale_ratio
+
+INPUT_NAME = 'lr_images'
+# key of the prediction in the PredictOutput of model_fn
+OUTPUT_KEY = 'high_res_images'
+
+FROZEN_GRAPH = 'frozen_graph.pb'
+FROZEN_GRAPH_JSON = 'frozen_graph.json'
+
+FREEZE_TRANSFORMS = [
+    'strip_unused_nodes',
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'sort_by_execution_order'
+]
+
+
+def get_export_dir(config=FLAGS):
+    return os.path.join(config.export_dir, config.dataset, config.subset)
+
+
+def serving_input_receiver_fn():
+    lr_images = tf.placeholder(tf.float32, shape=(None, None, None, FLAGS.color_channels), name=INPUT_NAME)
+    return tf.estimator.export.ServingInputReceiver(lr_images, {INPUT_NAME: lr_images})
+
+
+def export_saved_model(config=FLAGS):
+    input_mean, input_std = checkpoint_input_stats(config.color_channels)
+    params = tf.contrib.training.HParams(learning_rate=config.learning_rate, pkeep_conv=1.0, device='CPU:0', ratio=get_upscale_ratio(config),
+                                         normalize_inputs=config.normalize_inputs, input_mean=input_mean, input_std=input_std)
+    estimator = tf.estimator.Estimator(model_fn=model_fn, params=params, config=tf.estimator.RunConfig(model_dir=config.checkpoint_dir))
+    saved_model_dir = estimator.export_savedmodel(get_export_dir(config), serving_input_receiver_fn)
+    return saved_model_dir.decode('utf-8') if isinstance(saved_model_dir, bytes) else saved_model_dir
+
+
+def _node_name(tensor_name):
+    return tensor_name.split(':')[0]
+
+
+def freeze_saved_model(saved_model_dir, color_channels):
+    """Write the frozen graph of the default serving signature of a SavedModel into its directory."""
+    with tf.Graph().as_default(), tf.Session() as session:
+        meta_graph = tf.saved_model.loader.load(session, [tf.saved_model.tag_constants.SERVING], saved_model_dir)
+        signature = meta_graph.signature_def[tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+        input_name = signature.inputs[INPUT_NAME].name
+        output_name = signature.outputs[OUTPUT_KEY].name
+        graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph_def, [_node_name(output_name)])
+    graph_def = TransformGraph(graph_def, [_node_name(input_name)], [_node_name(output_name)], FREEZE_TRANSFORMS)
+
+    path = os.path.join(saved_model_dir, FROZEN_GRAPH)
+    with tf.gfile.GFile(path, 'wb') as writer:
+        writer.write(graph_def.SerializeToString())
+    with open(os.path.join(saved_model_dir, FROZEN_GRAPH_JSON), 'w') as writer:
+        json.dump({'input': input_name, 'output': output_name, 'color_channels': color_channels}, writer, indent=2, sort_keys=True)
+    return path, len(graph_def.node)
+
+
+if __name__ == '__main__':
+    print("Start export of %s" % FLAGS.checkpoint_dir)
+    saved_model_dir = export_saved_model()
+    print("Saved model to %s" % saved_model_dir)
+    frozen_graph, nodes = freeze_saved_model(saved_model_dir, FLAGS.color_channels)
+    print("Saved frozen graph of %d nodes to %s" % (nodes, frozen_graph))
+    print("Finish export of %s" % FLAGS.checkpoint_dir)
@@ -0,0 +1,174 @@
+"""
+Training hooks recording throughput, input stalls and memory.
+
+Every every_n_steps steps ThroughputHook records steps/sec, images/sec, the fraction of the step spent waiting for
+the input pipeline and the resident memory of the process. The records are written as scalars to TensorBoard next
+to the loss summaries and appended to throughput.csv, a summary of the whole run is logged and saved to
+throughput.json when training ends.
+
+The input wait is measured on sampled steps, every trace_every_steps steps one step is run with a full trace and the
+time spent in IteratorGetNext is divided by the time of the traced step.
+
+EvaluationCountHook logs the number of images of an evaluation and fails an evaluation without any.
+"""
+import csv
+import logging
+import os
+import resource
+import time
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+from utils import save_json
+
+THROUGHPUT_CSV = 'throughput.csv'
+THROUGHPUT_JSON = 'throughput.json'
+
+FIELDS = ['step', 'time', 'steps_per_sec', 'images_per_sec', 'input_wait_fraction', 'rss_mb']
+
+
+def rss_mb():
+    """Resident memory of the process, the peak when the current value is not available."""
+    try:
+        with open('/proc/self/statm') as reader:
+            return int(reader.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024. / 1024.
+    except (IOError, OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def input_wait_seconds(run_metadata):
+    """Time spent in IteratorGetNext ops of a traced step."""
+    micros = 0
+    for device in run_metadata.step_stats.dev_stats:
+        for node in device.node_stats:
+            if node.node_name.split('/')[-1].startswith('IteratorGetNext'):
+                micros += node.all_end_rel_micros
+    return micros / 1e6
+
+
+class ThroughputHook(tf.train.SessionRunHook):
+
+    def __init__(self, batch_size, output_dir, every_n_steps=100, trace_every_steps=500):
+        """
+        :param batch_size: tensor with the number of examples of a step
+        :param output_dir: directory of the summaries, throughput.csv and throughput.json
+        :param every_n_steps: steps per record
+        :param trace_every_steps: steps between traced steps measuring the input wait, 0 disables tracing
+        """
+        self._batch_size = batch_size
+        self._output_dir = output_dir
+        self._every_n_steps = every_n_steps
+        self._trace_every_steps = trace_every_steps
+
+    def begin(self):
+        self._global_step = tf.train.get_global_step()
+        self._writer = tf.summary.FileWriterCache.get(self._output_dir)
+        self._steps = 0
+        self._interval_steps = 0
+        self._interval_images = 0
+        self._images = 0
+        self._waits = []
+        self._interval_wait = None
+        self._records = []
+        self._start_rss = rss_mb()
+        self._peak_rss = self._start_rss
+        self._trace = False
+
+        path = os.path.join(self._output_dir, THROUGHPUT_CSV)
+        write_header = not os.path.exists(path)
+        self._csv_file = open(path, 'a')
+        self._csv = csv.DictWriter(self._csv_file, FIELDS)
+        if write_header:
+            self._csv.writeheader()
+
+    def after_create_session(self, session, coord):
+        self._start = time.time()
+        self._interval_start = self._start
+
+    def before_run(self, run_context):
+        self._trace = self._trace_every_steps > 0 and self._steps % self._trace_every_steps == self._trace_every_steps - 1
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE) if self._trace else None
+        self._step_start = time.time()
+        return tf.train.SessionRunArgs({'batch_size': self._batch_size, 'step': self._global_step}, options=options)
+
+    def after_run(self, run_context, run_values):
+        step_time = time.time() - self._step_start
+        self._steps += 1
+        self._interval_steps += 1
+        self._interval_images += run_values.results['batch_size']
+        self._images += run_values.results['batch_size']
+        if self._trace:
+            self._interval_wait = min(1., input_wait_seconds(run_values.run_metadata) / max(step_time, 1e-9))
+            self._waits.append(self._interval_wait)
+        if self._interval_steps >= self._every_n_steps:
+            self._record(run_values.results['step'])
+
+    def _record(self, step):
+        now = time.time()
+        elapsed = max(now - self._interval_start, 1e-9)
+        rss = rss_mb()
+        self._peak_rss = max(self._peak_rss, rss)
+        record = OrderedDict([('step', int(step)), ('time', now), ('steps_per_sec', self._interval_steps / elapsed),
+                              ('images_per_sec', self._interval_images / elapsed), ('input_wait_fraction', self._interval_wait),
+                              ('rss_mb', rss)])
+        self._records.append(record)
+        self._csv.writerow(record)
+        self._csv_file.flush()
+
+        summary = tf.Summary()
+        summary.value.add(tag='throughput/steps_per_sec', simple_value=record['steps_per_sec'])
+        summary.value.add(tag='throughput/images_per_sec', simple_value=record['images_per_sec'])
+        if self._interval_wait is not None:
+            summary.value.add(tag='throughput/input_wait_fraction', simple_value=self._interval_wait)
+        summary.value.add(tag='memory/rss_mb', simple_value=rss)
+        self._writer.add_summary(summary, step)
+
+        self._interval_start = now
+        self._interval_steps = 0
+        self._interval_images = 0
+        self._interval_wait = None
+
+    def end(self, session):
+        elapsed = max(time.time() - self._start, 1e-9)
+        rss = rss_mb()
+        self._peak_rss = max(self._peak_rss, rss)
+        summary = OrderedDict([
+            ('steps', self._steps),
+            ('images', int(self._images)),
+            ('seconds', elapsed),
+            ('steps_per_sec', self._steps / elapsed),
+            ('images_per_sec', self._images / elapsed),
+            ('input_wait_fraction', float(np.mean(self._waits)) if self._waits else None),
+            ('traced_steps', len(self._waits)),
+            ('rss_mb_start', self._start_rss),
+            ('rss_mb_end', rss),
+            ('rss_mb_peak', self._peak_rss),
+            ('rss_mb_growth', rss - self._start_rss),
+            ('intervals', self._records)
+        ])
+        logging.info('Training: %d steps in %.1f sec, %.2f steps/sec, %.1f images/sec' % (self._steps, elapsed, summary['steps_per_sec'],
+                                                                                          summary['images_per_sec']))
+        if self._waits:
+            logging.info('Training: %.1f%% of the traced steps waiting for input' % (100 * summary['input_wait_fraction']))
+        logging.info('Training: resident memory %.0f MB at start, %.0f MB at end, %.0f MB peak' % (self._start_rss, rss, self._peak_rss))
+        self._writer.flush()
+        self._csv_file.close()
+        save_json(os.path.join(self._output_dir, THROUGHPUT_JSON), summary)
+
+
+class EvaluationCountHook(tf.train.SessionRunHook):
+    """Fails an evaluation that saw no images, its streaming means would report 0 for every metric."""
+
+    def __init__(self, images):
+        """
+        :param images: tensor with the number of images evaluated so far
+        """
+        self._images = images
+
+    def end(self, session):
+        images = int(session.run(self._images))
+        if not images:
+            raise ValueError('Evaluation ran on no images')
+        logging.info('Evaluation: %d images' % images)
@@ -0,0 +1,85 @@
+"""
+Load generator for server.py.
+
+    python loadgen.py image.jpg [image.jpg ...] [--url http://127.0.0.1:8080] [--concurrency 16] [--requests 500]
+
+Every client thread posts the images in turn and waits for the answer before sending the next request. Client side
+throughput and latency percentiles are reported together with the metrics of the server, so the effect of
+--max_batch_size and --max_delay_ms of the server can be compared at different concurrency levels.
+"""
+import argparse
+import json
+import threading
+import time
+from collections import Counter
+
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+PERCENTILES = [50, 90, 99]
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(round(percentile / 100. * (len(values) - 1))))]
+
+
+def run_load(url, bodies, concurrency, requests):
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def client():
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            start = time.time()
+            try:
+                response = urlopen(Request(url + '/predict', data=bodies[index % len(bodies)]))
+                response.read()
+                status = response.getcode()
+            except HTTPError as e:
+                status = e.code
+            except Exception:
+                status = 'error'
+            with lock:
+                statuses[status] += 1
+                latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send concurrent prediction requests to server.py')
+    parser.add_argument('images', nargs='+', help='images posted in turn')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of client threads')
+    parser.add_argument('--requests', type=int, default=500, help='total number of requests')
+    args = parser.parse_args()
+
+    bodies = []
+    for path in args.images:
+        with open(path, 'rb') as reader:
+            bodies.append(reader.read())
+
+    latencies, statuses, elapsed = run_load(args.url, bodies, args.concurrency, args.requests)
+    print("%d requests in %.2f sec, %.1f requests/sec, concurrency %d" % (len(latencies), elapsed, len(latencies) / elapsed, args.concurrency))
+    print("status: %s" % ', '.join('%s: %d' % (status, count) for status, count in sorted(statuses.items(), key=str)))
+    print("client latency ms: %s" % ', '.join('p%d %.1f' % (p, 1000 * _percentile(latencies, p)) for p in PERCENTILES))
+    print("server metrics:")
+    print(json.dumps(json.loads(urlopen(args.url + '/metrics').read().decode('utf-8')), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import logging
 import logging.config
 import os
 import pprint
+import time
 from logging.handlers import RotatingFileHandler
 
 import numpy as np
@@ -11,14 +12,13 @@ import yaml
 from tensorflow.contrib.learn.python.learn import learn_runner
 
 from config import FLAGS
-from model import model_fn, srcnn, tf_psnr, tf_ssim
-from utils import get_tfrecord_files, parse_function, save_config, save_image, save_output
-
-PREDICTION = 'prediction'
-
-LOW_RESOLUTION = 'low_resolution'
-
-HIGH_RESOLUTION = 'high_resolution'
+from model import INFERENCE_WORKLOAD, TRAIN_WORKLOAD, checkpoint_input_stats, get_devices, get_session_config, model_fn, srcnn, tf_image_metrics
+from output_writer import OutputWriter, parse_artifacts
+from profiling import get_profiler
+from quantize import import_quantized_graph
+from tiling import predict_tiled
+from utils import HR_NPY, LR_NPY, SubsetConfig, get_input_stats, get_npy_dir, get_parse_function, get_record_count, get_record_format, get_tfrecord_compression, get_tfrecord_files, \
+    get_upscale_ratio, has_min_variance, parse_function, sample_patches, save_config
 
 pp = pprint.PrettyPrinter()
 
@@ -60,20 +60,186 @@ def get_estimator(run_config=None, params=None):
     )
 
 
-def input_fn(filenames, epoch, shuffle, batch_size):
-    dataset = tf.data.TFRecordDataset(filenames)
-    dataset = dataset.map(parse_function)
-    dataset = dataset.repeat(epoch)
+def _batch_by_size(dataset, batch_size, bucket_boundaries):
+    """Batch images of variable size.
+
+    Without boundaries only images of exactly the same size are batched together. With boundaries the images
+    are grouped into size buckets and padded to the largest image of their batch. The share of padded pixels
+    is added to the summaries as padding_waste.
+    """
+    boundaries = tf.constant(bucket_boundaries, dtype=tf.int32)
+
+    def add_size(lr_image, hr_image, name):
+        return lr_image, hr_image, name, tf.shape(hr_image)[:2]
+
+    def key_func(lr_image, hr_image, name, size):
+        if not bucket_boundaries:
+            return tf.cast(size[0], tf.int64) * 1000000 + tf.cast(size[1], tf.int64)
+        buckets = tf.reduce_sum(tf.cast(tf.expand_dims(size, 1) > boundaries, tf.int64), axis=1)
+        return buckets[0] * (len(bucket_boundaries) + 1) + buckets[1]
+
+    def reduce_func(key, window):
+        return window.padded_batch(batch_size, window.output_shapes)
+
+    dataset = dataset.map(add_size)
+    return dataset.apply(tf.contrib.data.group_by_window(key_func, reduce_func, batch_size))
+
+
+def _element_bytes(params):
+    """Approximate size of one parsed float32 example, used to fit the shuffle buffer into its memory budget."""
+    if params.patch_size:
+        lr_size = params.patch_size
+    else:
+        lr_size = params.image_size // params.ratio
+    return (lr_size ** 2) * (1 + params.ratio ** 2) * params.color_channels * 4
+
+
+def _shuffle_buffer_size(params):
+    return max(1, params.shuffle_buffer_mb * 1024 * 1024 // _element_bytes(params))
+
+
+def _drop_small_batches(dataset, params):
+    """Every tower of model_fn needs at least one example, drop a last batch smaller than the number of towers."""
+    towers = len(get_devices(params.device))
+    if towers == 1:
+        return dataset
+    return dataset.filter(lambda features, labels, *rest: tf.shape(features)[0] >= towers)
+
+
+def input_fn(filenames, epoch, shuffle, batch_size, params):
+    """Training input pipeline.
+
+    Files are read and parsed in parallel, parsed records are optionally cached in memory or on disk and shuffled
+    in a buffer bounded by params.shuffle_buffer_mb, before repeat so that every epoch is a permutation of the data.
+    Batches are prefetched to overlap the input pipeline with the training step.
+    """
+    files = tf.data.Dataset.from_tensor_slices(filenames)
     if shuffle:
-        dataset = dataset.shuffle(buffer_size=10000)
+        files = files.shuffle(len(filenames))
+    dataset = files.apply(tf.contrib.data.parallel_interleave(
+        lambda filename: tf.data.TFRecordDataset(filename, compression_type=params.compression_type),
+        cycle_length=params.num_parallel_reads, sloppy=shuffle))
+    dataset = dataset.map(lambda proto: parse_function(proto, params.record_format), num_parallel_calls=params.num_parallel_calls)
+    if params.cache:
+        dataset = dataset.cache('' if params.cache == 'memory' else params.cache)
+    if shuffle and not params.patch_size:
+        dataset = dataset.shuffle(buffer_size=_shuffle_buffer_size(params))
+    dataset = dataset.repeat(epoch)
+    if params.patch_size:
+        # patches are sampled after repeat, so every epoch sees new positions
+        stride = params.patch_stride or params.patch_size
+        dataset = dataset.flat_map(lambda lr_image, hr_image, name: sample_patches(lr_image, hr_image, name, params.ratio, params.patch_size,
+                                                                                   stride, params.patches_per_image))
+        if params.patch_min_variance > 0:
+            dataset = dataset.filter(lambda lr_patch, hr_patch, name: has_min_variance(lr_patch, hr_patch, name, params.patch_min_variance))
+        if shuffle:
+            # patches of one image follow each other, mix them across images
+            dataset = dataset.shuffle(buffer_size=_shuffle_buffer_size(params))
+    if params.variable_size and not params.patch_size:
+        bucket_boundaries = [int(b) for b in params.bucket_boundaries.split(',') if b]
+        dataset = _batch_by_size(dataset, batch_size, bucket_boundaries)
+        dataset = _drop_small_batches(dataset, params)
+        dataset = dataset.prefetch(params.prefetch_batches)
+        iterator = dataset.make_one_shot_iterator()
+        features, labels, names, sizes = iterator.get_next()
+        padded_pixels = tf.cast(tf.size(labels[:, :, :, 0]), tf.float32)
+        image_pixels = tf.cast(tf.reduce_sum(tf.reduce_prod(sizes, axis=1)), tf.float32)
+        tf.summary.scalar('padding_waste', 1.0 - image_pixels / padded_pixels)
+        return features, labels
     dataset = dataset.batch(batch_size)
+    dataset = _drop_small_batches(dataset, params)
+    dataset = dataset.prefetch(params.prefetch_batches)
     iterator = dataset.make_one_shot_iterator()
     features, labels, names = iterator.get_next()
     return features, labels
 
 
-def get_input_fn(filenames, num_epochs=None, shuffle=False, batch_size=1):
-    return lambda: input_fn(filenames, num_epochs, shuffle, batch_size)
+def npy_input_fn(npy_dir, epoch, shuffle, batch_size, params):
+    """Training input from memory-mapped arrays exported by tfrecords.py --tfrecord_mode=export_npy.
+
+    Batches are drawn by random index from a fresh permutation every epoch, so no shuffle buffer is needed.
+    The indices of a batch are sorted and gathered straight from the page cache into the batch array.
+    """
+    lr_array = np.load(os.path.join(npy_dir, LR_NPY), mmap_mode='r')
+    hr_array = np.load(os.path.join(npy_dir, HR_NPY), mmap_mode='r')
+    count = lr_array.shape[0]
+    towers = len(get_devices(params.device))
+
+    def batch_indices():
+        iteration = 0
+        while epoch is None or iteration < epoch:
+            order = np.random.permutation(count) if shuffle else np.arange(count)
+            for start in range(0, count, batch_size):
+                # every tower needs at least one example
+                if min(batch_size, count - start) >= towers:
+                    yield np.sort(order[start:start + batch_size])
+            iteration += 1
+
+    def gather(indices):
+        return lr_array[indices], hr_array[indices]
+
+    def load_batch(indices):
+        lr_images, hr_images = tf.py_func(gather, [indices], [tf.uint8, tf.uint8], stateful=False)
+        lr_images.set_shape((None,) + lr_array.shape[1:])
+        hr_images.set_shape((None,) + hr_array.shape[1:])
+        return tf.cast(lr_images, tf.float32) / 255., tf.cast(hr_images, tf.float32) / 255.
+
+    dataset = tf.data.Dataset.from_generator(batch_indices, tf.int64, tf.TensorShape([None]))
+    dataset = dataset.map(load_batch, num_parallel_calls=params.num_parallel_calls)
+    dataset = dataset.prefetch(params.prefetch_batches)
+    iterator = dataset.make_one_shot_iterator()
+    features, labels = iterator.get_next()
+    return features, labels
+
+
+def load_validation_set(config=FLAGS):
+    """Decode every record of the validation subset once, all evaluations read the same arrays."""
+    validation_config = SubsetConfig(config, config.validation_subset)
+    graph = tf.Graph()
+    with graph.as_default():
+        dataset = tf.data.TFRecordDataset(get_tfrecord_files(validation_config), compression_type=get_tfrecord_compression(validation_config))
+        dataset = dataset.map(get_parse_function(validation_config), num_parallel_calls=config.num_parallel_calls)
+        next_element = dataset.make_one_shot_iterator().get_next()
+    lr_images = []
+    hr_images = []
+    with tf.Session(graph=graph) as session:
+        while True:
+            try:
+                lr_image, hr_image, name = session.run(next_element)
+            except tf.errors.OutOfRangeError:
+                break
+            lr_images.append(lr_image)
+            hr_images.append(hr_image)
+    logging.info('Validation subset %s: %d images, %.1f MB' % (config.validation_subset, len(lr_images),
+                                                               sum(i.nbytes for i in lr_images + hr_images) / 1024 / 1024))
+    return lr_images, hr_images
+
+
+def validation_input_fn(validation_set, params):
+    """Evaluation input from the decoded validation subset, every image once per evaluation and no shuffling."""
+    lr_images, hr_images = validation_set
+    if params.variable_size:
+        shapes = (tf.TensorShape([None, None, params.color_channels]), tf.TensorShape([None, None, params.color_channels]))
+    else:
+        shapes = (tf.TensorShape(lr_images[0].shape), tf.TensorShape(hr_images[0].shape))
+
+    def images():
+        for lr_image, hr_image in zip(lr_images, hr_images):
+            yield lr_image, hr_image
+
+    dataset = tf.data.Dataset.from_generator(images, (tf.float32, tf.float32), shapes)
+    # images of different sizes cannot share a batch
+    dataset = dataset.batch(1 if params.variable_size else params.batch_size)
+    dataset = dataset.prefetch(params.prefetch_batches)
+    iterator = dataset.make_one_shot_iterator()
+    features, labels = iterator.get_next()
+    return features, labels
+
+
+def get_input_fn(filenames, params, num_epochs=None, shuffle=False, batch_size=1):
+    if params.data_backend == 'npy':
+        return lambda: npy_input_fn(params.npy_path, num_epochs, shuffle, batch_size, params)
+    return lambda: input_fn(filenames, num_epochs, shuffle, batch_size, params)
 
 
 def experiment_fn(run_config, params):
@@ -88,13 +254,18 @@ def experiment_fn(run_config, params):
     run_config = run_config.replace(save_checkpoints_steps=params.min_eval_frequency)
     estimator = get_estimator(run_config, params)
     # # Setup data loaders
-    train_input_fn = get_input_fn(params.train_files, params.epoch, True, params.batch_size)
+    train_input_fn = get_input_fn(params.train_files, params, params.epoch, True, params.batch_size)
+    if params.validation_subset:
+        validation_set = load_validation_set()
+        eval_input_fn = lambda: validation_input_fn(validation_set, params)
+    else:
+        eval_input_fn = train_input_fn
 
     # Define the experiment
     experiment = tf.contrib.learn.Experiment(
         estimator=estimator,  # Estimator
         train_input_fn=train_input_fn,  # First-class function
-        eval_input_fn=train_input_fn,  # First-class function
+        eval_input_fn=eval_input_fn,  # First-class function
         train_steps=params.train_steps,  # Minibatch steps
         min_eval_frequency=params.min_eval_frequency,  # Eval frequency
         # train_monitors=[train_input_hook],  # Hooks for training
@@ -104,33 +275,90 @@ def experiment_fn(run_config, params):
     return experiment
 
 
-def run_training(session, config=FLAGS):
-    save_config(config.summaries_dir, config)
-
-    train_files = get_tfrecord_files(config)
-    batch_number = len(train_files) // config.batch_size
-    logging.info('Total number of batches  %d' % batch_number)
-
-    params = tf.contrib.training.HParams(
+def get_params(config=FLAGS):
+    """Hyperparameters of the model and the training input pipeline."""
+    input_mean, input_std = get_input_stats(config) if config.normalize_inputs else checkpoint_input_stats(config.color_channels)
+    return tf.contrib.training.HParams(
         learning_rate=config.learning_rate,
         pkeep_conv=0.75,
+        histogram_loss_weight=config.histogram_loss_weight,
+        normalize_inputs=config.normalize_inputs,
+        input_mean=input_mean,
+        input_std=input_std,
         device=config.device,
         epoch=config.epoch,
         batch_size=config.batch_size,
-        min_eval_frequency=500,
+        min_eval_frequency=config.eval_frequency,
         train_steps=None,  # Use train feeder until its empty
-        eval_steps=1,  # Use 1 step of evaluation feeder
-        train_files=train_files
+        eval_steps=None if config.validation_subset else 1,  # Evaluate the whole validation subset
+        validation_subset=config.validation_subset,
+        train_files=get_tfrecord_files(config),
+        compression_type=get_tfrecord_compression(config),
+        record_format=get_record_format(config),
+        image_size=config.image_size,
+        color_channels=config.color_channels,
+        ratio=get_upscale_ratio(config),
+        variable_size=config.variable_size,
+        bucket_boundaries=config.bucket_boundaries,
+        patch_size=config.patch_size,
+        patches_per_image=config.patches_per_image,
+        patch_stride=config.patch_stride,
+        patch_min_variance=config.patch_min_variance,
+        num_parallel_reads=config.num_parallel_reads,
+        num_parallel_calls=config.num_parallel_calls,
+        cache=config.cache,
+        shuffle_buffer_mb=config.shuffle_buffer_mb,
+        prefetch_batches=config.prefetch_batches,
+        data_backend=config.data_backend,
+        npy_path=get_npy_dir(config)
     )
-    run_config = tf.contrib.learn.RunConfig(model_dir=config.checkpoint_dir)
+
+
+def run_training(session, config=FLAGS):
+    save_config(config.summaries_dir, config)
+
+    assert config.data_backend == 'tfrecord' or not (config.patch_size or config.variable_size), \
+        'Patches and variable size images need the tfrecord backend'
+    examples_per_record = config.patches_per_image if config.patch_size else 1
+    batch_number = get_record_count(config) * examples_per_record // config.batch_size
+    logging.info('Total number of batches  %d' % batch_number)
+
+    params = get_params(config)
+    run_config = tf.contrib.learn.RunConfig(model_dir=config.checkpoint_dir, session_config=get_session_config(params.device, TRAIN_WORKLOAD, config))
     learn_runner.run(
         experiment_fn=experiment_fn,  # First-class function
         run_config=run_config,  # RunConfig
-        schedule="train",  # What to run
+        schedule="train_and_evaluate" if config.validation_subset else "train",  # What to run
         hparams=params  # HParams
     )
 
 
+def benchmark_input(session, config=FLAGS):
+    """Drain the training input pipeline alone and report examples/sec and bytes/sec of the decoded batches.
+    If the pipeline is not clearly faster than the training steps, training is input bound.
+    """
+    params = get_params(config)
+    features, labels = get_input_fn(params.train_files, params, 1, True, params.batch_size)()
+    examples = 0
+    batches = 0
+    decoded_bytes = 0
+    start = time.time()
+    while not config.benchmark_steps or batches < config.benchmark_steps:
+        try:
+            lr_images, hr_images = session.run([features, labels])
+        except tf.errors.OutOfRangeError:
+            break
+        if not batches:
+            # the first batch includes filling the shuffle buffer
+            logging.info('First batch after %.2f sec' % (time.time() - start))
+        batches += 1
+        examples += lr_images.shape[0]
+        decoded_bytes += lr_images.nbytes + hr_images.nbytes
+    elapsed = max(time.time() - start, 1e-9)
+    logging.info('Input pipeline: %d batches, %d examples in %.2f sec' % (batches, examples, elapsed))
+    logging.info('Input pipeline: %.1f examples/sec, %.1f MB/sec decoded' % (examples / elapsed, decoded_bytes / elapsed / 1024 / 1024))
+
+
 def load(session, checkpoint_dir):
     logging.info(" [*] Reading checkpoints...")
     ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
@@ -144,57 +372,129 @@ def load(session, checkpoint_dir):
         return False
 
 
+def _build_prediction(session, tf_lr_image, output_size, config=FLAGS):
+    """srcnn restored from the checkpoint, or the quantized inference graph exported by quantize.py."""
+    if config.quantized_graph:
+        logging.info('Predict with quantized graph %s' % config.quantized_graph)
+        return import_quantized_graph(config.quantized_graph, tf_lr_image)
+    input_stats = checkpoint_input_stats(config.color_channels) if config.normalize_inputs else None
+    tf_prediction = srcnn(tf_lr_image, output_size, ratio=get_upscale_ratio(config), input_stats=input_stats)
+    tf.initialize_all_variables().run()
+    load(session, config.checkpoint_dir)
+    return tf_prediction
+
+
 def run_testing(session, config=FLAGS):
+    """Predict the test subset in batches. The metrics of all images of a batch are computed as vectors in the graph,
+    so a single session.run yields the outputs and metrics of the whole batch.
+    """
     files = get_tfrecord_files(config)
     logging.info('Total number of files  %d' % len(files))
 
-    dataset = tf.data.TFRecordDataset(files, buffer_size=10000)
-    dataset = dataset.map(parse_function)
-    dataset = dataset.batch(1)
+    # images of different sizes cannot share a batch
+    batch_size = 1 if config.variable_size else config.test_batch_size
+    dataset = tf.data.TFRecordDataset(files, compression_type=get_tfrecord_compression(config), buffer_size=10000)
+    dataset = dataset.map(get_parse_function(config), num_parallel_calls=config.num_parallel_calls)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.prefetch(config.prefetch_batches)
     iterator = dataset.make_one_shot_iterator()
     tf_next_element = iterator.get_next()
 
-    (tf_lr_image, tf_hr_image_tensor, _) = tf_next_element
-    tf_re_image = tf.image.resize_images(tf_lr_image, [FLAGS.image_size, FLAGS.image_size])
-    tf_initial_mse = tf.losses.mean_squared_error(tf_hr_image_tensor, tf_re_image)
-    tf_initial_rmse = tf.sqrt(tf_initial_mse)
-    tf_initial_psnr = tf_psnr(tf_initial_mse)
-    tf_initial_ssim = tf_ssim(tf_hr_image_tensor, tf_re_image)
+    (tf_lr_image, tf_hr_image_tensor, tf_name) = tf_next_element
+    tf_re_image = tf.image.resize_images(tf_lr_image, tf.shape(tf_hr_image_tensor)[1:3])
+    tf_initial_params = tf_image_metrics(tf_hr_image_tensor, tf_re_image)
 
-    tf_prediction = srcnn(tf_lr_image, FLAGS.image_size)
-    tf.initialize_all_variables().run()
+    tf_prediction = _build_prediction(session, tf_lr_image, FLAGS.image_size, config)
+    tf_predicted_params = tf_image_metrics(tf_hr_image_tensor, tf_prediction)
 
-    predicted_mse = tf.losses.mean_squared_error(tf_hr_image_tensor, tf_prediction)
-    predicted_rmse = tf.sqrt(predicted_mse)
-    predicted_psnr = tf_psnr(predicted_mse)
-    predicted_ssim = tf_ssim(tf_hr_image_tensor, tf_prediction)
+    params_file = open('metrics.csv', 'w+')
+    writer = csv.writer(params_file)
+    writer.writerows([['filename', 'initial_rmse', 'rmse', 'initial_psnr', 'psnr', 'initial_ssim', 'ssim']])
+    output_writer = _get_output_writer(config)
+
+    profiler = get_profiler(os.path.join(config.output_dir, 'profile'), config)
+    count = 0
+    batch = 0
+    start = time.time()
+    while True:
+        options, run_metadata = profiler.run_options(batch) if profiler else (None, None)
+        try:
+            hr_images, names, re_images, predictions, initial_params, predicted_params = session.run(
+                [tf_hr_image_tensor, tf_name, tf_re_image, tf_prediction, tf_initial_params, tf_predicted_params],
+                options=options, run_metadata=run_metadata)
+        except tf.errors.OutOfRangeError as e:
+            logging.error(e)
+            break
+        if profiler:
+            profiler.collect(batch, run_metadata)
+        batch += 1
+        for i in range(len(names)):
+            name = str(names[i]).replace('b\'', '').replace('\'', '')
+            _save_results(writer, output_writer, name, re_images[i], predictions[i], hr_images[i], [p[i] for p in initial_params],
+                          [p[i] for p in predicted_params])
+        count += len(names)
+    logging.info('%d images in %.2f sec, %.2f images/sec' % (count, time.time() - start, count / max(time.time() - start, 1e-9)))
+    if profiler:
+        profiler.report()
+
+    output_writer.close()
+    params_file.close()
+
+
+def _get_output_writer(config=FLAGS):
+    return OutputWriter(config.output_dir, parse_artifacts(config.outputs), config.output_workers)
+
+
+def _save_results(writer, output_writer, name, re_image, prediction, hr_image, initial_params, predicted_params):
+    (initial_rmse, initial_psnr, initial_ssim) = initial_params
+    (rmse, psnr, ssim) = predicted_params
+    prediction = np.squeeze(prediction)
+    logging.info('Enhance resolution for %s' % name)
+    writer.writerows([[name, initial_rmse, rmse, initial_psnr, psnr, initial_ssim, ssim]])
+    output_writer.submit(name, re_image, prediction, hr_image)
 
-    load(session, config.checkpoint_dir)
+
+def run_tiled_testing(session, config=FLAGS):
+    """Testing for images too large for one srcnn pass. The prediction is computed tile by tile, see tiling.py,
+    the metrics and outputs are the same as in run_testing.
+    """
+    files = get_tfrecord_files(config)
+    logging.info('Total number of files  %d' % len(files))
+
+    dataset = tf.data.TFRecordDataset(files, compression_type=get_tfrecord_compression(config), buffer_size=10000)
+    dataset = dataset.map(get_parse_function(config))
+    dataset = dataset.batch(1)
+    iterator = dataset.make_one_shot_iterator()
+    (tf_lr_image, tf_hr_image_tensor, tf_name) = iterator.get_next()
+    tf_re_image = tf.image.resize_images(tf_lr_image, tf.shape(tf_hr_image_tensor)[1:3])
+
+    ratio = get_upscale_ratio(config)
+    tf_lr_input = tf.placeholder(tf.float32, shape=(None, None, None, config.color_channels), name='lr_input')
+    tf_prediction = _build_prediction(session, tf_lr_input, None, config)
+
+    tf_hr_input = tf.placeholder(tf.float32, shape=(1, None, None, config.color_channels), name='hr_input')
+    tf_image_input = tf.placeholder(tf.float32, shape=(1, None, None, config.color_channels), name='image_input')
+    tf_params = tf_image_metrics(tf_hr_input, tf_image_input)
 
     params_file = open('metrics.csv', 'w+')
     writer = csv.writer(params_file)
     writer.writerows([['filename', 'initial_rmse', 'rmse', 'initial_psnr', 'psnr', 'initial_ssim', 'ssim']])
+    output_writer = _get_output_writer(config)
 
     while True:
         try:
-            tf_initial_params = [tf_initial_rmse, tf_initial_psnr, tf_initial_ssim]
-            tf_predicted_params = [predicted_rmse, predicted_psnr, predicted_ssim]
-            next_element, re_image, prediction, initial_params, predicted_params = session.run([tf_next_element, tf_re_image, tf_prediction, tf_initial_params, tf_predicted_params])
-            (lr_image, hr_image, name) = next_element
-            (initial_rmse, initial_psnr, initial_ssim) = initial_params
-            (rmse, psnr, ssim) = predicted_params
-            prediction = np.squeeze(prediction)
-            name = str(name[0]).replace('b\'', '').replace('\'', '')
-            logging.info('Enhance resolution for %s' % name)
-            writer.writerows([[name, initial_rmse, rmse, initial_psnr, psnr, initial_ssim, ssim]])
-            save_image(image=prediction, path=os.path.join(config.output_dir, PREDICTION, '%s.jpg' % name))
-            save_image(image=re_image, path=os.path.join(config.output_dir, LOW_RESOLUTION, '%s.jpg' % name))
-            save_image(image=hr_image, path=os.path.join(config.output_dir, HIGH_RESOLUTION, '%s.jpg' % name))
-            save_output(lr_img=re_image, prediction=prediction, hr_img=hr_image, path=os.path.join(config.output_dir, '%s.jpg' % name))
+            lr_image, hr_image, name, re_image = session.run([tf_lr_image, tf_hr_image_tensor, tf_name, tf_re_image])
         except tf.errors.OutOfRangeError as e:
             logging.error(e)
             break
-
+        prediction = predict_tiled(session, tf_lr_input, tf_prediction, lr_image[0], ratio, config.tile_size, config.tile_batch, config.tile_overlap)
+        initial_params = session.run(tf_params, feed_dict={tf_hr_input: hr_image, tf_image_input: re_image})
+        predicted_params = session.run(tf_params, feed_dict={tf_hr_input: hr_image, tf_image_input: prediction[np.newaxis]})
+        name = str(name[0]).replace('b\'', '').replace('\'', '')
+        _save_results(writer, output_writer, name, re_image[0], prediction, hr_image[0], [p[0] for p in initial_params],
+                      [p[0] for p in predicted_params])
+
+    output_writer.close()
     params_file.close()
 
 
@@ -205,19 +505,21 @@ def main(_):
     setup_logging()
 
     # start the session
-    with tf.Session(config=tf.ConfigProto(log_device_placement=True)) as sess:
-        if FLAGS.is_train:
+    workload = TRAIN_WORKLOAD if FLAGS.is_train else INFERENCE_WORKLOAD
+    with tf.Session(config=get_session_config(workload=workload, config=FLAGS)) as sess:
+        if FLAGS.benchmark_input:
+            benchmark_input(sess)
+        elif FLAGS.is_train:
             if not os.path.exists(FLAGS.checkpoint_dir):
                 os.makedirs(FLAGS.checkpoint_dir)
             if not os.path.exists(FLAGS.summaries_dir):
                 os.makedirs(FLAGS.summaries_dir)
             run_training(sess)
         else:
-            if not os.path.exists(FLAGS.output_dir):
-                os.makedirs(os.path.join(FLAGS.output_dir, PREDICTION))
-                os.makedirs(os.path.join(FLAGS.output_dir, LOW_RESOLUTION))
-                os.makedirs(os.path.join(FLAGS.output_dir, HIGH_RESOLUTION))
-            run_testing(sess)
+            if FLAGS.tile_size:
+                run_tiled_testing(sess)
+            else:
+                run_testing(sess)
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
+import os
 from math import ceil
 
 import numpy as np
@@ -5,42 +6,146 @@ import tensorflow as tf
 from tensorflow.python.estimator.model_fn import ModeKeys as Modes
 
 from config import FLAGS
+from hooks import EvaluationCountHook, ThroughputHook
+from profiling import ProfilerHook, get_profiler
 from subpixel import phase_shift
+from utils import load_thread_profile
 
 LOG_EVERY_STEPS = 10
 
 SUMMARY_EVERY_STEPS = 100
 
+# kernel sizes of the srcnn convolutions
+FILTERS_SHAPE = [2, 1, 3, 2, 1]
+
+
+VARIABLE_OPS = ('Variable', 'VariableV2', 'VarHandleOp')
+
+# workloads with thread pools of their own in a thread profile
+TRAIN_WORKLOAD = 'train'
+INFERENCE_WORKLOAD = 'inference'
+
+
+def get_devices(device):
+    """Devices of the towers from a comma separated list such as CPU:0,CPU:1."""
+    return [('/device:%s' % d) for d in device.split(',')]
+
+
+def get_thread_counts(workload, config):
+    """Intra and inter op thread counts of a workload, set by flags or tuned for this machine, 0 is the TensorFlow default."""
+    profile = load_thread_profile(config)
+    tuned = profile[workload] if profile else {}
+    intra = config.intra_op_threads or tuned.get('intra_op_threads', 0)
+    inter = config.inter_op_threads or tuned.get('inter_op_threads', 0)
+    return intra, inter
+
+
+def get_session_config(device='CPU:0', workload=TRAIN_WORKLOAD, config=None):
+    """Session configuration providing every CPU device the towers are placed on, e.g. CPU:0,CPU:1. With a config the
+    thread pools of the workload, train or inference, come from its flags or the tuned profile of this machine,
+    without one they are the TensorFlow defaults."""
+    specs = [tf.DeviceSpec.from_string(d) for d in get_devices(device)]
+    cpus = [spec.device_index or 0 for spec in specs if spec.device_type == 'CPU']
+    intra, inter = get_thread_counts(workload, config) if config is not None else (0, 0)
+    return tf.ConfigProto(device_count={'CPU': max(cpus) + 1 if cpus else 1}, allow_soft_placement=True,
+                          intra_op_parallelism_threads=intra, inter_op_parallelism_threads=inter)
+
+
+def _tower_device(device, variable_device):
+    """Device function placing the ops of a tower on device and the shared variables on variable_device."""
+    def _device_function(op):
+        node_def = op if isinstance(op, tf.NodeDef) else op.node_def
+        return variable_device if node_def.op in VARIABLE_OPS else device
+    return _device_function
+
+
+def _split_batch(tensor, count):
+    """Split a batch into count parts whose sizes differ by at most one."""
+    if count == 1:
+        return [tensor]
+    size = tf.shape(tensor)[0]
+    sizes = tf.stack([(size + count - 1 - i) // count for i in range(count)])
+    return tf.split(tensor, sizes, num=count)
+
+
+def _average_gradients(tower_gradients, weights):
+    """Weighted sum of the gradients of every variable over the towers, weights are the shares of the batch."""
+    averaged = []
+    for gradients_and_variables in zip(*tower_gradients):
+        variable = gradients_and_variables[0][1]
+        gradients = [weight * gradient for (gradient, _), weight in zip(gradients_and_variables, weights) if gradient is not None]
+        averaged.append((tf.add_n(gradients) if gradients else None, variable))
+    return averaged
+
+
+def _count_metric(values, name):
+    """Streaming number of values, a metric like tf.metrics.mean."""
+    with tf.variable_scope(name):
+        count = tf.get_variable('count', [], tf.float32, tf.zeros_initializer(), trainable=False,
+                                collections=[tf.GraphKeys.LOCAL_VARIABLES, tf.GraphKeys.METRIC_VARIABLES])
+    return tf.identity(count), tf.assign_add(count, tf.cast(tf.size(values), tf.float32))
+
 
 def model_fn(features, labels, mode, params):
+    """Data parallel srcnn. The batch is split across the towers listed in params.device, the towers share one set of
+    variables and their gradients are averaged into one train_op. Evaluation and prediction are forward only and run on
+    the first device, so batches smaller than the number of towers are evaluated as well."""
     learning_rate = params.learning_rate
-    devices = [('/device:%s' % d) for d in params.device.split(',')]
-    for d in devices:
-        with tf.device(d):
-            with tf.name_scope('inputs'):
-                lr_images = features
-                hr_images = labels
-                # Probability of keeping a node during dropout = 1.0 at test time (no dropout) and 0.75 at training time
-                pkeep_conv = tf.Variable(initial_value=params.pkeep_conv) if mode == Modes.TRAIN else tf.constant(params.pkeep_conv, dtype=tf.float32)
-
-            size = labels.get_shape().as_list()[1]
-            predictions = srcnn(lr_images, size, pkeep_conv, devices)
-
+    devices = get_devices(params.device)
+    if mode != Modes.TRAIN:
+        devices = devices[:1]
+    # a single device keeps its variables, several towers read them from the CPU
+    variable_device = devices[0] if len(devices) == 1 else '/device:CPU:0'
+    with tf.name_scope('inputs'):
+        lr_images = features
+        hr_images = labels
+        # Probability of keeping a node during dropout = 1.0 at test time (no dropout) and 0.75 at training time
+        pkeep_conv = tf.Variable(initial_value=params.pkeep_conv) if mode == Modes.TRAIN else tf.constant(params.pkeep_conv, dtype=tf.float32)
+        lr_towers = _split_batch(lr_images, len(devices))
+        hr_towers = _split_batch(hr_images, len(devices)) if hr_images is not None else [None] * len(devices)
+        batch_size = tf.cast(tf.shape(lr_images)[0], tf.float32)
+
+    size = labels.get_shape().as_list()[1] if labels is not None else None
+    if mode == Modes.TRAIN:
+        optimizer = tf.train.AdamOptimizer(learning_rate)
+    tower_predictions = []
+    tower_weights = []
+    tower_metrics = []
+    tower_gradients = []
+    for i, (device, lr_tower, hr_tower) in enumerate(zip(devices, lr_towers, hr_towers)):
+        with tf.device(_tower_device(device, variable_device)), tf.name_scope('tower_%d' % i):
+            predictions = srcnn(lr_tower, size, pkeep_conv, ratio=params.ratio, input_stats=_input_stats(params))
+            tower_predictions.append(predictions)
             if mode in (Modes.TRAIN, Modes.EVAL):
                 with tf.name_scope('losses'):
-                    mse = tf.losses.mean_squared_error(hr_images, predictions)
-                    rmse = tf.sqrt(mse)
-                    psnr = tf_psnr(mse)
-                    ssim = tf_ssim(hr_images, predictions)
-                    loss = 0.75 * rmse + 0.25 * (1 - ssim)
-                with tf.name_scope('train'):
-                    train_op = tf.train.AdamOptimizer(learning_rate).minimize(loss, tf.train.get_global_step())
-
+                    mse = tf.losses.mean_squared_error(hr_tower, predictions)
+                    ssim = tf_ssim(hr_tower, predictions)
+                    loss = 0.75 * tf.sqrt(mse) + 0.25 * (1 - ssim)
+                    histogram_loss = tf_histogram_loss(hr_tower, predictions) if params.histogram_loss_weight else tf.constant(0.)
+                    loss += params.histogram_loss_weight * histogram_loss
+                tower_weights.append(tf.cast(tf.shape(lr_tower)[0], tf.float32) / batch_size)
+                tower_metrics.append((mse, ssim, histogram_loss, loss))
+                if mode == Modes.TRAIN:
+                    tower_gradients.append(optimizer.compute_gradients(loss))
+
+    predictions = tf.concat(tower_predictions, 0) if len(tower_predictions) > 1 else tower_predictions[0]
     if mode in (Modes.TRAIN, Modes.EVAL):
+        with tf.name_scope('losses'):
+            mse, ssim, histogram_loss, loss = [tf.add_n([weight * metric for weight, metric in zip(tower_weights, metrics)]) for metrics in zip(*tower_metrics)]
+            rmse = tf.sqrt(mse)
+            psnr = tf_psnr(mse)
+        train_op = None
+        if mode == Modes.TRAIN:
+            with tf.name_scope('train'), tf.device(variable_device):
+                gradients = _average_gradients(tower_gradients, tower_weights)
+                train_op = optimizer.apply_gradients(gradients, tf.train.get_global_step())
+
         tf.summary.scalar('mse', mse)
         tf.summary.scalar('rmse', rmse)
         tf.summary.scalar('psnr', psnr)
         tf.summary.scalar('ssim', ssim)
+        if params.histogram_loss_weight:
+            tf.summary.scalar('histogram_loss', histogram_loss)
         tf.summary.scalar('loss', loss)
         # tf.summary.image('predictions', predictions, max_outputs=1)
 
@@ -49,16 +154,34 @@ def model_fn(features, labels, mode, params):
 
         logging_params = {'mse': mse, 'rmse': rmse, 'ssim': ssim, 'psnr': psnr, 'loss': loss, 'step': tf.train.get_global_step()}
         logging_hook = tf.train.LoggingTensorHook(logging_params, every_n_iter=LOG_EVERY_STEPS)
-
-        # eval_metric_ops = {
-        #     "rmse": tf.metrics.root_mean_squared_error(features, predictions)
-        # }
+        throughput_hook = ThroughputHook(tf.shape(features)[0], FLAGS.summaries_dir, FLAGS.throughput_every_steps, FLAGS.trace_every_steps)
+        training_hooks = [logging_hook, summary_hook, throughput_hook]
+        profiler = get_profiler(os.path.join(FLAGS.summaries_dir, 'profile'))
+        if profiler and mode == Modes.TRAIN:
+            training_hooks.append(ProfilerHook(profiler))
+
+        eval_metric_ops = None
+        evaluation_hooks = None
+        if mode == Modes.EVAL:
+            # streaming means over all evaluated images of the per-image metrics of run_testing
+            with tf.name_scope('metrics'):
+                image_rmse, image_psnr, image_ssim = tf_image_metrics(labels, predictions)
+                images = _count_metric(image_rmse, 'images')
+                eval_metric_ops = {
+                    'rmse': tf.metrics.mean(image_rmse),
+                    'psnr': tf.metrics.mean(image_psnr),
+                    'ssim': tf.metrics.mean(image_ssim),
+                    'images': images
+                }
+            evaluation_hooks = [EvaluationCountHook(images[0])]
         estimator_spec = tf.estimator.EstimatorSpec(
             mode=mode,
             loss=mse,
             predictions=predictions,
             train_op=train_op,
-            training_hooks=[logging_hook, summary_hook]
+            training_hooks=training_hooks,
+            eval_metric_ops=eval_metric_ops,
+            evaluation_hooks=evaluation_hooks
         )
     else:
         # mode == Modes.PREDICT:
@@ -73,42 +196,79 @@ def model_fn(features, labels, mode, params):
     return estimator_spec
 
 
-def srcnn(lr_images, output_size, pkeep_conv=1.0, devices=['/device:CPU:0']):
-    size = lr_images.get_shape().as_list()[1]
-    ratio = int(output_size / size)
+def _weight(name, shape):
+    return tf.get_variable(name, shape, initializer=tf.random_normal_initializer(stddev=1e-3))
+
+
+def _bias(name, size):
+    return tf.get_variable(name, [size], initializer=tf.zeros_initializer())
+
+
+def _standardize(lr_images, input_stats):
+    """Standardize the inputs per channel. The mean and std are variables, so the statistics of the training subset are
+    restored with the checkpoint and frozen into exported graphs."""
+    mean, std = input_stats
+    with tf.variable_scope('inputs', reuse=tf.AUTO_REUSE):
+        mean = tf.get_variable('mean', initializer=tf.constant(mean, dtype=tf.float32), trainable=False)
+        std = tf.get_variable('std', initializer=tf.constant(np.maximum(std, 1e-6), dtype=tf.float32), trainable=False)
+    return (lr_images - mean) / std
+
+
+def checkpoint_input_stats(channels):
+    """Initial input statistics of a graph that restores the statistics of training from its checkpoint."""
+    return [0.] * channels, [1.] * channels
+
+
+def _input_stats(params):
+    """(mean, std) srcnn standardizes its inputs with, None unless params.normalize_inputs."""
+    return (params.input_mean, params.input_std) if params.normalize_inputs else None
+
+
+def srcnn(lr_images, output_size, pkeep_conv=1.0, ratio=None, input_stats=None):
+    """srcnn in the current device scope. Variables are created by the first call and shared by later calls, e.g. by
+    the towers of model_fn. With input_stats, per-channel (mean, std), the inputs are standardized first."""
+    if input_stats is not None:
+        lr_images = _standardize(lr_images, input_stats)
+    if ratio is None:
+        # images of variable size need an explicit ratio, their size is unknown when the graph is built
+        size = lr_images.get_shape().as_list()[1]
+        ratio = int(output_size / size)
     output_channels = ratio*ratio if ratio > 1 else ratio
-    filters_shape = [2, 1, 3, 2, 1]
+    filters_shape = FILTERS_SHAPE
     filters = [64, 32, 16, 8, output_channels]
     channels = lr_images.get_shape().as_list()[3]
-    for d in devices:
-        with tf.device(d):
-            with tf.name_scope('weights'):
-                w1 = tf.Variable(tf.random_normal([filters_shape[0], filters_shape[0], channels, filters[0]], stddev=1e-3), name='cnn_w1')
-                w2 = tf.Variable(tf.random_normal([filters_shape[1], filters_shape[1], filters[0], filters[1]], stddev=1e-3), name='cnn_w2')
-                w3 = tf.Variable(tf.random_normal([filters_shape[2], filters_shape[2], filters[1], filters[2]], stddev=1e-3), name='cnn_w3')
-                w4 = tf.Variable(tf.random_normal([filters_shape[3], filters_shape[3], filters[2], filters[3]], stddev=1e-3), name='cnn_w4')
-                w5 = tf.Variable(tf.random_normal([filters_shape[4], filters_shape[4], filters[3], filters[4]], stddev=1e-3), name='cnn_w5')
-            with tf.name_scope('biases'):
-                b1 = tf.Variable(tf.zeros(filters[0]), name='cnn_b1')
-                b2 = tf.Variable(tf.zeros(filters[1]), name='cnn_b2')
-                b3 = tf.Variable(tf.zeros(filters[2]), name='cnn_b3')
-                b4 = tf.Variable(tf.zeros(filters[3]), name='cnn_b4')
-                b5 = tf.Variable(tf.zeros(filters[4]), name='cnn_b5')
-            with tf.name_scope('predictions'):
-                conv1 = tf.nn.bias_add(tf.nn.conv2d(lr_images, w1, strides=[1, 1, 1, 1], padding='SAME'), b1, name='conv_1')
-                conv1r = tf.nn.relu(conv1, name='relu_1')
-                conv2 = tf.nn.bias_add(tf.nn.conv2d(conv1r, w2, strides=[1, 1, 1, 1], padding='SAME'), b2, name='conv_2')
-                conv2r = tf.nn.relu(conv2, name='relu_2')
-                conv3 = tf.nn.bias_add(tf.nn.conv2d(conv2r, w3, strides=[1, 1, 1, 1], padding='SAME'), b3, name='conv_3')
-                conv3r = tf.nn.relu(conv3, name='relu_3')
-                conv4 = tf.nn.bias_add(tf.nn.conv2d(conv3r, w4, strides=[1, 1, 1, 1], padding='SAME'), b4, name='conv_4')
-                conv4r = tf.nn.relu(conv4, name='relu_4')
-                conv5 = tf.nn.bias_add(tf.nn.conv2d(conv4r, w5, strides=[1, 1, 1, 1], padding='SAME'), b5, name='conv_5')
-                upscaled = tf.tanh(phase_shift(conv5, ratio))
-                predictions = upscaled if ratio > 1 else conv5
+    with tf.variable_scope('weights', reuse=tf.AUTO_REUSE):
+        w1 = _weight('cnn_w1', [filters_shape[0], filters_shape[0], channels, filters[0]])
+        w2 = _weight('cnn_w2', [filters_shape[1], filters_shape[1], filters[0], filters[1]])
+        w3 = _weight('cnn_w3', [filters_shape[2], filters_shape[2], filters[1], filters[2]])
+        w4 = _weight('cnn_w4', [filters_shape[3], filters_shape[3], filters[2], filters[3]])
+        w5 = _weight('cnn_w5', [filters_shape[4], filters_shape[4], filters[3], filters[4]])
+    with tf.variable_scope('biases', reuse=tf.AUTO_REUSE):
+        b1 = _bias('cnn_b1', filters[0])
+        b2 = _bias('cnn_b2', filters[1])
+        b3 = _bias('cnn_b3', filters[2])
+        b4 = _bias('cnn_b4', filters[3])
+        b5 = _bias('cnn_b5', filters[4])
+    with tf.name_scope('predictions'):
+        conv1 = tf.nn.bias_add(tf.nn.conv2d(lr_images, w1, strides=[1, 1, 1, 1], padding='SAME'), b1, name='conv_1')
+        conv1r = tf.nn.relu(conv1, name='relu_1')
+        conv2 = tf.nn.bias_add(tf.nn.conv2d(conv1r, w2, strides=[1, 1, 1, 1], padding='SAME'), b2, name='conv_2')
+        conv2r = tf.nn.relu(conv2, name='relu_2')
+        conv3 = tf.nn.bias_add(tf.nn.conv2d(conv2r, w3, strides=[1, 1, 1, 1], padding='SAME'), b3, name='conv_3')
+        conv3r = tf.nn.relu(conv3, name='relu_3')
+        conv4 = tf.nn.bias_add(tf.nn.conv2d(conv3r, w4, strides=[1, 1, 1, 1], padding='SAME'), b4, name='conv_4')
+        conv4r = tf.nn.relu(conv4, name='relu_4')
+        conv5 = tf.nn.bias_add(tf.nn.conv2d(conv4r, w5, strides=[1, 1, 1, 1], padding='SAME'), b5, name='conv_5')
+        upscaled = tf.tanh(phase_shift(conv5, ratio))
+        predictions = upscaled if ratio > 1 else conv5
     return predictions
 
 
+def srcnn_margin():
+    """Number of low resolution pixels around an output pixel that srcnn reads, its receptive field radius."""
+    return sum(size - 1 for size in FILTERS_SHAPE)
+
+
 def _tf_fspecial_gauss(size, sigma):
     """Function to mimic the 'fspecial' gaussian MATLAB function
     :param size:
@@ -130,19 +290,71 @@ def _tf_fspecial_gauss(size, sigma):
     return g / tf.reduce_sum(g)
 
 
-def tf_ssim(img1, img2, cs_map=False, mean_metric=True, size=11, sigma=1.5):
+def _gauss_1d(size, sigma):
+    """Normalized 1-D gaussian, its outer product with itself is the window of _tf_fspecial_gauss."""
+    x = np.arange(-size // 2 + 1, size // 2 + 1, dtype=np.float64)
+    g = np.exp(-(x ** 2) / (2.0 * sigma ** 2))
+    return g / g.sum()
+
+
+def _tf_gauss_filter(images, size, sigma):
+    """Gaussian filter of every channel as a vertical and a horizontal 1-D depthwise convolution, 'VALID' padding."""
+    channels = images.get_shape().as_list()[3]
+    g = _gauss_1d(size, sigma).astype(np.float32)
+    rows = tf.constant(np.tile(g.reshape(size, 1, 1, 1), (1, 1, channels, 1)))
+    cols = tf.constant(np.tile(g.reshape(1, size, 1, 1), (1, 1, channels, 1)))
+    filtered = tf.nn.depthwise_conv2d(images, rows, strides=[1, 1, 1, 1], padding='VALID')
+    return tf.nn.depthwise_conv2d(filtered, cols, strides=[1, 1, 1, 1], padding='VALID')
+
+
+def tf_ssim(img1, img2, cs_map=False, mean_metric=True, size=11, sigma=1.5, per_image=False):
     """
     Compute structural similarity index metric.
     https://stackoverflow.com/questions/39051451/ssim-ms-ssim-for-tensorflow
 
+    The means and moments of both images are filtered together: img1, img2, img1^2, img2^2 and img1*img2 are stacked
+    along the channels and filtered by one separable gaussian, two 1-D depthwise convolutions.
+
     :param img1: an input image
     :param img2: an input image
     :param cs_map:
     :param mean_metric:
     :param size:
     :param sigma:
+    :param per_image: return the mean of every image of the batch, a vector of shape [batch]
     :return: ssim
     """
+    K1 = 0.01
+    K2 = 0.03
+    L = 1  # depth of image (255 in case the image has a differnt scale)
+    C1 = (K1 * L) ** 2
+    C2 = (K2 * L) ** 2
+    stacked = tf.concat([img1, img2, img1 * img1, img2 * img2, img1 * img2], axis=3)
+    mu1, mu2, img1_sq, img2_sq, img12 = tf.split(_tf_gauss_filter(stacked, size, sigma), 5, axis=3)
+    mu1_sq = mu1 * mu1
+    mu2_sq = mu2 * mu2
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = img1_sq - mu1_sq
+    sigma2_sq = img2_sq - mu2_sq
+    sigma12 = img12 - mu1_mu2
+    if cs_map:
+        value = (((2 * mu1_mu2 + C1) * (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) *
+                                                              (sigma1_sq + sigma2_sq + C2)),
+                 (2.0 * sigma12 + C2) / (sigma1_sq + sigma2_sq + C2))
+    else:
+        value = ((2 * mu1_mu2 + C1) * (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) *
+                                                             (sigma1_sq + sigma2_sq + C2))
+
+    if per_image or mean_metric:
+        axis = [1, 2, 3] if per_image else None
+        value = tuple(tf.reduce_mean(v, axis=axis) for v in value) if cs_map else tf.reduce_mean(value, axis=axis)
+    return value
+
+
+def tf_ssim_reference(img1, img2, cs_map=False, mean_metric=True, size=11, sigma=1.5):
+    """
+    Original tf_ssim with five 2-D convolutions of the full window, single channel images only. Reference for tf_ssim.
+    """
     window = _tf_fspecial_gauss(size, sigma)  # window shape [size, size]
     K1 = 0.01
     K2 = 0.03
@@ -170,7 +382,7 @@ def tf_ssim(img1, img2, cs_map=False, mean_metric=True, size=11, sigma=1.5):
     return value
 
 
-def tf_ms_ssim(img1, img2, mean_metric=True, level=5):
+def tf_ms_ssim(img1, img2, mean_metric=True, level=5, per_image=False):
     """
     Compute multi-scale structural similarity index metric.
     https://stackoverflow.com/questions/39051451/ssim-ms-ssim-for-tensorflow
@@ -179,15 +391,16 @@ def tf_ms_ssim(img1, img2, mean_metric=True, level=5):
     :param img2:
     :param mean_metric:
     :param level:
+    :param per_image: return the value of every image of the batch, a vector of shape [batch]
     :return: msssim
     """
     weight = tf.constant([0.0448, 0.2856, 0.3001, 0.2363, 0.1333], dtype=tf.float32)
     mssim = []
     mcs = []
     for l in range(level):
-        ssim_map, cs_map = tf_ssim(img1, img2, cs_map=True, mean_metric=False)
-        mssim.append(tf.reduce_mean(ssim_map))
-        mcs.append(tf.reduce_mean(cs_map))
+        ssim, cs = tf_ssim(img1, img2, cs_map=True, mean_metric=True, per_image=per_image)
+        mssim.append(ssim)
+        mcs.append(cs)
         filtered_im1 = tf.nn.avg_pool(img1, [1, 2, 2, 1], [1, 2, 2, 1], padding='SAME')
         filtered_im2 = tf.nn.avg_pool(img2, [1, 2, 2, 1], [1, 2, 2, 1], padding='SAME')
         img1 = filtered_im1
@@ -196,11 +409,13 @@ def tf_ms_ssim(img1, img2, mean_metric=True, level=5):
     # list to tensor of dim D+1
     mssim = tf.stack(mssim, axis=0)
     mcs = tf.stack(mcs, axis=0)
+    if per_image:
+        weight = tf.expand_dims(weight, 1)
 
-    value = (tf.reduce_prod(mcs[0:level - 1] ** weight[0:level - 1]) *
+    value = (tf.reduce_prod(mcs[0:level - 1] ** weight[0:level - 1], axis=0) *
              (mssim[level - 1] ** weight[level - 1]))
 
-    if mean_metric:
+    if mean_metric and not per_image:
         value = tf.reduce_mean(value)
     return value
 
@@ -221,12 +436,75 @@ def tf_psnr(mse):
     return -10. * tf.log(mse) / tf.log(10.)
 
 
+def tf_image_metrics(hr_images, images):
+    """
+    Per-image RMSE, PSNR and SSIM of a batch of images against the high resolution images.
+
+    :param hr_images: high resolution images [batch, height, width, channels]
+    :param images: images of the same shape
+    :return: rmse, psnr and ssim vectors of shape [batch]
+    """
+    mse = tf.reduce_mean(tf.squared_difference(hr_images, images), axis=[1, 2, 3])
+    ssim = tf_ssim(hr_images, images, per_image=True)
+    return tf.sqrt(mse), tf_psnr(mse), ssim
+
+
+# number of bins of the histogram loss
+HISTOGRAM_BINS = int(ceil(255 / 5))
+
+
+def _tf_bin_fractions(img, bins):
+    """Sum of the positions (img - base) / step of the pixels within every closed bin [base, base + step].
+
+    A pixel belongs to the bin of its histogram index, and to a neighbouring bin when it lies on their common
+    boundary. Membership is decided with the same float32 boundaries as the per-bin comparisons of
+    tf_histogram_loss_reference. The fractions of all pixels are summed per bin by one unsorted_segment_sum."""
+    step = 1.0 / bins
+    lower = tf.constant([i * step for i in range(bins)], dtype=tf.float32)
+    upper = tf.constant([i * step + step for i in range(bins)], dtype=tf.float32)
+    values = tf.reshape(img, [-1])
+    index = tf.clip_by_value(tf.cast(tf.floor(values * bins), tf.int32), 0, bins - 1)
+    fractions = []
+    indices = []
+    for offset in (-1, 0, 1):
+        candidate = index + offset
+        clipped = tf.clip_by_value(candidate, 0, bins - 1)
+        base = tf.gather(lower, clipped)
+        inside = tf.logical_and(tf.equal(candidate, clipped),
+                                tf.logical_and(values >= base, values <= tf.gather(upper, clipped)))
+        fractions.append(tf.where(inside, tf.div(values - base, step), tf.zeros_like(values)))
+        indices.append(clipped)
+    return tf.unsorted_segment_sum(tf.concat(fractions, 0), tf.concat(indices, 0), bins)
+
+
+def _tf_histogram_positions(img, bins):
+    hist = tf.cast(tf.histogram_fixed_width(values=img, value_range=[0.0, 1.0], nbins=bins, dtype=tf.int32), tf.float32)
+    return _tf_bin_fractions(img, bins) / tf.where(hist > 0, hist, tf.ones_like(hist))
+
+
 def tf_histogram_loss(img1, img2):
     """
     Calculate histogram loss between two images.
 
     https://pdfs.semanticscholar.org/ece3/b623232c90bb8a9021a3eb25223c4fde7069.pdf
 
+    Same value as tf_histogram_loss_reference, the bins are computed at once instead of one by one.
+
+    :param img1: an image normalized from 0 to 1
+    :param img2: an image normalized from 0 to 1
+    :return: MSE(hist_loss1, hist_loss2)
+    """
+    hist1_loss = _tf_histogram_positions(tf.cast(img1, dtype=tf.float32), HISTOGRAM_BINS)
+    hist2_loss = _tf_histogram_positions(tf.cast(img2, dtype=tf.float32), HISTOGRAM_BINS)
+    return tf.losses.mean_squared_error(hist1_loss, hist2_loss)
+
+
+def tf_histogram_loss_reference(img1, img2):
+    """
+    Original tf_histogram_loss with a loop over the bins. Reference for tf_histogram_loss.
+
+    https://pdfs.semanticscholar.org/ece3/b623232c90bb8a9021a3eb25223c4fde7069.pdf
+
     :param img1: an image normalized from 0 to 1
     :param img2: an image normalized from 0 to 1
     :return: MSE(hist_loss1, hist_loss2)
@@ -0,0 +1,107 @@
+"""
+Background writer for the images produced by testing.
+
+Post-processing, JPEG encoding and file writes run in a pool of threads while the next batch is predicted.
+The bounded queue blocks the inference loop when the writers fall behind, so memory stays bounded. Without worker
+threads the images are written in the inference loop.
+"""
+import logging
+import os
+import threading
+
+from six.moves import queue
+
+from utils import save_image, save_output
+
+PREDICTION = 'prediction'
+
+LOW_RESOLUTION = 'low_resolution'
+
+HIGH_RESOLUTION = 'high_resolution'
+
+# low resolution, prediction and high resolution side by side
+COMPOSITE = 'composite'
+
+ARTIFACTS = (PREDICTION, LOW_RESOLUTION, HIGH_RESOLUTION, COMPOSITE)
+
+
+def parse_artifacts(value):
+    artifacts = [artifact.strip() for artifact in value.split(',') if artifact.strip()]
+    for artifact in artifacts:
+        assert artifact in ARTIFACTS, 'Unknown output %s, expected one of %s' % (artifact, ', '.join(ARTIFACTS))
+    return artifacts
+
+
+class OutputWriter(object):
+    """Writes the selected artifacts of every submitted image in worker threads."""
+
+    def __init__(self, output_dir, artifacts=ARTIFACTS, workers=4, queue_size=32):
+        self.output_dir = output_dir
+        self.artifacts = list(artifacts)
+        self.errors = []
+        self.written = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        for artifact in self.artifacts:
+            path = self._artifact_dir(artifact)
+            if not os.path.exists(path):
+                os.makedirs(path)
+        self._threads = [threading.Thread(target=self._run) for _ in range(workers if self.artifacts else 0)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _artifact_dir(self, artifact):
+        # the composite images have always been written to the output directory itself
+        return self.output_dir if artifact == COMPOSITE else os.path.join(self.output_dir, artifact)
+
+    def _path(self, artifact, name):
+        return os.path.join(self._artifact_dir(artifact), '%s.jpg' % name)
+
+    def _write(self, name, re_image, prediction, hr_image):
+        for artifact in self.artifacts:
+            try:
+                if artifact == PREDICTION:
+                    save_image(image=prediction, path=self._path(artifact, name))
+                elif artifact == LOW_RESOLUTION:
+                    save_image(image=re_image, path=self._path(artifact, name))
+                elif artifact == HIGH_RESOLUTION:
+                    save_image(image=hr_image, path=self._path(artifact, name))
+                else:
+                    save_output(lr_img=re_image, prediction=prediction, hr_img=hr_image, path=self._path(artifact, name))
+            except Exception as e:
+                with self._lock:
+                    self.errors.append((name, artifact, e))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+                with self._lock:
+                    self.written += 1
+            finally:
+                self._queue.task_done()
+
+    def submit(self, name, re_image, prediction, hr_image):
+        """Queue the images of one test image, blocks while the queue is full. Without workers they are written right away."""
+        if not self.artifacts:
+            return
+        if not self._threads:
+            self._write(name, re_image, prediction, hr_image)
+            self.written += 1
+            return
+        self._queue.put((name, re_image, prediction, hr_image))
+
+    def close(self):
+        """Wait for all queued images, stop the workers and report the errors. Returns the number of errors."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        for name, artifact, error in self.errors:
+            logging.error('Failed to write %s of %s: %s' % (artifact, name, error))
+        logging.info('Wrote outputs of %d images, %d errors' % (self.written, len(self.errors)))
+        return len(self.errors)
@@ -0,0 +1,101 @@
+"""
+Standalone predictor for models exported by export.py.
+
+    python predict.py export/{dataset}/{subset}/{timestamp}/frozen_graph.pb image.jpg [image.jpg ...] [--output_dir DIR]
+
+The model is a frozen graph (with its .json next to it) or a SavedModel directory. Images are read, normalized like
+the low resolution images of the tfrecords and written upscaled to output_dir under their own names. Only
+numpy, Pillow and the core of TensorFlow are imported, no configuration flags or estimator code. Time to the
+first prediction is reported split into import, model loading and the first run.
+"""
+import time
+
+START = time.time()
+
+import argparse
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+IMPORTED = time.time()
+
+FROZEN_GRAPH_JSON = 'frozen_graph.json'
+SIGNATURE_INPUT = 'lr_images'
+SIGNATURE_OUTPUT = 'high_res_images'
+
+
+def _bytescale(image):
+    """Stretch intensities to 0..255 like scipy.misc.imresize and imsave do for float images."""
+    low, high = image.min(), image.max()
+    scale = 255. / (high - low) if high > low else 1.
+    return (((image - low) * scale).clip(0, 255) + 0.5).astype(np.uint8)
+
+
+def read_image(path, color_channels):
+    image = Image.open(path).convert('YCbCr' if color_channels == 3 else 'F')
+    image = _bytescale(np.asarray(image, dtype=np.float32)) / 255.
+    return image.reshape(image.shape[:2] + (color_channels,)).astype(np.float32)
+
+
+def write_image(image, path, image_format=None):
+    Image.fromarray(_bytescale(np.squeeze(image) * 255.)).save(path, image_format)
+
+
+class Predictor(object):
+    """Frozen graph or SavedModel in a session of its own."""
+
+    def __init__(self, model_path):
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph)
+        with self.graph.as_default():
+            if os.path.isdir(model_path):
+                meta_graph = tf.saved_model.loader.load(self.session, [tf.saved_model.tag_constants.SERVING], model_path)
+                signature = meta_graph.signature_def[tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+                self.input = self.graph.get_tensor_by_name(signature.inputs[SIGNATURE_INPUT].name)
+                self.output = self.graph.get_tensor_by_name(signature.outputs[SIGNATURE_OUTPUT].name)
+            else:
+                with open(os.path.join(os.path.dirname(model_path), FROZEN_GRAPH_JSON)) as reader:
+                    names = json.load(reader)
+                graph_def = tf.GraphDef()
+                with open(model_path, 'rb') as reader:
+                    graph_def.ParseFromString(reader.read())
+                self.input, self.output = tf.import_graph_def(graph_def, return_elements=[names['input'], names['output']], name='')
+        self.color_channels = self.input.get_shape().as_list()[-1]
+
+    def predict(self, lr_images):
+        """Upscale a batch of images of equal size [batch, height, width, channels]."""
+        return self.session.run(self.output, feed_dict={self.input: lr_images})
+
+    def close(self):
+        self.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upscale images with an exported srcnn model')
+    parser.add_argument('model', help='frozen_graph.pb or SavedModel directory written by export.py')
+    parser.add_argument('images', nargs='+', help='low resolution images')
+    parser.add_argument('--output_dir', default='predictions', help='directory of the upscaled images')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    predictor = Predictor(args.model)
+    loaded = time.time()
+    for i, path in enumerate(args.images):
+        prediction = predictor.predict(read_image(path, predictor.color_channels)[np.newaxis])[0]
+        write_image(prediction, os.path.join(args.output_dir, os.path.basename(path)))
+        if i == 0:
+            first = time.time()
+            print("Time to first prediction %.3f sec: import %.3f sec, load model %.3f sec, first image %.3f sec"
+                  % (first - START, IMPORTED - START, loaded - IMPORTED, first - loaded))
+    if len(args.images) > 1:
+        print("%d more images in %.3f sec" % (len(args.images) - 1, time.time() - first))
+    predictor.close()
+
+
+if __name__ == '__main__':
+    main()
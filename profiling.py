@@ -0,0 +1,155 @@
+"""
+Per-op profiling of a window of training or testing steps.
+
+With --profile the steps from --profile_start to --profile_start + --profile_steps are run with a full trace. Every
+traced step is saved as timeline-{step}.json in Chrome trace format with memory, open it in chrome://tracing. When the
+window is over the op timings and output memory of all traced steps are aggregated into report.txt: the top ops by
+time and by memory and the totals per name scope (weights, predictions, losses, train, gradients/... of the towers
+merged).
+"""
+import logging
+import os
+import re
+from collections import defaultdict
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+from config import FLAGS
+
+REPORT_TXT = 'report.txt'
+
+# name scope components of the towers of model_fn, merged in the report
+TOWER_SCOPE = re.compile(r'^tower_\d+$')
+
+
+def _op_type(node):
+    """Op type from the timeline label 'name = Type(inputs)' of a node."""
+    if ' = ' in node.timeline_label:
+        return node.timeline_label.split(' = ', 1)[1].split('(', 1)[0]
+    return node.node_name
+
+
+def _scope(name):
+    """Name scope of an op, the gradients are grouped by the scope they differentiate."""
+    parts = [p for p in name.split('/') if not TOWER_SCOPE.match(p)]
+    if len(parts) < 2:
+        return '(root)'
+    if parts[0] == 'gradients' and len(parts) > 2:
+        return 'gradients/' + parts[1]
+    return parts[0]
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.micros = 0
+        self.bytes = 0
+
+    def add(self, micros, allocated_bytes):
+        self.count += 1
+        self.micros += micros
+        self.bytes += allocated_bytes
+
+
+class Profiler(object):
+    """Traces a window of steps, writes their Chrome traces and aggregates an op report."""
+
+    def __init__(self, output_dir, start, steps, top=20):
+        self.output_dir = output_dir
+        self.start = start
+        self.steps = steps
+        self.top = top
+        self.ops = defaultdict(_Stats)
+        self.scopes = defaultdict(_Stats)
+        self.traced = 0
+        self.reported = False
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+    def traces(self, step):
+        return self.start <= step < self.start + self.steps
+
+    def run_options(self, step):
+        """RunOptions and RunMetadata of a step, (None, None) outside of the window."""
+        if not self.traces(step):
+            return None, None
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+    def collect(self, step, run_metadata):
+        if run_metadata is None:
+            return
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True)
+        with open(os.path.join(self.output_dir, 'timeline-%d.json' % step), 'w') as writer:
+            writer.write(trace)
+        for device in run_metadata.step_stats.dev_stats:
+            for node in device.node_stats:
+                allocated_bytes = sum(output.tensor_description.allocation_description.allocated_bytes for output in node.output)
+                self.ops[(node.node_name, _op_type(node))].add(node.all_end_rel_micros, allocated_bytes)
+                self.scopes[_scope(node.node_name)].add(node.all_end_rel_micros, allocated_bytes)
+        self.traced += 1
+        if step == self.start + self.steps - 1:
+            self.report()
+
+    def report(self):
+        """Write report.txt once, after the window or when the run ends within it."""
+        if self.reported or not self.traced:
+            return
+        self.reported = True
+        total_micros = max(sum(s.micros for s in self.scopes.values()), 1)
+        lines = ['%d traced steps, %.1f ms op time per step' % (self.traced, total_micros / 1000. / self.traced), '']
+
+        lines.append('Top %d ops by time' % self.top)
+        lines.append('%-60s %-22s %6s %12s %7s %14s' % ('op', 'type', 'runs', 'ms/step', '%', 'bytes/step'))
+        for (name, op_type), stats in sorted(self.ops.items(), key=lambda item: -item[1].micros)[:self.top]:
+            lines.append(self._format_op(name, op_type, stats, total_micros))
+        lines.append('')
+
+        lines.append('Top %d ops by memory' % self.top)
+        lines.append('%-60s %-22s %6s %12s %7s %14s' % ('op', 'type', 'runs', 'ms/step', '%', 'bytes/step'))
+        for (name, op_type), stats in sorted(self.ops.items(), key=lambda item: -item[1].bytes)[:self.top]:
+            lines.append(self._format_op(name, op_type, stats, total_micros))
+        lines.append('')
+
+        lines.append('Name scopes')
+        lines.append('%-30s %8s %12s %7s %14s' % ('scope', 'ops/step', 'ms/step', '%', 'bytes/step'))
+        for scope, stats in sorted(self.scopes.items(), key=lambda item: -item[1].micros):
+            lines.append('%-30s %8d %12.3f %7.2f %14d' % (scope, stats.count // self.traced, stats.micros / 1000. / self.traced,
+                                                           100. * stats.micros / total_micros, stats.bytes // self.traced))
+
+        path = os.path.join(self.output_dir, REPORT_TXT)
+        with open(path, 'w') as writer:
+            writer.write('\n'.join(lines) + '\n')
+        logging.info('Profile of %d steps saved to %s\n%s' % (self.traced, path, '\n'.join(lines)))
+
+    def _format_op(self, name, op_type, stats, total_micros):
+        return '%-60s %-22s %6d %12.3f %7.2f %14d' % (name[-60:], op_type[:22], stats.count, stats.micros / 1000. / self.traced,
+                                                       100. * stats.micros / total_micros, stats.bytes // self.traced)
+
+
+def get_profiler(output_dir, config=FLAGS):
+    """Profiler of the configured window, None when profiling is off."""
+    if not config.profile:
+        return None
+    return Profiler(output_dir, config.profile_start, config.profile_steps, config.profile_top)
+
+
+class ProfilerHook(tf.train.SessionRunHook):
+    """Profiles the training steps of the window of a Profiler, counted from the start of the run."""
+
+    def __init__(self, profiler):
+        self._profiler = profiler
+        self._step = 0
+
+    def before_run(self, run_context):
+        options, _ = self._profiler.run_options(self._step)
+        return tf.train.SessionRunArgs(None, options=options)
+
+    def after_run(self, run_context, run_values):
+        if self._profiler.traces(self._step):
+            self._profiler.collect(self._step, run_values.run_metadata)
+        self._step += 1
+
+    def end(self, session):
+        self._profiler.report()
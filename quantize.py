@@ -0,0 +1,234 @@
+"""
+Post-training quantization of srcnn for CPU inference.
+
+python quantize.py --quantize_mode=export --quantization=int8 converts the latest checkpoint into a frozen inference
+graph. With int8 the activations entering every convolution are quantized to 8 bits within ranges calibrated on
+--calibration_batches batches of the subset, the weights are stored as 8 bit constants and the convolutions run as
+QuantizedConv2D with 32 bit accumulation. With float16 the weights are stored as float16 and computed in float32.
+
+python quantize.py --quantize_mode=report compares the graph with the float model on the subset: mean rmse, psnr and
+ssim as written by run_testing and their deltas, latency per image, model size and bytes allocated per image.
+
+Testing runs the graph instead of the checkpoint with main.py --is_train=false --quantized_graph=path.
+"""
+import os
+import time
+from collections import OrderedDict
+from itertools import islice
+
+import numpy as np
+import tensorflow as tf
+
+from config import FLAGS
+from model import srcnn, tf_image_metrics
+from subpixel import phase_shift
+from utils import get_parse_function, get_tfrecord_compression, get_tfrecord_files, get_upscale_ratio, save_json
+
+INT8 = 'int8'
+FLOAT16 = 'float16'
+QUANTIZATIONS = [INT8, FLOAT16]
+
+INPUT_NAME = 'lr_images'
+OUTPUT_NAME = 'predictions'
+
+# number of srcnn convolutions, the inputs of the later ones are the relu outputs of the float model
+LAYERS = 5
+
+CALIBRATION_SHUFFLE_BUFFER = 1000
+
+
+def get_quantized_graph_path(config=FLAGS):
+    return config.quantized_graph or os.path.join(config.checkpoint_dir, 'srcnn_%s.pb' % config.quantization)
+
+
+def _checkpoint_path(checkpoint_dir):
+    ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise ValueError('No checkpoint in %s' % checkpoint_dir)
+    return os.path.join(checkpoint_dir, os.path.basename(ckpt.model_checkpoint_path))
+
+
+def _load_parameters(checkpoint):
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    weights = [reader.get_tensor('weights/cnn_w%d' % i) for i in range(1, LAYERS + 1)]
+    biases = [reader.get_tensor('biases/cnn_b%d' % i) for i in range(1, LAYERS + 1)]
+    return weights, biases
+
+
+def _batches(config, shuffle=False):
+    """Batches (lr_images, hr_images, names) of the subset as NumPy arrays, read in a graph of their own."""
+    batch_size = 1 if config.variable_size else config.test_batch_size
+    graph = tf.Graph()
+    with graph.as_default():
+        dataset = tf.data.TFRecordDataset(get_tfrecord_files(config), compression_type=get_tfrecord_compression(config))
+        if shuffle:
+            dataset = dataset.shuffle(CALIBRATION_SHUFFLE_BUFFER)
+        dataset = dataset.map(get_parse_function(config), num_parallel_calls=config.num_parallel_calls)
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.prefetch(config.prefetch_batches)
+        next_element = dataset.make_one_shot_iterator().get_next()
+    session = tf.Session(graph=graph)
+    try:
+        while True:
+            try:
+                yield session.run(next_element)
+            except tf.errors.OutOfRangeError:
+                return
+    finally:
+        session.close()
+
+
+def calibrate(checkpoint, config=FLAGS):
+    """Range of the input of every convolution over the calibration batches of the float model."""
+    with tf.Graph().as_default(), tf.Session() as session:
+        lr_input = tf.placeholder(tf.float32, shape=(None, None, None, config.color_channels))
+        srcnn(lr_input, None, ratio=get_upscale_ratio(config))
+        tf.train.Saver().restore(session, checkpoint)
+        graph = tf.get_default_graph()
+        activations = [lr_input] + [graph.get_tensor_by_name('predictions/relu_%d:0' % i) for i in range(1, LAYERS)]
+        ranges = [[0., 0.] for _ in activations]
+        for lr_images, _, _ in islice(_batches(config, shuffle=True), config.calibration_batches):
+            for layer_range, values in zip(ranges, session.run(activations, feed_dict={lr_input: lr_images})):
+                layer_range[0] = min(layer_range[0], float(values.min()))
+                layer_range[1] = max(layer_range[1], float(values.max()))
+    # the ranges include zero, quantization needs max > min
+    return [(low, max(high, low + 1e-6)) for low, high in ranges]
+
+
+def _quantize_weights(weights):
+    """8 bit weights with their ranges, quantized by QuantizeV2 so they match the quantized convolution."""
+    with tf.Graph().as_default(), tf.Session() as session:
+        return [session.run(tf.quantize_v2(w, float(w.min()), max(float(w.max()), float(w.min()) + 1e-6), tf.quint8, mode='MIN_FIRST'))
+                for w in weights]
+
+
+def _int8_conv(x, weight, bias, input_range):
+    quantized_weight, weight_min, weight_max = weight
+    quantized_x, x_min, x_max = tf.quantize_v2(x, input_range[0], input_range[1], tf.quint8, mode='MIN_FIRST')
+    conv, conv_min, conv_max = tf.nn.quantized_conv2d(quantized_x, tf.constant(quantized_weight, dtype=tf.quint8), x_min, x_max,
+                                                      weight_min, weight_max, strides=[1, 1, 1, 1], padding='SAME')
+    return tf.nn.bias_add(tf.dequantize(conv, conv_min, conv_max, mode='MIN_FIRST'), bias)
+
+
+def _float16_conv(x, weight, bias):
+    weight = tf.cast(tf.constant(weight.astype(np.float16)), tf.float32)
+    return tf.nn.bias_add(tf.nn.conv2d(x, weight, strides=[1, 1, 1, 1], padding='SAME'), bias)
+
+
+def build_quantized_graph(weights, biases, ranges, quantization, ratio, channels):
+    """Frozen srcnn inference graph from INPUT_NAME to OUTPUT_NAME with quantized convolutions."""
+    if quantization == INT8:
+        weights = _quantize_weights(weights)
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, shape=(None, None, None, channels), name=INPUT_NAME)
+        for layer, (weight, bias) in enumerate(zip(weights, biases)):
+            with tf.name_scope('conv_%d' % (layer + 1)):
+                if quantization == INT8:
+                    x = _int8_conv(x, weight, bias, ranges[layer])
+                else:
+                    x = _float16_conv(x, weight, bias)
+                if layer < LAYERS - 1:
+                    x = tf.nn.relu(x)
+        predictions = tf.tanh(phase_shift(x, ratio)) if ratio > 1 else x
+        tf.identity(predictions, name=OUTPUT_NAME)
+    return graph.as_graph_def()
+
+
+def import_quantized_graph(path, lr_images):
+    """Predictions of the quantized graph at path for the lr_images tensor of the current graph."""
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as reader:
+        graph_def.ParseFromString(reader.read())
+    return tf.import_graph_def(graph_def, input_map={INPUT_NAME + ':0': lr_images}, return_elements=[OUTPUT_NAME + ':0'],
+                               name='quantized')[0]
+
+
+def export_quantized(config=FLAGS):
+    assert config.quantization in QUANTIZATIONS, 'Unknown quantization %s' % config.quantization
+    assert not config.normalize_inputs, 'Quantized graphs do not standardize their inputs, train without --normalize_inputs'
+    checkpoint = _checkpoint_path(config.checkpoint_dir)
+    weights, biases = _load_parameters(checkpoint)
+    ranges = calibrate(checkpoint, config) if config.quantization == INT8 else None
+    if ranges:
+        for layer, (low, high) in enumerate(ranges):
+            print("conv_%d input range [%g, %g]" % (layer + 1, low, high))
+    graph_def = build_quantized_graph(weights, biases, ranges, config.quantization, get_upscale_ratio(config), config.color_channels)
+    path = get_quantized_graph_path(config)
+    with tf.gfile.GFile(path, 'wb') as writer:
+        writer.write(graph_def.SerializeToString())
+    print("Saved %s graph of %s to %s, %d bytes" % (config.quantization, checkpoint, path, os.path.getsize(path)))
+
+
+def _allocated_bytes(run_metadata):
+    return sum(output.tensor_description.allocation_description.allocated_bytes
+               for device in run_metadata.step_stats.dev_stats for node in device.node_stats for output in node.output)
+
+
+def _evaluate(prediction_fn, config):
+    """Mean metrics, latency per image and bytes allocated per image of a model on the subset."""
+    with tf.Graph().as_default(), tf.Session() as session:
+        lr_input = tf.placeholder(tf.float32, shape=(None, None, None, config.color_channels))
+        hr_input = tf.placeholder(tf.float32, shape=(None, None, None, config.color_channels))
+        image_input = tf.placeholder(tf.float32, shape=(None, None, None, config.color_channels))
+        prediction = prediction_fn(session, lr_input)
+        metrics = tf_image_metrics(hr_input, image_input)
+
+        # an untimed traced pass over the first batch, it also pays for the initialization of the kernels
+        warm_up = _batches(config)
+        first_batch = next(warm_up, None)
+        warm_up.close()
+        if first_batch is None:
+            raise ValueError('No records in subset %s of %s' % (config.subset, config.dataset))
+        run_metadata = tf.RunMetadata()
+        session.run(prediction, feed_dict={lr_input: first_batch[0]}, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                    run_metadata=run_metadata)
+        allocated_bytes = _allocated_bytes(run_metadata) / len(first_batch[0])
+
+        values = [[], [], []]
+        elapsed = 0.
+        images = 0
+        for lr_images, hr_images, _ in _batches(config):
+            start = time.time()
+            predictions = session.run(prediction, feed_dict={lr_input: lr_images})
+            elapsed += time.time() - start
+            images += len(lr_images)
+            for metric_values, batch_values in zip(values, session.run(metrics, feed_dict={hr_input: hr_images, image_input: predictions})):
+                metric_values.extend(batch_values.tolist())
+    rmse, psnr, ssim = [float(np.mean(v)) for v in values]
+    return OrderedDict([('rmse', rmse), ('psnr', psnr), ('ssim', ssim), ('ms_per_image', 1000 * elapsed / images),
+                        ('allocated_bytes_per_image', allocated_bytes)])
+
+
+def report_quantized(config=FLAGS):
+    assert not config.normalize_inputs, 'Quantized graphs do not standardize their inputs, train without --normalize_inputs'
+    checkpoint = _checkpoint_path(config.checkpoint_dir)
+    path = get_quantized_graph_path(config)
+    ratio = get_upscale_ratio(config)
+
+    def float_model(session, lr_input):
+        prediction = srcnn(lr_input, None, ratio=ratio)
+        tf.train.Saver().restore(session, checkpoint)
+        return prediction
+
+    weights, biases = _load_parameters(checkpoint)
+    float_result = _evaluate(float_model, config)
+    float_result['model_bytes'] = sum(p.nbytes for p in weights + biases)
+    quantized_result = _evaluate(lambda session, lr_input: import_quantized_graph(path, lr_input), config)
+    quantized_result['model_bytes'] = os.path.getsize(path)
+
+    print("%-26s %14s %14s %14s" % ('', 'float', os.path.basename(path), 'delta'))
+    for key in float_result:
+        print("%-26s %14.4f %14.4f %+14.4f" % (key, float_result[key], quantized_result[key], quantized_result[key] - float_result[key]))
+    report = {'checkpoint': checkpoint, 'graph': path, 'float': float_result, 'quantized': quantized_result,
+              'delta': {key: quantized_result[key] - float_result[key] for key in float_result}}
+    save_json(os.path.splitext(path)[0] + '_report.json', report)
+
+
+if __name__ == '__main__':
+    print("Start %s quantized graph" % FLAGS.quantize_mode)
+    if FLAGS.quantize_mode == 'report':
+        report_quantized()
+    else:
+        export_quantized()
+    print("Finish %s quantized graph" % FLAGS.quantize_mode)
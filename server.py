@@ -0,0 +1,235 @@
+"""
+HTTP inference server for models exported by export.py.
+
+    python server.py export/{dataset}/{subset}/{timestamp}/frozen_graph.pb [--port 8080] [--max_batch_size 8]
+                     [--max_delay_ms 10] [--workers 2]
+
+POST /predict with an image file as body answers with the upscaled image as PNG. Concurrent requests for images of
+the same size are coalesced into one batch: a batch is run as soon as max_batch_size requests are waiting or the
+oldest of them waited max_delay_ms. The model is loaded once and its session is shared by the worker threads.
+When max_queue requests are waiting new requests are rejected with 503.
+
+GET /metrics returns json with request counts, latency percentiles, the batch size histogram and the queue depth.
+loadgen.py sends concurrent requests to test the server on localhost.
+"""
+import argparse
+import io
+import json
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+
+from predict import Predictor, read_image, write_image
+
+# number of recent requests the latency percentiles are computed from
+LATENCY_WINDOW = 10000
+PERCENTILES = [50, 90, 99]
+
+
+class _Request(object):
+
+    def __init__(self, image):
+        self.image = image
+        self.key = image.shape
+        self.created = time.time()
+        self.done = threading.Event()
+        self.prediction = None
+        self.error = None
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Batcher(object):
+    """Coalesce requests for images of equal size into batches run by a pool of worker threads."""
+
+    def __init__(self, predictor, max_batch_size=8, max_delay_ms=10, workers=2, max_queue=256):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000.
+        self.max_queue = max_queue
+        self.pending = []
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.metrics_lock = threading.Lock()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = Counter()
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+
+        self.threads = [threading.Thread(target=self._work, name='batcher-%d' % i) for i in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def predict(self, image):
+        """Upscale one [height, width, channels] image, blocks until its batch has run."""
+        request = _Request(image)
+        with self.condition:
+            if not self.running:
+                raise QueueFullError('server shutting down')
+            if len(self.pending) >= self.max_queue:
+                with self.metrics_lock:
+                    self.rejected += 1
+                raise QueueFullError('%d requests waiting' % len(self.pending))
+            self.pending.append(request)
+            self.max_queue_depth = max(self.max_queue_depth, len(self.pending))
+            self.condition.notify_all()
+        request.done.wait()
+        with self.metrics_lock:
+            self.requests += 1
+            self.latencies.append(time.time() - request.created)
+            if request.error is not None:
+                self.errors += 1
+        if request.error is not None:
+            raise request.error
+        return request.prediction
+
+    def _next_batch(self):
+        """Wait for a full batch or the delay of its oldest request, None when stopped. While the batch of the oldest
+        request waits to fill, a full batch of another image size runs first."""
+        with self.condition:
+            while self.running:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                groups = OrderedDict()
+                for request in self.pending:
+                    groups.setdefault(request.key, []).append(request)
+                oldest = self.pending[0]
+                batch = groups[oldest.key][:self.max_batch_size]
+                remaining = oldest.created + self.max_delay - time.time()
+                if len(batch) < self.max_batch_size and remaining > 0:
+                    full = [group for group in groups.values() if len(group) >= self.max_batch_size]
+                    if not full:
+                        self.condition.wait(remaining)
+                        continue
+                    batch = full[0][:self.max_batch_size]
+                selected = set(id(r) for r in batch)
+                self.pending = [r for r in self.pending if id(r) not in selected]
+                return batch
+        return None
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                predictions = self.predictor.predict(np.stack([r.image for r in batch]))
+                for request, prediction in zip(batch, predictions):
+                    request.prediction = prediction
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            with self.metrics_lock:
+                self.batch_sizes[len(batch)] += 1
+            for request in batch:
+                request.done.set()
+
+    def metrics(self):
+        with self.condition:
+            queue_depth = len(self.pending)
+        with self.metrics_lock:
+            latencies = np.array(self.latencies) * 1000
+            return OrderedDict([
+                ('requests', self.requests),
+                ('errors', self.errors),
+                ('rejected', self.rejected),
+                ('queue_depth', queue_depth),
+                ('max_queue_depth', self.max_queue_depth),
+                ('latency_ms', OrderedDict([('p%d' % p, float(np.percentile(latencies, p)) if latencies.size else None) for p in PERCENTILES])),
+                ('batch_sizes', OrderedDict((str(size), count) for size, count in sorted(self.batch_sizes.items())))
+            ])
+
+    def close(self):
+        """Stop the workers, requests still waiting fail with QueueFullError."""
+        with self.condition:
+            self.running = False
+            pending, self.pending = self.pending, []
+            self.condition.notify_all()
+        for request in pending:
+            request.error = QueueFullError('server shutting down')
+            request.done.set()
+        for thread in self.threads:
+            thread.join()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    batcher = None
+    color_channels = 1
+
+    def _reply(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            return self._reply(404, b'not found\n', 'text/plain')
+        self._reply(200, json.dumps(self.batcher.metrics(), indent=2).encode('utf-8'), 'application/json')
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self._reply(404, b'not found\n', 'text/plain')
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            image = read_image(io.BytesIO(body), self.color_channels)
+        except Exception as e:
+            return self._reply(400, ('cannot read image: %s\n' % e).encode('utf-8'), 'text/plain')
+        try:
+            prediction = self.batcher.predict(image)
+        except QueueFullError as e:
+            return self._reply(503, ('%s\n' % e).encode('utf-8'), 'text/plain')
+        except Exception as e:
+            return self._reply(500, ('prediction failed: %s\n' % e).encode('utf-8'), 'text/plain')
+        output = io.BytesIO()
+        write_image(prediction, output, 'PNG')
+        self._reply(200, output.getvalue(), 'image/png')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve an exported srcnn model over HTTP with dynamic batching')
+    parser.add_argument('model', help='frozen_graph.pb or SavedModel directory written by export.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max_batch_size', type=int, default=8, help='largest batch of coalesced requests')
+    parser.add_argument('--max_delay_ms', type=float, default=10, help='longest time a request waits for its batch to fill')
+    parser.add_argument('--workers', type=int, default=2, help='threads running batches')
+    parser.add_argument('--max_queue', type=int, default=256, help='waiting requests before new ones are rejected')
+    args = parser.parse_args()
+
+    predictor = Predictor(args.model)
+    _Handler.batcher = Batcher(predictor, args.max_batch_size, args.max_delay_ms, args.workers, args.max_queue)
+    _Handler.color_channels = predictor.color_channels
+    server = _ThreadingHTTPServer((args.host, args.port), _Handler)
+    print("Serving %s on http://%s:%d" % (args.model, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        _Handler.batcher.close()
+        predictor.close()
+
+
+if __name__ == '__main__':
+    main()
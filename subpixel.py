@@ -6,7 +6,22 @@ import numpy as np
 import tensorflow as tf
 
 
-def _phase_shift(I, r):
+def _phase_shift(I, r, channels=1):
+    """Pixel shuffle of a [bsize, a, b, channels * r * r] tensor into [bsize, a * r, b * r, channels].
+
+    Output pixel (A * r + i, B * r + j) of color k is input channel k * r * r + j * r + i at (A, B), the ordering of
+    the original split/concat implementation. One reshape, one transpose and one reshape, whatever the image size."""
+    _, a, b, _ = I.get_shape().as_list()
+    shape = tf.shape(I)
+    a = shape[1] if a is None else a
+    b = shape[2] if b is None else b
+    X = tf.reshape(I, (-1, a, b, channels, r, r))  # bsize, a, b, channels, j, i
+    X = tf.transpose(X, (0, 1, 5, 2, 4, 3))  # bsize, a, i, b, j, channels
+    return tf.reshape(X, (-1, a * r, b * r, channels))
+
+
+def _split_phase_shift(I, r):
+    """Original split/concat implementation, kept as reference for _phase_shift. Creates O(a + b) ops."""
     bsize, a, b, c = I.get_shape().as_list()
     bsize = tf.shape(I)[0]  # Handling Dimension(None) type for undefined batch dim
     X = tf.reshape(I, (bsize, a, b, r, r))
@@ -19,44 +34,46 @@ def _phase_shift(I, r):
 
 
 def phase_shift(X, r, color=False):
+    return _phase_shift(X, r, 3 if color else 1)
+
+
+def split_phase_shift(X, r, color=False):
     if color:
         Xc = tf.split(X, 3, 3)
-        X = tf.concat([_phase_shift(x, r) for x in Xc], 3)
+        X = tf.concat([_split_phase_shift(x, r) for x in Xc], 3)
     else:
-        X = _phase_shift(X, r)
+        X = _split_phase_shift(X, r)
     return X
 
 
 def PS(I, r):
+    """NumPy reference of phase_shift for a single [a, b, channels * r * r] image."""
     assert len(I.shape) == 3
     assert r > 0
     r = int(r)
-    O = np.zeros((I.shape[0] * r, I.shape[1] * r, I.shape[2] / (r * 2)))
+    O = np.zeros((I.shape[0] * r, I.shape[1] * r, I.shape[2] // (r * r)), dtype=I.dtype)
     for x in range(O.shape[0]):
         for y in range(O.shape[1]):
             for c in range(O.shape[2]):
-                c += 1
-                a = np.floor(x / r).astype("int")
-                b = np.floor(y / r).astype("int")
-                d = c * r * (y % r) + c * (x % r)
-                print(a, b, d)
-                O[x, y, c - 1] = I[a, b, d]
+                a = x // r
+                b = y // r
+                d = c * r * r + r * (y % r) + (x % r)
+                O[x, y, c] = I[a, b, d]
     return O
 
 
 if __name__ == "__main__":
+    # phase_shift has to match the split/concat implementation and the NumPy reference
     with tf.Session() as sess:
-        x = np.arange(2 * 16 * 16).reshape(2, 8, 8, 4)
-        X = tf.placeholder("float32", shape=(2, 8, 8, 4), name="X")  # tf.Variable(x, name="X")
-        Y = phase_shift(X, 2)
-        y = sess.run(Y, feed_dict={X: x})
-        print(y.shape)
-        print(PS(x, 2))
-
-        x2 = np.arange(2 * 3 * 16 * 16).reshape(2, 8, 8, 4 * 3)
-        X2 = tf.placeholder("float32", shape=(2, 8, 8, 4 * 3), name="X")  # tf.Variable(x, name="X")
-        Y2 = phase_shift(X2, 2, color=True)
-        y2 = sess.run(Y2, feed_dict={X2: x2})
-        print(y2.shape)
-    # plt.imshow(y[0, :, :, 0], interpolation="none")
-    # plt.show()
+        for r, color, dynamic in [(2, False, False), (3, False, False), (2, True, False), (4, True, False), (3, False, True),
+                                  (2, True, True)]:
+            channels = (3 if color else 1) * r * r
+            x = np.random.rand(2, 7, 5, channels).astype(np.float32)
+            X = tf.placeholder(tf.float32, shape=(None, None, None, channels) if dynamic else x.shape, name="X")
+            Y = phase_shift(X, r, color)
+            y = sess.run(Y, feed_dict={X: x})
+            assert y.shape == (2, 7 * r, 5 * r, channels // (r * r))
+            assert np.array_equal(y, np.stack([PS(image, r) for image in x]))
+            if not dynamic:
+                assert np.array_equal(y, sess.run(split_phase_shift(X, r, color), feed_dict={X: x}))
+            print("ratio %d color %s dynamic %s: ok" % (r, color, dynamic))
@@ -1,9 +1,45 @@
+import hashlib
+import json
 import ntpath
 import os
+import time
+from collections import Counter, OrderedDict, deque, namedtuple
+from glob import glob
+from multiprocessing import Pool
+
+import numpy as np
 import tensorflow as tf
 
 from config import FLAGS
-from utils import DEPTH, FILENAME, HEIGHT, HR_IMAGE, LR_IMAGE, TFRECORD, WIDTH, get_image, get_tfrecord_files, load_files, parse_function, save_config
+from model import INFERENCE_WORKLOAD, get_session_config
+from utils import DEPTH, FILENAME, FLOAT_FORMAT, FORMAT, HEIGHT, FILENAMES_TXT, FLOAT16_FORMAT, HR_IMAGE, HR_NPY, INDEX_JSON, LR_HEIGHT, LR_IMAGE, LR_NPY, LR_WIDTH, RECORD_FORMATS, STATS_JSON, TFRECORD, WIDTH, encode_image, get_npy_dir, get_parse_function, get_record_count, get_record_format, get_tfrecord_compression, get_tfrecord_dir, get_tfrecord_files, get_tfrecord_options, get_upscale_ratio, \
+    load_files, load_tfrecord_index, read_image, resize_image, save_config, save_json, save_tfrecord_index, to_uint8
+
+# length (8 bytes) and two crc32 checksums (4 bytes each) framing every record in a tfrecord file
+RECORD_OVERHEAD = 16
+
+# The subset of the configuration needed to turn an image pair into a record, small enough to send to worker processes
+RecordParams = namedtuple('RecordParams', ['data_dir', 'dataset', 'subset', 'extension', 'image_size', 'lr_image_size', 'color_channels',
+                                           'record_format', 'variable_size'])
+
+DECODE = 'decode'
+RESIZE = 'resize'
+SERIALIZE = 'serialize'
+WRITE = 'write'
+
+MANIFEST_JSON = 'manifest.json'
+
+HIGHRES = 'highres'
+LOWRES = 'lowres'
+
+# The subset of the configuration needed to check the records of a shard in a worker process
+ValidationParams = namedtuple('ValidationParams', ['compression', 'record_format', 'variable_size', 'image_size', 'lr_image_size',
+                                                   'color_channels', 'ratio'])
+
+HISTOGRAM_BINS = 256
+
+# Save the manifest of an unsharded build every so many records, so an interrupted build resumes close to where it stopped
+MANIFEST_SAVE_EVERY = 100
 
 
 def _bytes_feature(value):
@@ -18,56 +54,358 @@ def _float_feature(value):
     return tf.train.Feature(float_list=tf.train.FloatList(value=value.flatten()))
 
 
+class ShardWriter(object):
+    """Writes serialized records into tfrecord shards bounded by a number of records and/or bytes.
+
+    Shards are written under temporary names and renamed to '{prefix}-{index}-of-{total}.tfrecord'
+    on close, when the total number of shards is known. The index file lists the shards in order.
+    Complete shards of a previous build can be passed in to be kept in front of the new ones.
+    """
+
+    def __init__(self, target_dir, prefix, max_records=0, max_bytes=0, compression='', record_format=FLOAT_FORMAT, shards=(),
+                 on_shard_closed=None):
+        self.target_dir = target_dir
+        self.prefix = prefix
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.compression = compression.upper()
+        self.record_format = record_format
+        self.options = get_tfrecord_options(self.compression)
+        self.shards = list(shards)
+        self.renames = {}
+        self.on_shard_closed = on_shard_closed
+        self._run_id = '%x' % int(time.time() * 1000)
+        self._writer = None
+
+    def _temp_name(self, tag):
+        return '%s-%s-%s.%s.tmp' % (self.prefix, self._run_id, tag, TFRECORD)
+
+    def _is_full(self):
+        shard = self.shards[-1]
+        if self.max_records and shard['records'] >= self.max_records:
+            return True
+        return self.max_bytes and shard['bytes'] >= self.max_bytes
+
+    def _close_current(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            if self.on_shard_closed:
+                self.on_shard_closed(self.shards[-1])
+
+    def _open_next(self):
+        self._close_current()
+        temp_name = self._temp_name('%05d' % len(self.shards))
+        self.shards.append({'file': temp_name, 'records': 0, 'bytes': 0})
+        self._writer = tf.python_io.TFRecordWriter(os.path.join(self.target_dir, temp_name), options=self.options)
+
+    def write(self, record):
+        """Write a record and return the name of the shard it went to."""
+        if self._writer is None or self._is_full():
+            self._open_next()
+        self._writer.write(record)
+        shard = self.shards[-1]
+        shard['records'] += 1
+        shard['bytes'] += len(record) + RECORD_OVERHEAD
+        return shard['file']
+
+    def close(self):
+        self._close_current()
+        total = len(self.shards)
+        moving = []
+        for i, shard in enumerate(self.shards):
+            name = '%s-%05d-of-%05d.%s' % (self.prefix, i, total, TFRECORD)
+            if shard['file'] != name:
+                moving.append((shard, name))
+        # move through temporary names first, a kept shard may currently own the final name of another one
+        for i, (shard, name) in enumerate(moving):
+            temp_name = self._temp_name('r%05d' % i)
+            os.replace(os.path.join(self.target_dir, shard['file']), os.path.join(self.target_dir, temp_name))
+            self.renames[shard['file']] = name
+            shard['file'] = temp_name
+        for shard, name in moving:
+            os.replace(os.path.join(self.target_dir, shard['file']), os.path.join(self.target_dir, name))
+            shard['file'] = name
+        # remove shards left from a previous or an interrupted build
+        current = set(shard['file'] for shard in self.shards)
+        stale_files = glob(os.path.join(self.target_dir, '%s-*-of-*.%s' % (self.prefix, TFRECORD)))
+        stale_files += glob(os.path.join(self.target_dir, '%s-*.%s.tmp' % (self.prefix, TFRECORD)))
+        for stale in stale_files:
+            if ntpath.basename(stale) not in current:
+                os.remove(stale)
+        index = {
+            'compression': self.compression,
+            FORMAT: self.record_format,
+            'records': sum(shard['records'] for shard in self.shards),
+            'shards': self.shards
+        }
+        save_tfrecord_index(self.target_dir, index)
+        return index
+
+
+def _image_name(file):
+    return ntpath.basename(file).split('.')[0]
+
+
+def _lowres_filename(file, params):
+    return os.path.join(params.data_dir, params.dataset, params.subset, 'Lowres', '%s.%s' % (_image_name(file), params.extension))
+
+
+def _create_record(file, params):
+    """Decode, resize and serialize one high/low resolution image pair.
+    Returns the image name, the serialized record and the seconds spent in every stage.
+    """
+    timings = OrderedDict()
+    name = _image_name(file)
+    colored = params.color_channels == 3
+
+    start = time.time()
+    hr_image = read_image(file, colored)
+    lr_image = read_image(_lowres_filename(file, params), colored)
+    timings[DECODE] = time.time() - start
+
+    start = time.time()
+    if params.variable_size:
+        # keep the low resolution size and align the high resolution image to it
+        ratio = params.image_size // params.lr_image_size
+        lr_image = resize_image(lr_image, None)
+        hr_image = resize_image(hr_image, (lr_image.shape[0] * ratio, lr_image.shape[1] * ratio))
+    else:
+        hr_image = resize_image(hr_image, params.image_size)
+        lr_image = resize_image(lr_image, params.lr_image_size)
+    timings[RESIZE] = time.time() - start
+
+    start = time.time()
+    # Create a feature and record
+    feature = {
+        HEIGHT: _int64_feature(hr_image.shape[0]),
+        WIDTH: _int64_feature(hr_image.shape[1]),
+        DEPTH: _int64_feature(params.color_channels),
+        LR_HEIGHT: _int64_feature(lr_image.shape[0]),
+        LR_WIDTH: _int64_feature(lr_image.shape[1]),
+        FILENAME: _bytes_feature(bytes(name, 'utf-8'))
+    }
+    if params.record_format == FLOAT_FORMAT:
+        feature[LR_IMAGE] = _float_feature(lr_image)
+        feature[HR_IMAGE] = _float_feature(hr_image)
+    else:
+        feature[FORMAT] = _bytes_feature(bytes(params.record_format, 'utf-8'))
+        feature[LR_IMAGE] = _bytes_feature(encode_image(lr_image, params.record_format))
+        feature[HR_IMAGE] = _bytes_feature(encode_image(hr_image, params.record_format))
+    record = tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+    timings[SERIALIZE] = time.time() - start
+    return name, record, timings
+
+
+def _record_stream(files, params, workers, queue_size):
+    """Yield processed records in the order of files.
+
+    With several workers the images are processed by a process pool. At most queue_size results are in flight,
+    so a slow writer blocks the submission of new images instead of letting finished records pile up in memory.
+    """
+    if workers <= 1:
+        for file in files:
+            yield _create_record(file, params)
+        return
+    pool = Pool(workers)
+    try:
+        pending = deque()
+        for file in files:
+            if len(pending) >= queue_size:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(_create_record, (file, params)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _print_throughput(count, timings, workers, elapsed):
+    """Print images/sec per stage. Worker stages are summed over all workers and therefore scaled by their number."""
+    print("\nProcessed %d images in %.1f sec (%.1f images/sec) with %d worker(s)" % (count, elapsed, count / max(elapsed, 1e-9), workers))
+    for stage, seconds in timings.items():
+        parallelism = 1 if stage == WRITE else workers
+        print("%-10s %10.1f sec %10.1f images/sec" % (stage, seconds, count * parallelism / max(seconds, 1e-9)))
+
+
+def _file_state(path, previous=None):
+    """Size, modification time and sha1 of a file. The hash is only recomputed when size or mtime changed."""
+    stat = os.stat(path)
+    if previous and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime:
+        return previous
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as reader:
+        for block in iter(lambda: reader.read(1024 * 1024), b''):
+            sha1.update(block)
+    return {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}
+
+
+def _build_params(config):
+    """Everything that changes the content or layout of the records. A change of any of them requires a full rebuild."""
+    return {
+        'image_size': config.image_size,
+        'lr_image_size': config.lr_image_size,
+        'variable_size': config.variable_size,
+        'color_channels': config.color_channels,
+        'extension': config.extension,
+        'record_format': config.record_format,
+        'shard_size': config.shard_size,
+        'shard_bytes': config.shard_bytes,
+        'compression': config.compression.upper()
+    }
+
+
+def _load_manifest(target_dir, build_params, incremental=True):
+    path = os.path.join(target_dir, MANIFEST_JSON)
+    if incremental and os.path.exists(path):
+        with open(path) as reader:
+            manifest = json.load(reader)
+        if manifest['params'] == build_params:
+            return manifest
+        print("Preprocessing parameters changed, rebuilding all tfrecords")
+    return {'params': build_params, 'files': {}, 'shards': []}
+
+
+def _save_manifest(target_dir, manifest):
+    save_json(os.path.join(target_dir, MANIFEST_JSON), manifest)
+
+
+def _remove_shards(config):
+    """Remove the shards and the index of a sharded build, readers would prefer them over one file per image."""
+    index = load_tfrecord_index(config)
+    if index is None:
+        return
+    for shard in index['shards']:
+        if os.path.exists(os.path.join(get_tfrecord_dir(config), shard['file'])):
+            os.remove(os.path.join(get_tfrecord_dir(config), shard['file']))
+    os.remove(os.path.join(get_tfrecord_dir(config), INDEX_JSON))
+
+
+def _record_name(record):
+    return tf.train.Example.FromString(record).features.feature[FILENAME].bytes_list.value[0].decode('utf-8')
+
+
 def create_tfrecords(config=FLAGS):
-    if not os.path.exists(config.tfrecord_dir):
-        os.makedirs(config.tfrecord_dir)
-    if not os.path.exists(os.path.join(config.tfrecord_dir, config.dataset, config.subset)):
-        os.makedirs(os.path.join(config.tfrecord_dir, config.dataset, config.subset))
+    """Create the tfrecords of a subset.
+
+    A manifest next to the records keeps the size, mtime and sha1 of every source image pair, the build parameters and
+    the file or shard holding its record. Rebuilds only decode new or changed pairs and drop deleted ones. Records of
+    unchanged pairs that share a shard with a stale record are copied as serialized bytes. The manifest is saved as
+    shards complete, so an interrupted build resumes from the last complete shard.
+    """
+    target_dir = get_tfrecord_dir(config)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
 
     save_config(config.tfrecord_dir, config)
 
     highres_files = load_files(os.path.join(config.data_dir, config.dataset, config.subset, 'Highres'), config.extension)
     print("\nThere are %d files in %s dataset, subset %s\n" % (len(highres_files), config.dataset, config.subset))
+    assert config.record_format in RECORD_FORMATS, 'Unknown record format %s' % config.record_format
+    assert not (config.variable_size and config.record_format == FLOAT_FORMAT), 'Variable size records need a compact record format'
+    params = RecordParams(config.data_dir, config.dataset, config.subset, config.extension, config.image_size, config.lr_image_size,
+                          config.color_channels, config.record_format, config.variable_size)
+    sharded = config.shard_size > 0 or config.shard_bytes > 0
+    if not sharded:
+        _remove_shards(config)
+
+    manifest = _load_manifest(target_dir, _build_params(config), config.incremental)
+    entries = manifest['files']
+    shard_files = set(shard['file'] for shard in manifest['shards'])
+    sources = {}
+    pending = []
+    kept = set()
     for file in highres_files:
-        print(file)
-        name = ntpath.basename(file).split('.')[0]
-        lowres_filename = os.path.join(config.data_dir, config.dataset, config.subset, 'Lowres', '%s.%s' % (name, config.extension))
-        hr_image = get_image(file, config.image_size, config.color_channels == 3)
-        lr_image = get_image(lowres_filename, 256, config.color_channels == 3)
-
-        # Create a feature and record
-        feature = {
-            HEIGHT: _int64_feature(config.image_size),
-            WIDTH: _int64_feature(config.image_size),
-            DEPTH: _int64_feature(config.color_channels),
-            LR_IMAGE: _float_feature(lr_image),
-            HR_IMAGE: _float_feature(hr_image),
-            FILENAME: _bytes_feature(bytes(name, 'utf-8'))
+        name = _image_name(file)
+        entry = entries.get(name)
+        state = {
+            HIGHRES: _file_state(file, entry and entry[HIGHRES]),
+            LOWRES: _file_state(_lowres_filename(file, params), entry and entry[LOWRES])
         }
-        record = tf.train.Example(features=tf.train.Features(feature=feature))
+        sources[name] = state
+        unchanged = entry is not None and all(entry[key]['sha1'] == state[key]['sha1'] for key in (HIGHRES, LOWRES))
+        stored = entry is not None and (entry['shard'] in shard_files if sharded else True)
+        if unchanged and stored and os.path.exists(os.path.join(target_dir, entry['shard'])):
+            entry.update(state)
+            kept.add(name)
+        else:
+            pending.append(file)
+    deleted = [name for name in entries if name not in sources]
+    print("%d unchanged, %d new or changed and %d deleted image pairs\n" % (len(kept), len(pending), len(deleted)))
+    for name in deleted:
+        if not sharded and os.path.exists(os.path.join(target_dir, entries[name]['shard'])):
+            os.remove(os.path.join(target_dir, entries[name]['shard']))
+        del entries[name]
 
-        tfrecord_filename = os.path.join(config.tfrecord_dir, config.dataset, config.subset, '%s.%s' % (name, TFRECORD))
-        print(tfrecord_filename)
-        with tf.python_io.TFRecordWriter(tfrecord_filename) as writer:
-            writer.write(record.SerializeToString())
+    if sharded:
+        # a shard is kept as is when it holds exactly the unchanged records that point to it
+        members = Counter(entries[name]['shard'] for name in kept)
+        clean = [shard for shard in manifest['shards'] if members[shard['file']] == shard['records']]
+        dirty = [shard for shard in manifest['shards'] if members[shard['file']] != shard['records']]
+
+        def on_shard_closed(shard):
+            manifest['shards'].append(shard)
+            _save_manifest(target_dir, manifest)
+
+        shard_writer = ShardWriter(target_dir, config.subset, config.shard_size, config.shard_bytes, config.compression, config.record_format,
+                                   shards=clean, on_shard_closed=on_shard_closed)
+        copied = 0
+        for shard in dirty:
+            if not members[shard['file']]:
+                continue
+            for record in tf.python_io.tf_record_iterator(os.path.join(target_dir, shard['file']), options=shard_writer.options):
+                name = _record_name(record)
+                if name in kept and entries[name]['shard'] == shard['file']:
+                    entries[name]['shard'] = shard_writer.write(record)
+                    copied += 1
+        print("%d unchanged records copied from %d outdated shards" % (copied, len(dirty)))
+
+    timings = OrderedDict((stage, 0.0) for stage in (DECODE, RESIZE, SERIALIZE, WRITE))
+    count = 0
+    start = time.time()
+    for name, record, record_timings in _record_stream(pending, params, config.workers, config.queue_size):
+        print(name)
+        write_start = time.time()
+        if sharded:
+            shard = shard_writer.write(record)
+        else:
+            shard = '%s.%s' % (name, TFRECORD)
+            with tf.python_io.TFRecordWriter(os.path.join(target_dir, shard)) as writer:
+                writer.write(record)
+        entries[name] = dict(sources[name], shard=shard)
+        for stage, seconds in record_timings.items():
+            timings[stage] += seconds
+        timings[WRITE] += time.time() - write_start
+        count += 1
+        if not sharded and count % MANIFEST_SAVE_EVERY == 0:
+            _save_manifest(target_dir, manifest)
+    if sharded:
+        index = shard_writer.close()
+        for entry in entries.values():
+            entry['shard'] = shard_writer.renames.get(entry['shard'], entry['shard'])
+        manifest['shards'] = index['shards']
+        print("%d records written into %d shards" % (index['records'], len(index['shards'])))
+    _save_manifest(target_dir, manifest)
+    _print_throughput(count, timings, max(config.workers, 1), time.time() - start)
 
 
 def test_tfrecords(config=FLAGS):
     assert os.path.exists(config.tfrecord_dir)
-    assert os.path.exists(os.path.join(config.tfrecord_dir, config.dataset, config.subset))
+    assert os.path.exists(get_tfrecord_dir(config))
 
     filenames = get_tfrecord_files(config)
 
-    dataset = tf.contrib.data.TFRecordDataset(filenames)
-    dataset = dataset.map(parse_function)
+    dataset = tf.contrib.data.TFRecordDataset(filenames, compression_type=get_tfrecord_compression(config))
+    dataset = dataset.map(get_parse_function(config))
     dataset = dataset.shuffle(10000)
-    dataset = dataset.batch(10)
+    dataset = dataset.padded_batch(10, dataset.output_shapes) if config.variable_size else dataset.batch(10)
     dataset = dataset.repeat(100)
 
     iterator = dataset.make_initializable_iterator()
     next_element = iterator.get_next()
 
-    with tf.Session() as sess:
+    with tf.Session(config=get_session_config(workload=INFERENCE_WORKLOAD, config=config)) as sess:
         sess.run(tf.global_variables_initializer())
         sess.run(iterator.initializer)
         while True:
@@ -78,12 +416,225 @@ def test_tfrecords(config=FLAGS):
                 break
 
 
+def export_npy(config=FLAGS):
+    """Export a subset into contiguous memory-mapped arrays, lr.npy and hr.npy of uint8 pixels with a fixed stride per image,
+    and filenames.txt with the image name of every row. The pixels come from 8-bit images, so uint8 is lossless.
+    """
+    assert not config.variable_size, 'Only images of a fixed size can be exported to NumPy arrays'
+    target_dir = get_npy_dir(config)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    count = get_record_count(config)
+    dataset = tf.data.TFRecordDataset(get_tfrecord_files(config), compression_type=get_tfrecord_compression(config))
+    dataset = dataset.map(get_parse_function(config), num_parallel_calls=config.num_parallel_calls)
+    dataset = dataset.batch(64)
+    next_element = dataset.make_one_shot_iterator().get_next()
+
+    lr_shape = (count, config.lr_image_size, config.lr_image_size, config.color_channels)
+    hr_shape = (count, config.image_size, config.image_size, config.color_channels)
+    lr_array = np.lib.format.open_memmap(os.path.join(target_dir, LR_NPY), mode='w+', dtype=np.uint8, shape=lr_shape)
+    hr_array = np.lib.format.open_memmap(os.path.join(target_dir, HR_NPY), mode='w+', dtype=np.uint8, shape=hr_shape)
+    names = []
+    with tf.Session() as sess:
+        while True:
+            try:
+                lr_images, hr_images, batch_names = sess.run(next_element)
+            except tf.errors.OutOfRangeError:
+                break
+            lr_array[len(names):len(names) + len(batch_names)] = to_uint8(lr_images)
+            hr_array[len(names):len(names) + len(batch_names)] = to_uint8(hr_images)
+            names.extend(name.decode('utf-8') for name in batch_names)
+            print("%d/%d images exported" % (len(names), count))
+    assert len(names) == count, 'Expected %d records, found %d' % (count, len(names))
+    lr_array.flush()
+    hr_array.flush()
+    with open(os.path.join(target_dir, FILENAMES_TXT), 'w') as writer:
+        writer.write('\n'.join(names) + '\n')
+
+
+class RunningStats(object):
+    """Streaming per-channel mean, variance, range and histogram of pixels in [0, 1].
+
+    Partial statistics of different shards are merged with the parallel variant of Welford's algorithm,
+    so memory does not grow with the number of records.
+    """
+
+    def __init__(self, channels):
+        self.count = 0
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros(channels)
+        self.min = np.full(channels, np.inf)
+        self.max = np.full(channels, -np.inf)
+        self.histogram = np.zeros((channels, HISTOGRAM_BINS), dtype=np.int64)
+
+    def _merge(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    def update(self, image):
+        pixels = image.reshape(-1, image.shape[-1]).astype(np.float64)
+        mean = pixels.mean(axis=0)
+        self._merge(len(pixels), mean, ((pixels - mean) ** 2).sum(axis=0))
+        self.min = np.minimum(self.min, pixels.min(axis=0))
+        self.max = np.maximum(self.max, pixels.max(axis=0))
+        bins = np.clip(np.round(pixels * (HISTOGRAM_BINS - 1)), 0, HISTOGRAM_BINS - 1).astype(np.int64)
+        for channel in range(pixels.shape[1]):
+            self.histogram[channel] += np.bincount(bins[:, channel], minlength=HISTOGRAM_BINS)
+
+    def merge(self, other):
+        if other.count:
+            self._merge(other.count, other.mean, other.m2)
+            self.min = np.minimum(self.min, other.min)
+            self.max = np.maximum(self.max, other.max)
+            self.histogram += other.histogram
+
+    def to_dict(self):
+        return {
+            'pixels': int(self.count),
+            'mean': self.mean.tolist(),
+            'std': np.sqrt(self.m2 / max(self.count, 1)).tolist(),
+            'min': self.min.tolist(),
+            'max': self.max.tolist(),
+            'histogram': self.histogram.tolist()
+        }
+
+
+def _decode_feature(feature, record_format):
+    if record_format == FLOAT_FORMAT:
+        return np.asarray(feature.float_list.value, dtype=np.float32)
+    raw = feature.bytes_list.value[0]
+    if record_format == FLOAT16_FORMAT:
+        return np.frombuffer(raw, dtype='<f2').astype(np.float32)
+    return np.frombuffer(raw, dtype=np.uint8).astype(np.float32) / 255.
+
+
+def _check_record(record, params):
+    """Decode a serialized record with NumPy and check shapes, value range and the pairing of the images.
+    Returns the name and the low and high resolution images, raises ValueError describing the first problem found.
+    """
+    feature = tf.train.Example.FromString(record).features.feature
+    for key in (HEIGHT, WIDTH, DEPTH, LR_IMAGE, HR_IMAGE, FILENAME):
+        if key not in feature:
+            raise ValueError('missing feature %s' % key)
+    name = feature[FILENAME].bytes_list.value[0].decode('utf-8')
+    if not name:
+        raise ValueError('empty filename')
+    record_format = feature[FORMAT].bytes_list.value[0].decode('utf-8') if FORMAT in feature else FLOAT_FORMAT
+    if record_format != params.record_format:
+        raise ValueError('%s: format %s, expected %s' % (name, record_format, params.record_format))
+
+    depth = feature[DEPTH].int64_list.value[0]
+    hr_shape = (feature[HEIGHT].int64_list.value[0], feature[WIDTH].int64_list.value[0], depth)
+    lr_height = feature[LR_HEIGHT].int64_list.value[0] if LR_HEIGHT in feature else params.lr_image_size
+    lr_width = feature[LR_WIDTH].int64_list.value[0] if LR_WIDTH in feature else params.lr_image_size
+    lr_shape = (lr_height, lr_width, depth)
+    if depth != params.color_channels:
+        raise ValueError('%s: %d color channels, expected %d' % (name, depth, params.color_channels))
+    if not params.variable_size and (hr_shape[0] != params.image_size or hr_shape[1] != params.image_size):
+        raise ValueError('%s: high resolution size %s, expected %d' % (name, hr_shape[:2], params.image_size))
+    if hr_shape[0] != lr_shape[0] * params.ratio or hr_shape[1] != lr_shape[1] * params.ratio:
+        raise ValueError('%s: sizes %s and %s do not match the ratio %d' % (name, lr_shape[:2], hr_shape[:2], params.ratio))
+
+    images = []
+    for key, shape in ((LR_IMAGE, lr_shape), (HR_IMAGE, hr_shape)):
+        image = _decode_feature(feature[key], record_format)
+        if image.size != np.prod(shape):
+            raise ValueError('%s: %s has %d values, expected %s' % (name, key, image.size, shape))
+        if not np.all(np.isfinite(image)) or image.min() < 0 or image.max() > 1:
+            raise ValueError('%s: %s values out of [0, 1]' % (name, key))
+        images.append(image.reshape(shape))
+    return name, images[0], images[1]
+
+
+def _validate_shard(path, params):
+    """Stream the records of one shard. Returns the number of records and bytes, statistics and the problems found."""
+    lr_stats = RunningStats(params.color_channels)
+    hr_stats = RunningStats(params.color_channels)
+    errors = []
+    records = 0
+    # offset of the record in the uncompressed stream
+    offset = 0
+    try:
+        for record in tf.python_io.tf_record_iterator(path, options=get_tfrecord_options(params.compression)):
+            try:
+                name, lr_image, hr_image = _check_record(record, params)
+                lr_stats.update(lr_image)
+                hr_stats.update(hr_image)
+            except Exception as e:
+                errors.append({'shard': path, 'record': records, 'offset': offset, 'error': str(e)})
+            records += 1
+            offset += len(record) + RECORD_OVERHEAD
+    except Exception as e:
+        # corrupt or truncated file, nothing after this point can be read
+        errors.append({'shard': path, 'record': records, 'offset': offset, 'error': 'unreadable: %s' % e})
+    return records, offset, lr_stats, hr_stats, errors
+
+
+def _validate_shard_task(args):
+    return _validate_shard(*args)
+
+
+def validate_tfrecords(config=FLAGS):
+    """Read every record of a subset once, in parallel over the files, and check it.
+
+    Reports corrupt or truncated records with their file, record number and offset and saves the per-channel
+    statistics of the low and high resolution images to stats.json, training with --normalize_inputs standardizes
+    its inputs with them.
+    """
+    files = get_tfrecord_files(config)
+    params = ValidationParams(get_tfrecord_compression(config), get_record_format(config), config.variable_size, config.image_size,
+                              config.lr_image_size, config.color_channels, get_upscale_ratio(config))
+    lr_stats = RunningStats(config.color_channels)
+    hr_stats = RunningStats(config.color_channels)
+    errors = []
+    records = 0
+    stream_bytes = 0
+    start = time.time()
+    pool = Pool(max(config.workers, 1))
+    try:
+        for shard_records, shard_bytes, shard_lr_stats, shard_hr_stats, shard_errors in pool.imap_unordered(
+                _validate_shard_task, [(file, params) for file in files]):
+            records += shard_records
+            stream_bytes += shard_bytes
+            lr_stats.merge(shard_lr_stats)
+            hr_stats.merge(shard_hr_stats)
+            errors.extend(shard_errors)
+    finally:
+        pool.terminate()
+        pool.join()
+    elapsed = max(time.time() - start, 1e-9)
+
+    for error in errors:
+        print("%(shard)s record %(record)d offset %(offset)d: %(error)s" % error)
+    stats = {
+        'records': records,
+        'invalid_records': len(errors),
+        FORMAT: params.record_format,
+        'lr_image': lr_stats.to_dict(),
+        'hr_image': hr_stats.to_dict()
+    }
+    save_json(os.path.join(get_tfrecord_dir(config), STATS_JSON), stats)
+    print("\n%d records in %d files, %d problems" % (records, len(files), len(errors)))
+    print("high resolution mean %s std %s" % (stats['hr_image']['mean'], stats['hr_image']['std']))
+    print("low resolution mean %s std %s" % (stats['lr_image']['mean'], stats['lr_image']['std']))
+    print("%.1f sec, %.1f records/sec, %.1f MB/sec" % (elapsed, records / elapsed, stream_bytes / elapsed / 1024 / 1024))
+    return stats
+
+
 if __name__ == '__main__':
     if not os.path.exists(FLAGS.tfrecord_dir):
         os.makedirs(FLAGS.tfrecord_dir)
     print("Start %s tfrecord files" % FLAGS.tfrecord_mode)
     if FLAGS.tfrecord_mode == 'create':
         create_tfrecords()
+    elif FLAGS.tfrecord_mode == 'validate':
+        validate_tfrecords()
+    elif FLAGS.tfrecord_mode == 'export_npy':
+        export_npy()
     else:
         test_tfrecords()
     print("Finish %s tfrecord files" % FLAGS.tfrecord_mode)
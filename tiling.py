@@ -0,0 +1,74 @@
+"""
+Tiled srcnn inference for images larger than what fits into memory in one piece.
+
+The low resolution image is split into tiles. Every tile is predicted from a window extended by a margin that covers
+the receptive field of srcnn, so its core is predicted exactly as in the whole image. Windows at the image border are
+shifted inside the image instead of being padded, which keeps the border handling of the SAME convolutions and gives
+all windows the same size, so they are predicted in batches. Optionally neighbouring tiles overlap and are blended
+with linear weights. Peak memory of the network depends on the tile size and the batch, not on the image size.
+"""
+import numpy as np
+import tensorflow as tf
+
+from model import srcnn, srcnn_margin
+
+
+def _axis_tiles(length, tile_size, margin, overlap):
+    """Split one axis into tiles. Returns (start, end, window_start, weights) of every tile, the region [start, end)
+    is predicted from the window starting at window_start and blended with the weights."""
+    window = min(length, tile_size + 2 * (margin + overlap))
+    tiles = []
+    for core_start in range(0, length, tile_size):
+        core_end = min(core_start + tile_size, length)
+        start = max(core_start - overlap, 0)
+        end = min(core_end + overlap, length)
+        window_start = min(max(start - margin, 0), length - window)
+        weights = np.ones(end - start, dtype=np.float32)
+        weights[:core_start - start] = np.arange(1, core_start - start + 1) / (overlap + 1.)
+        weights[weights.size - (end - core_end):] = np.arange(end - core_end, 0, -1) / (overlap + 1.)
+        tiles.append((start, end, window_start, weights))
+    return tiles, window
+
+
+def predict_tiled(session, lr_input, prediction, lr_image, ratio, tile_size, batch_size=8, overlap=0, margin=None):
+    """Predict the high resolution image of a low resolution image [height, width, channels] tile by tile.
+
+    lr_input is a placeholder of shape [None, None, None, channels] and prediction the srcnn output for it.
+    """
+    margin = srcnn_margin() if margin is None else margin
+    height, width, channels = lr_image.shape
+    rows, window_height = _axis_tiles(height, tile_size, margin, overlap)
+    cols, window_width = _axis_tiles(width, tile_size, margin, overlap)
+    output = np.zeros((height * ratio, width * ratio), dtype=np.float32)
+    weight_sum = np.zeros((height * ratio, width * ratio), dtype=np.float32)
+    tiles = [(row, col) for row in rows for col in cols]
+    for i in range(0, len(tiles), batch_size):
+        batch = tiles[i:i + batch_size]
+        windows = np.stack([lr_image[row[2]:row[2] + window_height, col[2]:col[2] + window_width] for row, col in batch])
+        predictions = session.run(prediction, feed_dict={lr_input: windows})
+        for (row, col), tile_prediction in zip(batch, predictions):
+            (y0, y1, window_y, row_weights), (x0, x1, window_x, col_weights) = row, col
+            tile = tile_prediction[(y0 - window_y) * ratio:(y1 - window_y) * ratio, (x0 - window_x) * ratio:(x1 - window_x) * ratio, 0]
+            weights = np.outer(np.repeat(row_weights, ratio), np.repeat(col_weights, ratio))
+            output[y0 * ratio:y1 * ratio, x0 * ratio:x1 * ratio] += tile * weights
+            weight_sum[y0 * ratio:y1 * ratio, x0 * ratio:x1 * ratio] += weights
+    return (output / weight_sum)[:, :, np.newaxis]
+
+
+if __name__ == "__main__":
+    # tiled inference has to match inference on the whole image
+    with tf.Session() as sess:
+        ratio = 2
+        X = tf.placeholder(tf.float32, shape=(None, None, None, 1), name="X")
+        Y = srcnn(X, None, ratio=ratio)
+        sess.run(tf.global_variables_initializer())
+        # weights large enough that the network output depends on its neighbourhood
+        for variable in tf.trainable_variables():
+            sess.run(variable.assign(tf.random_normal(tf.shape(variable), stddev=0.5)))
+        x = np.random.rand(97, 131, 1).astype(np.float32)
+        y = sess.run(Y, feed_dict={X: x[np.newaxis]})[0]
+        for tile_size, overlap in [(16, 0), (32, 0), (40, 3), (200, 0)]:
+            y_tiled = predict_tiled(sess, X, Y, x, ratio, tile_size, batch_size=4, overlap=overlap)
+            difference = np.abs(y - y_tiled).max()
+            print("tile %d overlap %d: max difference %g" % (tile_size, overlap, difference))
+            assert difference < 1e-5
@@ -0,0 +1,123 @@
+"""
+Thread pool tuning of srcnn training and inference for the CPUs of this machine.
+
+    python tune_threads.py [--image_size 512 --lr_image_size 256 --batch_size 10 --test_batch_size 8 --tune_steps 10]
+
+Every combination of intra op threads (powers of two up to the number of CPUs) and inter op threads (1, 2 and 4)
+and the TensorFlow defaults is run on random images of the configured size: an Adam training step with batch_size
+images and an inference step with test_batch_size images. TensorFlow creates its thread pools once per process, so
+every configuration runs in a fresh process. The median step times of all configurations and the fastest
+configuration per workload are saved to {thread_profile_dir}/{hostname}.json.
+
+Training, testing and tfrecords.py --tfrecord_mode=test load the profile of their machine through
+model.get_session_config, --intra_op_threads and --inter_op_threads override it.
+"""
+import multiprocessing
+import os
+import platform
+import socket
+import time
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+from config import FLAGS
+from model import INFERENCE_WORKLOAD, TRAIN_WORKLOAD, srcnn
+from utils import get_thread_profile_path, get_upscale_ratio, save_json
+
+TUNE_SEED = 42
+INTER_OP_THREADS = [1, 2, 4]
+
+
+def _thread_configurations(cpus):
+    """(intra, inter) pairs to try, (0, 0) are the TensorFlow defaults."""
+    intra_threads = sorted(set([2 ** i for i in range(cpus.bit_length()) if 2 ** i <= cpus] + [cpus // 2, cpus]) - {0})
+    configurations = [(0, 0)]
+    for inter in INTER_OP_THREADS:
+        for intra in intra_threads:
+            if inter <= cpus and intra * inter <= 2 * cpus:
+                configurations.append((intra, inter))
+    return configurations
+
+
+def _median_ms(session, fetches, feed_dict, steps):
+    session.run(fetches, feed_dict=feed_dict)
+    times = []
+    for _ in range(steps):
+        start = time.time()
+        session.run(fetches, feed_dict=feed_dict)
+        times.append(time.time() - start)
+    return 1000 * float(np.median(times))
+
+
+def _measure(intra, inter, workload, batch_size, size, ratio, channels, learning_rate, steps):
+    """Median step time of a workload on random images with the given thread pool sizes."""
+    np.random.seed(TUNE_SEED)
+    lr_size = size // ratio
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.set_random_seed(TUNE_SEED)
+        lr_input = tf.placeholder(tf.float32, shape=(batch_size, lr_size, lr_size, channels))
+        prediction = srcnn(lr_input, size, ratio=ratio)
+        feed_dict = {lr_input: np.random.rand(batch_size, lr_size, lr_size, channels).astype(np.float32)}
+        if workload == TRAIN_WORKLOAD:
+            hr_input = tf.placeholder(tf.float32, shape=(batch_size, size, size, channels))
+            fetches = tf.train.AdamOptimizer(learning_rate).minimize(tf.losses.mean_squared_error(hr_input, prediction))
+            feed_dict[hr_input] = np.random.rand(batch_size, size, size, channels).astype(np.float32)
+        else:
+            fetches = prediction
+        session_config = tf.ConfigProto(intra_op_parallelism_threads=intra, inter_op_parallelism_threads=inter)
+        with tf.Session(graph=graph, config=session_config) as session:
+            session.run(tf.global_variables_initializer())
+            return _median_ms(session, fetches, feed_dict, steps)
+
+
+def _isolated(function, *args):
+    pool = multiprocessing.get_context('spawn').Pool(1)
+    try:
+        return pool.apply(function, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def tune_threads(config=FLAGS):
+    cpus = multiprocessing.cpu_count()
+    ratio = get_upscale_ratio(config)
+    workloads = [(TRAIN_WORKLOAD, config.batch_size), (INFERENCE_WORKLOAD, config.test_batch_size)]
+    results = []
+    for intra, inter in _thread_configurations(cpus):
+        result = OrderedDict([('intra_op_threads', intra), ('inter_op_threads', inter)])
+        for workload, batch_size in workloads:
+            result[workload + '_ms'] = _isolated(_measure, intra, inter, workload, batch_size, config.image_size, ratio,
+                                                 config.color_channels, config.learning_rate, config.tune_steps)
+        print("intra %2d inter %2d: %s" % (intra, inter, ', '.join('%s %.2f ms' % (workload, result[workload + '_ms'])
+                                                                   for workload, _ in workloads)))
+        results.append(result)
+
+    profile = OrderedDict([('host', socket.gethostname()), ('platform', platform.platform()), ('cpus', cpus),
+                           ('tensorflow', tf.__version__), ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                           ('image_size', config.image_size), ('ratio', ratio)])
+    default = results[0]
+    for workload, batch_size in workloads:
+        best = min(results, key=lambda r: r[workload + '_ms'])
+        profile[workload] = OrderedDict([('intra_op_threads', best['intra_op_threads']), ('inter_op_threads', best['inter_op_threads']),
+                                         ('batch_size', batch_size), ('step_ms', best[workload + '_ms']),
+                                         ('default_step_ms', default[workload + '_ms'])])
+        print("Best %s: intra %d inter %d, %.2f ms per step, %.2fx the defaults" % (
+            workload, best['intra_op_threads'], best['inter_op_threads'], best[workload + '_ms'],
+            default[workload + '_ms'] / best[workload + '_ms']))
+    profile['results'] = results
+
+    if not os.path.exists(config.thread_profile_dir):
+        os.makedirs(config.thread_profile_dir)
+    path = get_thread_profile_path(config)
+    save_json(path, profile)
+    print("Saved thread profile to %s" % path)
+
+
+if __name__ == '__main__':
+    print("Start tuning threads")
+    tune_threads()
+    print("Finish tuning threads")
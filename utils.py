@@ -1,4 +1,7 @@
+import json
 import os
+import socket
+from functools import partial
 from glob import glob
 
 import numpy as np
@@ -11,6 +14,16 @@ CONFIG_TXT = 'config.txt'
 
 TFRECORD = 'tfrecord'
 
+INDEX_JSON = 'index.json'
+
+LR_NPY = 'lr.npy'
+
+HR_NPY = 'hr.npy'
+
+FILENAMES_TXT = 'filenames.txt'
+
+STATS_JSON = 'stats.json'
+
 FILENAME = 'filename'
 
 LR_IMAGE = 'lr_image'
@@ -21,8 +34,24 @@ HEIGHT = 'height'
 
 WIDTH = 'width'
 
+LR_HEIGHT = 'lr_height'
+
+LR_WIDTH = 'lr_width'
+
 DEPTH = 'depth'
 
+FORMAT = 'format'
+
+# Records without a format field store every pixel as a normalized float in a FloatList
+FLOAT_FORMAT = 'float'
+
+# Compact formats store the pixels as raw bytes, uint8 in [0, 255] or little-endian float16 in [0, 1]
+UINT8_FORMAT = 'uint8'
+
+FLOAT16_FORMAT = 'float16'
+
+RECORD_FORMATS = (FLOAT_FORMAT, UINT8_FORMAT, FLOAT16_FORMAT)
+
 
 def load_files(path, extension):
     path = os.path.join(path, "*.%s" % extension)
@@ -30,16 +59,147 @@ def load_files(path, extension):
     return files
 
 
+class SubsetConfig(object):
+    """The configuration with another subset, e.g. to read the validation subset next to the training subset."""
+
+    def __init__(self, config, subset):
+        self._config = config
+        self.subset = subset
+
+    def __getattr__(self, name):
+        return getattr(self._config, name)
+
+
+def get_tfrecord_dir(config):
+    return os.path.join(config.tfrecord_dir, config.dataset, config.subset)
+
+
+def get_npy_dir(config):
+    return os.path.join(config.npy_dir, config.dataset, config.subset)
+
+
+def load_tfrecord_index(config):
+    """Load the shard index of a subset or None when the subset is stored as one file per image."""
+    path = os.path.join(get_tfrecord_dir(config), INDEX_JSON)
+    if not os.path.exists(path):
+        return None
+    with open(path) as reader:
+        return json.load(reader)
+
+
+def save_json(path, data):
+    """Write a json file atomically, so an interrupted run never leaves a truncated file behind."""
+    with open(path + '.tmp', 'w') as writer:
+        json.dump(data, writer, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def save_tfrecord_index(target_dir, index):
+    save_json(os.path.join(target_dir, INDEX_JSON), index)
+
+
+def load_dataset_stats(config):
+    """Per-channel statistics of a subset saved by tfrecords.py --tfrecord_mode=validate, None if it has not been validated."""
+    path = os.path.join(get_tfrecord_dir(config), STATS_JSON)
+    if not os.path.exists(path):
+        return None
+    with open(path) as reader:
+        return json.load(reader)
+
+
+def get_input_stats(config):
+    """Per-channel mean and std of the low resolution images of a subset, srcnn standardizes its inputs with them."""
+    stats = load_dataset_stats(config)
+    assert stats is not None, 'No %s of subset %s, run tfrecords.py --tfrecord_mode=validate first' % (STATS_JSON, config.subset)
+    return stats['lr_image']['mean'], stats['lr_image']['std']
+
+
+def get_thread_profile_path(config, host=None):
+    return os.path.join(config.thread_profile_dir, '%s.json' % (host or socket.gethostname()))
+
+
+def load_thread_profile(config):
+    """Thread pool sizes tuned for this machine by tune_threads.py, None if it has not been tuned."""
+    path = get_thread_profile_path(config)
+    if not os.path.exists(path):
+        return None
+    with open(path) as reader:
+        return json.load(reader)
+
+
 def get_tfrecord_files(config):
-    return load_files(os.path.join(config.tfrecord_dir, config.dataset, config.subset), TFRECORD)
+    index = load_tfrecord_index(config)
+    if index is None:
+        return load_files(get_tfrecord_dir(config), TFRECORD)
+    return [os.path.join(get_tfrecord_dir(config), shard['file']) for shard in index['shards']]
 
 
-def get_image(image_path, image_size, colored=False):
-    image = scipy.misc.imread(image_path, flatten=(not colored), mode='YCbCr').astype(np.float32)
-    image = do_resize(image, [image_size, image_size])
+def get_tfrecord_compression(config):
+    index = load_tfrecord_index(config)
+    return index['compression'] if index else ''
+
+
+def get_record_count(config):
+    index = load_tfrecord_index(config)
+    return index['records'] if index else len(get_tfrecord_files(config))
+
+
+def get_record_format(config):
+    """Return the format of the records of a subset, from the shard index or from the first record."""
+    index = load_tfrecord_index(config)
+    if index is not None and FORMAT in index:
+        return index[FORMAT]
+    files = get_tfrecord_files(config)
+    if not files:
+        return FLOAT_FORMAT
+    options = get_tfrecord_options(get_tfrecord_compression(config))
+    for record in tf.python_io.tf_record_iterator(files[0], options=options):
+        feature = tf.train.Example.FromString(record).features.feature
+        if FORMAT in feature:
+            return feature[FORMAT].bytes_list.value[0].decode('utf-8')
+        break
+    return FLOAT_FORMAT
+
+
+def get_parse_function(config):
+    return partial(parse_function, record_format=get_record_format(config))
+
+
+def get_upscale_ratio(config):
+    return config.image_size // config.lr_image_size
+
+
+def get_tfrecord_options(compression):
+    compression_types = {
+        '': tf.python_io.TFRecordCompressionType.NONE,
+        'GZIP': tf.python_io.TFRecordCompressionType.GZIP,
+        'ZLIB': tf.python_io.TFRecordCompressionType.ZLIB
+    }
+    return tf.python_io.TFRecordOptions(compression_types[compression.upper()])
+
+
+def read_image(image_path, colored=False):
+    return scipy.misc.imread(image_path, flatten=(not colored), mode='YCbCr').astype(np.float32)
+
+
+def resize_image(image, image_size):
+    """Resize to a square of image_size or to a (height, width) tuple.
+    With image_size None the size is kept, the intensities are still rescaled like by any other resize.
+    """
+    if image_size is None:
+        shape = list(image.shape[:2])
+    elif isinstance(image_size, tuple):
+        shape = list(image_size)
+    else:
+        shape = [image_size, image_size]
+    image = do_resize(image, shape)
     return _pre_process(image)
 
 
+def get_image(image_path, image_size, colored=False):
+    return resize_image(read_image(image_path, colored), image_size)
+
+
 def save_output(lr_img, prediction, hr_img, path):
     h = max(hr_img.shape[0], prediction.shape[0], hr_img.shape[0])
     eh_img = do_resize(_post_process(prediction), [h, hr_img.shape[1]])
@@ -93,14 +253,49 @@ def _post_process(images):
     return post_processed.squeeze()
 
 
-def parse_function(proto):
+def to_uint8(image):
+    return np.round(_unnormalize(image)).clip(0, 255).astype(np.uint8)
+
+
+def encode_image(image, record_format):
+    """Convert a pre-processed image to the bytes stored by a compact record format."""
+    if record_format == UINT8_FORMAT:
+        return to_uint8(image).tobytes()
+    return image.astype('<f2').tobytes()
+
+
+def _decode_image(raw, record_format, shape):
+    if record_format == UINT8_FORMAT:
+        image = _normalize(tf.cast(tf.decode_raw(raw, tf.uint8), tf.float32))
+    else:
+        image = tf.cast(tf.decode_raw(raw, tf.float16, little_endian=True), tf.float32)
+    return tf.reshape(image, shape)
+
+
+def parse_function(proto, record_format=FLOAT_FORMAT):
+    """Parse a record into low and high resolution images and the image name.
+
+    Compact records are reshaped to their stored height and width when FLAGS.variable_size is set,
+    their shape is then only known at run time. Otherwise the shapes are fixed by the image size flags.
+    """
+    hr_shape = (FLAGS.image_size, FLAGS.image_size, FLAGS.color_channels)
+    lr_shape = (FLAGS.lr_image_size, FLAGS.lr_image_size, FLAGS.color_channels)
+    if record_format == FLOAT_FORMAT:
+        # TODO Reshape doesn't work, I have to put the shape here.
+        hr_feature = tf.FixedLenFeature(hr_shape, tf.float32)
+        lr_feature = tf.FixedLenFeature(lr_shape, tf.float32)
+    else:
+        hr_feature = tf.FixedLenFeature([], tf.string)
+        lr_feature = tf.FixedLenFeature([], tf.string)
     features = {
         HEIGHT: tf.FixedLenFeature([], tf.int64),
         WIDTH: tf.FixedLenFeature([], tf.int64),
         DEPTH: tf.FixedLenFeature([], tf.int64),
-        # TODO Reshape doesn't work, I have to put the shape here.
-        HR_IMAGE: tf.FixedLenFeature((FLAGS.image_size, FLAGS.image_size, FLAGS.color_channels), tf.float32),
-        LR_IMAGE: tf.FixedLenFeature((256, 256, FLAGS.color_channels), tf.float32),
+        # records written before variable sizes always have a low resolution image of lr_image_size
+        LR_HEIGHT: tf.FixedLenFeature([], tf.int64, default_value=FLAGS.lr_image_size),
+        LR_WIDTH: tf.FixedLenFeature([], tf.int64, default_value=FLAGS.lr_image_size),
+        HR_IMAGE: hr_feature,
+        LR_IMAGE: lr_feature,
         FILENAME: tf.FixedLenFeature([], tf.string)
     }
     parsed_features = tf.parse_single_example(proto, features)
@@ -108,10 +303,80 @@ def parse_function(proto):
     lr_images = parsed_features[LR_IMAGE]
     hr_images = parsed_features[HR_IMAGE]
     name = parsed_features[FILENAME]
+    if record_format != FLOAT_FORMAT:
+        if FLAGS.variable_size:
+            depth = tf.cast(parsed_features[DEPTH], tf.int32)
+            hr_shape = tf.stack([tf.cast(parsed_features[HEIGHT], tf.int32), tf.cast(parsed_features[WIDTH], tf.int32), depth])
+            lr_shape = tf.stack([tf.cast(parsed_features[LR_HEIGHT], tf.int32), tf.cast(parsed_features[LR_WIDTH], tf.int32), depth])
+        lr_images = _decode_image(lr_images, record_format, lr_shape)
+        hr_images = _decode_image(hr_images, record_format, hr_shape)
+        if FLAGS.variable_size:
+            lr_images.set_shape([None, None, FLAGS.color_channels])
+            hr_images.set_shape([None, None, FLAGS.color_channels])
 
     return lr_images, hr_images, name
 
 
+def sample_patches(lr_image, hr_image, name, ratio, patch_size, stride, count):
+    """Sample count random aligned patches from an image pair.
+
+    Patch positions lie on a grid with the given stride in low resolution pixels, a stride smaller than the patch size
+    gives overlapping patches. Every position is used at most once per call, images smaller than a patch give no patches.
+    Returns a dataset of (lr_patch, hr_patch, name) elements.
+    """
+    shape = tf.shape(lr_image)
+    rows = tf.maximum((shape[0] - patch_size) // stride + 1, 0)
+    cols = tf.maximum((shape[1] - patch_size) // stride + 1, 0)
+    positions = tf.random_shuffle(tf.range(rows * cols))[:count]
+    offsets = tf.stack([positions // cols * stride, positions % cols * stride], axis=1)
+
+    def crop(offset):
+        lr_patch = tf.slice(lr_image, [offset[0], offset[1], 0], [patch_size, patch_size, -1])
+        hr_patch = tf.slice(hr_image, [offset[0] * ratio, offset[1] * ratio, 0], [patch_size * ratio, patch_size * ratio, -1])
+        return lr_patch, hr_patch
+
+    def crop_all():
+        return tf.map_fn(crop, offsets, dtype=(tf.float32, tf.float32))
+
+    def no_patches():
+        # map_fn cannot stack zero patches of an unknown shape
+        return (tf.zeros([0, patch_size, patch_size, shape[2]]),
+                tf.zeros([0, patch_size * ratio, patch_size * ratio, shape[2]]))
+
+    lr_patches, hr_patches = tf.cond(tf.size(positions) > 0, crop_all, no_patches)
+    channels = lr_image.get_shape().as_list()[2]
+    lr_patches.set_shape([None, patch_size, patch_size, channels])
+    hr_patches.set_shape([None, patch_size * ratio, patch_size * ratio, channels])
+    names = tf.fill(tf.shape(offsets)[:1], name)
+    return tf.data.Dataset.from_tensor_slices((lr_patches, hr_patches, names))
+
+
+def has_min_variance(lr_patch, hr_patch, name, min_variance):
+    return tf.reduce_mean(tf.square(hr_patch - tf.reduce_mean(hr_patch))) > min_variance
+
+
 if __name__ == '__main__':
-    print("start")
-    print("finish")
+    # sample_patches gives aligned patches, and no patches for images smaller than a patch, within a dataset of mixed sizes
+    ratio, patch_size, stride, count = 2, 8, 4, 16
+    sizes = {b'large': (20, 30), b'narrow': (5, 30), b'small': (5, 5), b'exact': (8, 8)}
+    images = []
+    for name, (height, width) in sorted(sizes.items()):
+        lr = np.random.rand(height, width, 1).astype(np.float32)
+        images.append((lr, np.repeat(np.repeat(lr, ratio, axis=0), ratio, axis=1), name))
+    dataset = tf.data.Dataset.from_generator(lambda: iter(images), (tf.float32, tf.float32, tf.string),
+                                             (tf.TensorShape([None, None, 1]), tf.TensorShape([None, None, 1]), tf.TensorShape([])))
+    dataset = dataset.flat_map(lambda lr, hr, name: sample_patches(lr, hr, name, ratio, patch_size, stride, count))
+    next_element = dataset.make_one_shot_iterator().get_next()
+    patches = {name: 0 for name in sizes}
+    with tf.Session() as sess:
+        while True:
+            try:
+                lr_patch, hr_patch, name = sess.run(next_element)
+            except tf.errors.OutOfRangeError:
+                break
+            assert np.array_equal(np.repeat(np.repeat(lr_patch, ratio, axis=0), ratio, axis=1), hr_patch)
+            patches[name] += 1
+    for name, (height, width) in sorted(sizes.items()):
+        positions = max((height - patch_size) // stride + 1, 0) * max((width - patch_size) // stride + 1, 0)
+        print("%s image %dx%d: %d patches" % (name.decode('utf-8'), height, width, patches[name]))
+        assert patches[name] == min(count, positions)